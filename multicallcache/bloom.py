@@ -0,0 +1,216 @@
+import math
+import os
+from pathlib import Path
+import struct
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # windows, concurrent writers from several processes can lose each others bits
+    fcntl = None
+
+MAGIC = b"MCBLOOM1"
+HEADER = struct.Struct(">8sQIQQ")  # magic, num_bits, num_hashes, capacity, count
+DEFAULT_CAPACITY = 10_000_000
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+
+
+class BloomFilter:
+    """
+    Compact set membership over call ids, persisted to `path`. `key in bloom_filter` is never a false negative,
+    it is a false positive about false_positive_rate of the time while it holds fewer than capacity keys.
+
+    The keys are call ids, which are already sha256 digests, so the k bit positions are derived from the first
+    16 bytes of the key by double hashing instead of hashing again.
+    """
+
+    def __init__(self, path: Path, num_bits: int, num_hashes: int, capacity: int, count: int = 0, bits=None):
+        self.path = path
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.capacity = capacity
+        self.count = count
+        self.bits = np.zeros((num_bits + 7) // 8, dtype=np.uint8) if bits is None else bits
+        self._dirty_bytes: set[int] = set()
+        self._lock = threading.Lock()
+        self._unflushed_count = 0  # keys added since the last flush, part of count but not of the count on disk
+        # (inode, count) of self.path when this filter last read or wrote it. The count on disk grows with every flush
+        # of any process and save() replaces the file, so it changes whenever another process changed the bits.
+        self._file_stamp: tuple[int, int] | None = None
+
+    @classmethod
+    def for_capacity(cls, path: Path, capacity: int, false_positive_rate: float) -> "BloomFilter":
+        """The smallest filter that stays under false_positive_rate while holding capacity keys"""
+        num_bits = max(8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        return cls(path, num_bits, num_hashes, capacity)
+
+    @property
+    def size_in_bytes(self) -> int:
+        return self.bits.nbytes
+
+    def _bit_positions(self, keys: list[bytes]) -> np.ndarray:
+        """(len(keys), num_hashes) array of the bit positions of each key"""
+        prefixes = np.frombuffer(b"".join(key[:16] for key in keys), dtype=">u8").reshape(-1, 2).astype(np.uint64)
+        h1, h2 = prefixes[:, :1], prefixes[:, 1:]
+        with np.errstate(over="ignore"):
+            positions = h1 + np.arange(self.num_hashes, dtype=np.uint64) * h2
+        return positions % np.uint64(self.num_bits)
+
+    def add_many(self, keys: list[bytes]) -> None:
+        if len(keys) == 0:
+            return
+        positions = self._bit_positions(keys).ravel()
+        byte_indexes = positions >> np.uint64(3)
+        masks = (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)).astype(np.uint8)
+        with self._lock:
+            np.bitwise_or.at(self.bits, byte_indexes, masks)
+            self._dirty_bytes.update(byte_indexes.tolist())
+            self.count += len(keys)
+            self._unflushed_count += len(keys)
+
+    def contains_many(self, keys: list[bytes]) -> np.ndarray:
+        """bool array, False means the key was definitely never added"""
+        if len(keys) == 0:
+            return np.zeros(0, dtype=bool)
+        positions = self._bit_positions(keys)
+        bits_set = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return bits_set.all(axis=1)
+
+    def __contains__(self, key: bytes) -> bool:
+        return bool(self.contains_many([key])[0])
+
+    def save(self) -> None:
+        """Write the whole filter to self.path"""
+        tmp_path = f"{self.path}.tmp"
+        with self._lock:
+            with open(tmp_path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, self.num_bits, self.num_hashes, self.capacity, self.count))
+                f.write(self.bits.tobytes())
+                self._file_stamp = (os.fstat(f.fileno()).st_ino, self.count)
+            os.replace(tmp_path, self.path)
+            self._dirty_bytes.clear()
+            self._unflushed_count = 0
+
+    def flush(self) -> None:
+        """
+        Write only the bytes that changed since the last flush. They are OR-ed with what is on disk so bits
+        added by another process writing to the same filter are kept, and the keys added are counted on top of
+        the count on disk.
+        """
+        with self._lock:
+            if not self._dirty_bytes:
+                return
+            with open(self.path, "r+b") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                self.count = HEADER.unpack(f.read(HEADER.size))[4] + self._unflushed_count
+                for start, stop in _to_runs(sorted(self._dirty_bytes)):
+                    f.seek(HEADER.size + start)
+                    on_disk = np.frombuffer(f.read(stop - start), dtype=np.uint8)
+                    self.bits[start:stop] |= on_disk
+                    f.seek(HEADER.size + start)
+                    f.write(self.bits[start:stop].tobytes())
+                f.seek(0)
+                f.write(HEADER.pack(MAGIC, self.num_bits, self.num_hashes, self.capacity, self.count))
+                self._file_stamp = (os.fstat(f.fileno()).st_ino, self.count)
+            self._dirty_bytes.clear()
+            self._unflushed_count = 0
+
+    def refresh(self) -> bool:
+        """
+        OR in the bits another process wrote to self.path since this filter last read or wrote it, so the keys it
+        saved are not reported as definite misses. False if the file now holds a filter of another size.
+        """
+        with self._lock:
+            with open(self.path, "rb") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_SH)
+                _, num_bits, num_hashes, _, count = HEADER.unpack(f.read(HEADER.size))
+                file_stamp = (os.fstat(f.fileno()).st_ino, count)
+                if file_stamp == self._file_stamp:
+                    return True
+                if (num_bits, num_hashes) != (self.num_bits, self.num_hashes):
+                    return False
+                self.bits |= np.frombuffer(f.read(), dtype=np.uint8)
+            self.count = count + self._unflushed_count
+            self._file_stamp = file_stamp
+        return True
+
+    @classmethod
+    def load(cls, path: Path) -> "BloomFilter":
+        with open(path, "rb") as f:
+            magic, num_bits, num_hashes, capacity, count = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path=} is not a bloom filter")
+            bits = np.frombuffer(f.read(), dtype=np.uint8).copy()
+            bloom_filter = cls(path, num_bits, num_hashes, capacity, count, bits)
+            bloom_filter._file_stamp = (os.fstat(f.fileno()).st_ino, count)
+        return bloom_filter
+
+
+def _to_runs(sorted_indexes: list[int], max_gap: int = 64) -> list[tuple[int, int]]:
+    """Merge sorted byte indexes into [start, stop) runs so nearby bytes are written together"""
+    runs = []
+    start = previous = sorted_indexes[0]
+    for index in sorted_indexes[1:]:
+        if index - previous > max_gap:
+            runs.append((start, previous + 1))
+            start = index
+        previous = index
+    runs.append((start, previous + 1))
+    return runs
+
+
+_bloom_filters: dict[str, BloomFilter] = {}
+_bloom_filters_lock = threading.Lock()
+
+
+def bloom_filter_path(cache_path: Path) -> str:
+    return f"{cache_path}.bloom"
+
+
+def get_bloom_filter(cache_path: Path) -> BloomFilter | None:
+    """
+    The bloom filter stored next to cache_path, or None if create_bloom_filter() was never called for it.
+    It is loaded once, then refreshed with what other processes added whenever its file changed.
+    """
+    key = os.path.abspath(str(cache_path))
+    path = bloom_filter_path(cache_path)
+    bloom_filter = _bloom_filters.get(key)
+    try:
+        if bloom_filter is None or not bloom_filter.refresh():
+            with _bloom_filters_lock:
+                bloom_filter = _bloom_filters[key] = BloomFilter.load(path)
+    except FileNotFoundError:
+        forget_bloom_filter(cache_path)
+        return None
+    return bloom_filter
+
+
+def forget_bloom_filter(cache_path: Path) -> None:
+    """Drop the loaded filter of cache_path, eg after its file is deleted"""
+    with _bloom_filters_lock:
+        _bloom_filters.pop(os.path.abspath(str(cache_path)), None)
+
+
+def register_bloom_filter(cache_path: Path, bloom_filter: BloomFilter) -> BloomFilter:
+    """
+    Save bloom_filter and only then register it so get_bloom_filter() finds it,
+    a save_data() in another thread can't flush to its file before the file exists.
+    """
+    bloom_filter.save()
+    with _bloom_filters_lock:
+        _bloom_filters[os.path.abspath(str(cache_path))] = bloom_filter
+    return bloom_filter
+
+
+def new_bloom_filter(
+    cache_path: Path, capacity: int = DEFAULT_CAPACITY, false_positive_rate: float = DEFAULT_FALSE_POSITIVE_RATE
+) -> BloomFilter:
+    """An empty filter for cache_path, saved and registered"""
+    return register_bloom_filter(
+        cache_path, BloomFilter.for_capacity(bloom_filter_path(cache_path), capacity, false_positive_rate)
+    )
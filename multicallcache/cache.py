@@ -1,12 +1,45 @@
-import sqlite3
+from decimal import Decimal
+import hashlib
+import json
+import numpy as np
 import pandas as pd
 from pathlib import Path
+import pickle
 import os
-
-from multicallcache.call import Call
+import shutil
+import sqlite3
+from typing import Iterable, Sequence
+
+from multicallcache.bloom import (
+    BloomFilter,
+    DEFAULT_CAPACITY,
+    DEFAULT_FALSE_POSITIVE_RATE,
+    bloom_filter_path,
+    forget_bloom_filter,
+    get_bloom_filter,
+    new_bloom_filter,
+    register_bloom_filter,
+)
+from multicallcache.call import Call, call_id_prefix, call_ids_by_call
+from multicallcache.connection import get_connection, close_connections
 from multicallcache.constants import CACHE_PATH
-from multicallcache.multicall import CallRawData, Multicall
-from multicallcache.utils import flatten, time_function
+from multicallcache.memory_cache import LRUCache, get_memory_cache
+from multicallcache.multicall import CallRawData
+from multicallcache.signature import Signature, parse_signature
+from multicallcache.shards import (
+    DEFAULT_BLOCKS_PER_SHARD,
+    existing_shard_paths,
+    existing_shards_in_block_range,
+    forget_shards_config,
+    get_blocks_per_shard,
+    get_shards_config,
+    is_sharded,
+    map_over_shards,
+    shard_path,
+    shard_start,
+    write_shards_config,
+)
+from multicallcache.utils import time_function
 
 # from multicall.constants import CACHE_PATH
 
@@ -34,58 +67,336 @@ log attempted to read X rows, found y rows and did not find z rows from dbPATH
 """
 
 
-COLUMNS = [
-    "callId",  # sha256(chainId, target, signature, arguements, block)
-    "target",
-    "signature",
-    "argumentsAsStr",
-    "argumentsAsPickle",
-    "block",
-    "chainId",
-    "success",
-    "response",
+SCHEMA_VERSION = 1  # stored in `PRAGMA user_version`, see migrate_db()
+
+# get_data_from_disk() range scans each call when at least this fraction of the blocks between the lowest and highest
+# requested block are requested, otherwise it seeks each (call, block) pair
+RANGE_SCAN_MIN_BLOCK_DENSITY = 0.25
+
+FOUND_COLUMNS = ["callIndex", "block", "success", "response", "decoded"]
+
+# responseHash is stored twice per distinct response, in responseBlob and its unique index. 16 bytes keeps that small
+# and collisions are still out of reach, around 1e-15 after 1e12 distinct responses.
+RESPONSE_HASH_BYTES = 16
+
+# Each call identity is stored once in callIdentity and each distinct response once in responseBlob,
+# each (call, block) result only refers to them by callKey and responseKey.
+# callResult is clustered on (callKey, block) so lookups and block range scans of a call are index seeks.
+# Results at blocks that are not finalized yet are kept apart in pendingResult, keyed by the hash of the block
+# they ran on, and only move to callResult once that block is finalized, see promote_pending_results().
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS callIdentity (
+        callKey INTEGER PRIMARY KEY,
+        callHash BLOB UNIQUE, -- Call.to_key(), sha256(chainId, target, signature, arguments)
+        chainId INTEGER,
+        target TEXT,
+        signature TEXT,
+        argumentsAsStr TEXT,
+        argumentsAsPickle BLOB
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS responseBlob (
+        responseKey INTEGER PRIMARY KEY,
+        responseHash BLOB UNIQUE, -- truncated sha256(output types, response), see _response_hash()
+        response BLOB,
+        decoded BLOB -- response abi decoded as tagged json, NULL when it was not decodable, see dump_decoded()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS callResult (
+        callKey INTEGER,
+        block INTEGER,
+        success BOOLEAN,
+        responseKey INTEGER,
+        PRIMARY KEY (callKey, block)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS blockHash (
+        chainId INTEGER,
+        block INTEGER,
+        blockHash BLOB, -- of the block the results at (chainId, block) ran on, from the tryBlockAndAggregate engine
+        PRIMARY KEY (chainId, block)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS pendingResult (
+        blockHash BLOB, -- of the not yet finalized block the result ran on
+        callKey INTEGER,
+        chainId INTEGER,
+        block INTEGER,
+        success BOOLEAN,
+        responseKey INTEGER,
+        PRIMARY KEY (blockHash, callKey)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS pendingResultBlock ON pendingResult (chainId, block)",
 ]
 
 
-def return_cleaned_data_as_df(data: list[CallRawData]) -> pd.DataFrame:
-    # list_of_values_to_cache = [c.convert_to_format_to_save_in_cache_db() for c in data]
-    pass
+def _save_call_identities(conn: sqlite3.Connection, calls: list[Call]) -> dict[Call, int]:
+    """Insert the identity of each call if it is not already stored. Returns call -> callKey"""
+    call_hashes = {call: call.to_key() for call in calls}
+    conn.executemany(
+        """
+        INSERT INTO callIdentity (callHash, chainId, target, signature, argumentsAsStr, argumentsAsPickle)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(callHash) DO NOTHING;
+        """,
+        [
+            (
+                call_hash,
+                call.get_chain_id(),
+                call.target,
+                call.signature.signature,
+                str(call.arguments),
+                pickle.dumps(call.arguments),
+            )
+            for call, call_hash in call_hashes.items()
+        ],
+    )
+    return {call: _get_call_key(conn, call_hash) for call, call_hash in call_hashes.items()}
 
 
-def save_data(data: list[CallRawData], cache_path: Path) -> None:
-    # Convert the CallRawData objects to the format required for the database
-    list_of_values_to_cache = [c.convert_to_format_to_save_in_cache_db() for c in data]
+def _get_call_key(conn: sqlite3.Connection, call_hash: bytes) -> int | None:
+    result = conn.execute("SELECT callKey FROM callIdentity WHERE callHash = ?", (call_hash,)).fetchone()
+    return result[0] if result is not None else None
 
-    with sqlite3.connect(cache_path) as conn:
-        cursor = conn.cursor()
 
-        # Bulk insert using executemany
-        cursor.executemany(
+def save_data(data: list[CallRawData], cache_path: Path, pending: bool = False) -> None:
+    """
+    Save data to the cache. pending=True is for results at blocks that are not finalized yet, every one needs
+    its block_hash. They are saved to pendingResult under that hash, where only get_pending_data() reads them,
+    and replace the pending results of another hash at the same block, that block was reorged away.
+    """
+    if pending and any(d.block_hash is None for d in data):
+        raise ValueError("pending results need the hash of the block they ran on")
+    if is_sharded(cache_path):
+        data_by_shard: dict[Path, list[CallRawData]] = {}
+        for d in data:
+            data_by_shard.setdefault(shard_path(cache_path, d.chainID, d.block), []).append(d)
+        map_over_shards(lambda shard: _save_data_to_shard(cache_path, *shard, pending), list(data_by_shard.items()))
+        return
+
+    # each distinct response is decoded and stored once however many calls and blocks returned it
+    response_hashes = [_response_hash(d.call.signature.output_types, d.response) for d in data]
+    distinct_data: dict[bytes, CallRawData] = {}
+    for d, response_hash in zip(data, response_hashes):
+        distinct_data.setdefault(response_hash, d)
+    blobs: dict[bytes, tuple[bytes, bytes | None]] = {  # responseHash -> (response, decoded)
+        response_hash: (d.response, decoded)
+        for (response_hash, d), decoded in zip(distinct_data.items(), _dump_all_decoded(list(distinct_data.values())))
+    }
+
+    # the results of a (chain, block) all ran on the same block, the last hash seen is the one they share
+    block_hashes = {(d.chainID, d.block): bytes(d.block_hash) for d in data if d.block_hash is not None}
+
+    with get_connection(cache_path) as conn:
+        call_keys = _save_call_identities(conn, list(dict.fromkeys(d.call for d in data)))
+        conn.executemany(
+            """
+            INSERT INTO responseBlob (responseHash, response, decoded)
+            VALUES (?, ?, ?)
+            ON CONFLICT(responseHash) DO NOTHING;
+            """,
+            [(response_hash, response, decoded) for response_hash, (response, decoded) in blobs.items()],
+        )
+        if pending:
+            _save_pending_results(conn, data, call_keys, response_hashes, block_hashes)
+            conn.commit()
+            return
+        changes_before = conn.total_changes
+        conn.executemany(
+            """
+            INSERT INTO callResult (callKey, block, success, responseKey)
+            VALUES (?, ?, ?, (SELECT responseKey FROM responseBlob WHERE responseHash = ?))
+            ON CONFLICT(callKey, block) DO NOTHING;
+            """,
+            [(call_keys[d.call], d.block, d.success, h) for d, h in zip(data, response_hashes)],
+        )
+        # a (call, block) that was already saved keeps its stored result, eg after a refetch of a reorged block
+        all_inserted = conn.total_changes - changes_before == len(data)
+        conn.executemany(
             """
-            INSERT INTO multicallCache (callId, target, signature, argumentsAsStr, argumentsAsPickle, block, chainId, success, response)
-            VALUES (?, ?, ?, ?, ?, ?, ? , ?, ?)
-            ON CONFLICT(callId) DO NOTHING;
+            INSERT INTO blockHash (chainId, block, blockHash)
+            VALUES (?, ?, ?)
+            ON CONFLICT(chainId, block) DO UPDATE SET blockHash = excluded.blockHash;
             """,
-            list_of_values_to_cache,
+            [(chain, block, block_hash) for (chain, block), block_hash in block_hashes.items()],
         )
         conn.commit()
 
+    bloom_filter = get_bloom_filter(cache_path)
+    if bloom_filter is not None:
+        bloom_filter.add_many([d.call_id for d in data])
+        bloom_filter.flush()
+
+    memory_cache = get_memory_cache()
+    if memory_cache is not None:
+        for d, response_hash in zip(data, response_hashes):
+            if all_inserted:
+                memory_cache.put(cache_path, d.call_id, bool(d.success), d.response, blobs[response_hash][1])
+            else:  # the next read refills it from what the db kept
+                memory_cache.remove(cache_path, d.call_id)
+
+
+def _save_pending_results(
+    conn: sqlite3.Connection,
+    data: list[CallRawData],
+    call_keys: dict[Call, int],
+    response_hashes: list[bytes],
+    block_hashes: dict[tuple[int, int], bytes],
+) -> None:
+    conn.executemany(
+        "DELETE FROM pendingResult WHERE chainId = ? AND block = ? AND blockHash != ?",
+        [(chain, block, block_hash) for (chain, block), block_hash in block_hashes.items()],
+    )
+    conn.executemany(
+        """
+        INSERT INTO pendingResult (blockHash, callKey, chainId, block, success, responseKey)
+        VALUES (?, ?, ?, ?, ?, (SELECT responseKey FROM responseBlob WHERE responseHash = ?))
+        ON CONFLICT(blockHash, callKey) DO NOTHING;
+        """,
+        [
+            (bytes(d.block_hash), call_keys[d.call], d.chainID, d.block, d.success, h)
+            for d, h in zip(data, response_hashes)
+        ],
+    )
+
+
+def _response_hash(output_types: str, response: bytes) -> bytes:
+    """
+    The key of a response in responseBlob. The output types are part of it because the decoded value
+    stored with the response depends on them, the same bytes returned by different signatures are stored once per type.
+    """
+    return hashlib.sha256(output_types.encode("utf-8") + b" " + response).digest()[:RESPONSE_HASH_BYTES]
+
+
+def _dump_all_decoded(data: list[CallRawData]) -> list[bytes | None]:
+    """
+    The response of each CallRawData abi decoded and dumped with dump_decoded(), so reads can skip eth_abi.
+    None when there is nothing to decode or it does not decode as the signature's output types.
+    Responses are decoded with one Signature.decode_many() per signature.
+    """
+    rows_by_signature: dict[Signature, list[int]] = {}
+    for i, d in enumerate(data):
+        if d.response:
+            rows_by_signature.setdefault(d.call.signature, []).append(i)
+
+    dumped: list[bytes | None] = [None] * len(data)
+    for signature, rows in rows_by_signature.items():
+        for i, decoded in zip(rows, signature.decode_many([data[i].response for i in rows])):
+            if decoded is not None:
+                dumped[i] = dump_decoded(decoded)
+    return dumped
+
+
+def dump_decoded(decoded: tuple) -> bytes | None:
+    """
+    decoded as json, tuples are json arrays and the other types eth_abi decodes to are tagged objects:
+    {"x": hex} for bytes, {"l": [...]} for lists and {"d": str} for Decimal. None if a value has another type.
+    Unlike pickle, loading it back can't run code from a cache file someone else made.
+    """
+    try:
+        return json.dumps(_to_json(decoded), separators=(",", ":")).encode("utf-8")
+    except TypeError:
+        return None
+
+
+def _to_json(value):
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, bytes):
+        return {"x": value.hex()}
+    if isinstance(value, tuple):
+        return [_to_json(v) for v in value]
+    if isinstance(value, list):
+        return {"l": [_to_json(v) for v in value]}
+    if isinstance(value, Decimal):
+        return {"d": str(value)}
+    raise TypeError(f"can't store a decoded {type(value)=}")
+
+
+def _from_json(value):
+    if isinstance(value, list):
+        return tuple(_from_json(v) for v in value)
+    if isinstance(value, dict):
+        if "x" in value:
+            return bytes.fromhex(value["x"])
+        if "l" in value:
+            return [_from_json(v) for v in value["l"]]
+        if "d" in value:
+            return Decimal(value["d"])
+        raise ValueError(f"unknown tag in {value=}")
+    return value
+
+
+def load_decoded(decoded: bytes | None) -> tuple | None:
+    """
+    The decoded output stored by save_data(), or None if the response has to be decoded from the raw bytes,
+    which includes anything that is not tagged json, eg the pickles older versions stored.
+    """
+    if decoded is None:
+        return None
+    try:
+        loaded = _from_json(json.loads(decoded))
+    except ValueError:  # also UnicodeDecodeError and json.JSONDecodeError
+        return None
+    return loaded if isinstance(loaded, tuple) else None
+
+
+def load_all_decoded(
+    signatures: Sequence[Signature], responses: Sequence[bytes], all_decoded: Iterable[bytes | None]
+) -> list[tuple | None]:
+    """
+    load_decoded() of every row, where signatures[i] is the signature of the call that returned responses[i].
+    Rows saved without a decoded output are decoded here with one Signature.decode_many() per signature,
+    the rows that still don't decode stay None and are left to Call.decode_output() to raise about.
+    """
+    decoded_outputs = [load_decoded(decoded) for decoded in all_decoded]
+    rows_by_signature: dict[Signature, list[int]] = {}
+    for i, decoded in enumerate(decoded_outputs):
+        if decoded is None and len(responses[i]) > 0:
+            rows_by_signature.setdefault(signatures[i], []).append(i)
+
+    for signature, rows in rows_by_signature.items():
+        for i, decoded in zip(rows, signature.decode_many([responses[i] for i in rows])):
+            decoded_outputs[i] = decoded
+    return decoded_outputs
+
+
+def _save_data_to_shard(cache_path: Path, path: Path, data: list[CallRawData], pending: bool = False) -> None:
+    if not os.path.exists(path):
+        os.makedirs(path.parent, exist_ok=True)
+        _create_schema(path)
+        bloom_filter_config = get_shards_config(cache_path).get("bloom_filter")
+        if bloom_filter_config is not None:
+            new_bloom_filter(path, **bloom_filter_config)
+    save_data(data, path, pending)
+
 
 def delete_call(call: Call, block: int, cache_path: Path) -> bool:
     """Delete a single call entry based on callId and return True if the operation was successful, False otherwise."""
+    if is_sharded(cache_path):
+        path = shard_path(cache_path, call.get_chain_id(), block)
+        return delete_call(call, block, path) if os.path.exists(path) else False
 
-    call_id = call.to_id(block)
+    memory_cache = get_memory_cache()
+    if memory_cache is not None:
+        memory_cache.remove(cache_path, call.to_id(block))
 
-    with sqlite3.connect(cache_path) as conn:
+    with get_connection(cache_path) as conn:
         cursor = conn.cursor()
 
         # Execute the delete statement
         cursor.execute(
             """
-            DELETE FROM multicallCache
-            WHERE callId = ?
+            DELETE FROM callResult
+            WHERE callKey = (SELECT callKey FROM callIdentity WHERE callHash = ?) AND block = ?
             """,
-            (call_id,),
+            (call.to_key(), block),
         )
 
         # Check if the row was deleted
@@ -96,161 +407,428 @@ def delete_call(call: Call, block: int, cache_path: Path) -> bool:
             return False  # No row was deleted, possibly because it did not exist
 
 
-def isCached(call: Call, block: int, cache_path: Path) -> bool:
-    """return bool -> we have this"""
+def get_block_hash(chain: int, block: int, cache_path: Path) -> bytes | None:
+    """The hash of the block the results cached at (chain, block) ran on, None if it was not recorded"""
+    if is_sharded(cache_path):
+        path = shard_path(cache_path, chain, block)
+        return get_block_hash(chain, block, path) if os.path.exists(path) else None
 
-    call_id = call.to_id(block)
+    with get_connection(cache_path) as conn:
+        result = conn.execute(
+            "SELECT blockHash FROM blockHash WHERE chainId = ? AND block = ?", (chain, block)
+        ).fetchone()
+        return bytes(result[0]) if result is not None else None
 
-    with sqlite3.connect(cache_path) as conn:
-        cursor = conn.cursor()
 
-        cursor.execute(
+def get_pending_data(calls: list[Call], block: int, block_hash: bytes, cache_path: Path) -> list[CallRawData] | None:
+    """
+    The results of calls saved with save_data(pending=True) at block while its hash was block_hash,
+    in the order of calls. None unless every call has one.
+    """
+    if is_sharded(cache_path):
+        path = shard_path(cache_path, calls[0].get_chain_id(), block)
+        return get_pending_data(calls, block, block_hash, path) if os.path.exists(path) else None
+
+    with get_connection(cache_path) as conn:
+        rows = conn.execute(
             """
-            SELECT success, response
-            FROM multicallCache
-            WHERE callId = ?
+            SELECT i.callHash, p.success, b.response, b.decoded
+            FROM pendingResult p
+            JOIN callIdentity i ON i.callKey = p.callKey
+            JOIN responseBlob b ON b.responseKey = p.responseKey
+            WHERE p.blockHash = ?
             """,
-            (call_id,),
+            (bytes(block_hash),),
+        ).fetchall()
+    rows_by_call_hash = {bytes(call_hash): row for call_hash, *row in rows}
+    if any(call.to_key() not in rows_by_call_hash for call in calls):
+        return None
+
+    found = [rows_by_call_hash[call.to_key()] for call in calls]
+    all_decoded = load_all_decoded(
+        [call.signature for call in calls], [response for _, response, _ in found], [d for _, _, d in found]
+    )
+    return [
+        CallRawData(call, block, bool(success), response, decoded, bytes(block_hash))
+        for call, (success, response, _), decoded in zip(calls, found, all_decoded)
+    ]
+
+
+def has_pending_results(chain: int, block: int, cache_path: Path) -> bool:
+    if is_sharded(cache_path):
+        path = shard_path(cache_path, chain, block)
+        return has_pending_results(chain, block, path) if os.path.exists(path) else False
+
+    with get_connection(cache_path) as conn:
+        return (
+            conn.execute(
+                "SELECT 1 FROM pendingResult WHERE chainId = ? AND block = ? LIMIT 1", (chain, block)
+            ).fetchone()
+            is not None
         )
-        result = cursor.fetchone()
-        if result:
-            return True
-        else:
-            return False
+
+
+def promote_pending_results(chain: int, block: int, block_hash: bytes, cache_path: Path) -> int:
+    """
+    Once block is finalized with block_hash, move its pending results of that hash into callResult,
+    where every other read trusts them, and drop the pending results of any other hash at block.
+    Returns the number of results promoted.
+    """
+    if is_sharded(cache_path):
+        path = shard_path(cache_path, chain, block)
+        return promote_pending_results(chain, block, block_hash, path) if os.path.exists(path) else 0
+
+    with get_connection(cache_path) as conn:
+        cursor = conn.execute(
+            """
+            INSERT INTO callResult (callKey, block, success, responseKey)
+            SELECT callKey, block, success, responseKey
+            FROM pendingResult
+            WHERE blockHash = ? AND chainId = ? AND block = ?
+            ON CONFLICT(callKey, block) DO NOTHING;
+            """,
+            (bytes(block_hash), chain, block),
+        )
+        num_promoted = cursor.rowcount
+        if num_promoted > 0:
+            conn.execute(
+                """
+                INSERT INTO blockHash (chainId, block, blockHash)
+                VALUES (?, ?, ?)
+                ON CONFLICT(chainId, block) DO UPDATE SET blockHash = excluded.blockHash;
+                """,
+                (chain, block, bytes(block_hash)),
+            )
+        conn.execute("DELETE FROM pendingResult WHERE chainId = ? AND block = ?", (chain, block))
+        conn.commit()
+
+    if num_promoted > 0:
+        bloom_filter = get_bloom_filter(cache_path)
+        if bloom_filter is not None:
+            bloom_filter.add_many(_promoted_call_ids(chain, block, cache_path))
+            bloom_filter.flush()
+    return num_promoted
+
+
+def _promoted_call_ids(chain: int, block: int, cache_path: Path) -> list[bytes]:
+    """The call ids of every result in callResult at (chain, block)"""
+    with get_connection(cache_path) as conn:
+        identities = conn.execute(
+            """
+            SELECT i.target, i.signature, i.argumentsAsStr
+            FROM callResult r
+            JOIN callIdentity i ON i.callKey = r.callKey
+            WHERE r.block = ? AND i.chainId = ?
+            """,
+            (block, chain),
+        ).fetchall()
+    return [
+        hashlib.sha256((call_id_prefix(chain, target, signature, arguments) + str(block)).encode("utf-8")).digest()
+        for target, signature, arguments in identities
+    ]
+
+
+def forget_block(chain: int, block: int, cache_path: Path) -> int:
+    """
+    Delete every result cached at (chain, block), pending or not, and its block hash, eg after a reorg replaced
+    that block. Returns the number of results deleted from callResult.
+    """
+    if is_sharded(cache_path):
+        path = shard_path(cache_path, chain, block)
+        return forget_block(chain, block, path) if os.path.exists(path) else 0
+
+    memory_cache = get_memory_cache()
+    if memory_cache is not None:
+        memory_cache.remove_cache_path(cache_path)  # it is not indexed by block, reorgs are rare enough to start over
+
+    with get_connection(cache_path) as conn:
+        cursor = conn.execute(
+            """
+            DELETE FROM callResult
+            WHERE block = ? AND callKey IN (SELECT callKey FROM callIdentity WHERE chainId = ?)
+            """,
+            (block, chain),
+        )
+        num_deleted = cursor.rowcount
+        conn.execute("DELETE FROM blockHash WHERE chainId = ? AND block = ?", (chain, block))
+        conn.execute("DELETE FROM pendingResult WHERE chainId = ? AND block = ?", (chain, block))
+        conn.commit()
+        return num_deleted
+
+
+def isCached(call: Call, block: int, cache_path: Path) -> bool:
+    """return bool -> we have this"""
+    isCached, _, _ = get_isCached_success_raw_bytes_output_for_a_single_call(call, block, cache_path)
+    return isCached
 
 
 def get_isCached_success_raw_bytes_output_for_a_single_call(
     call: Call, block: int, cache_path: Path
 ) -> tuple[bool, bytes] | None:
     """run one call and return success and block or None if the call is not indexed"""
-
-    call_id = call.to_id(block)
-
-    with sqlite3.connect(cache_path) as conn:
+    if is_sharded(cache_path):
+        path = shard_path(cache_path, call.get_chain_id(), block)
+        if not os.path.exists(path):
+            return (False, None, None)
+        return get_isCached_success_raw_bytes_output_for_a_single_call(call, block, path)
+
+    memory_cache = get_memory_cache()
+    if memory_cache is not None:
+        call_id = call.to_id(block)
+        in_memory = memory_cache.get(cache_path, call_id)
+        if in_memory is not None:
+            success, response, _ = in_memory
+            return (True, success, response)
+
+    with get_connection(cache_path) as conn:
         cursor = conn.cursor()
 
         cursor.execute(
             """
-            SELECT success, response
-            FROM multicallCache
-            WHERE callId = ?
+            SELECT r.success, b.response, b.decoded
+            FROM callIdentity i
+            JOIN callResult r ON r.callKey = i.callKey
+            JOIN responseBlob b ON b.responseKey = r.responseKey
+            WHERE i.callHash = ? AND r.block = ?
             """,
-            (call_id,),
+            (call.to_key(), block),
         )
         result = cursor.fetchone()
         if result is not None:
+            if memory_cache is not None:
+                memory_cache.put(cache_path, call_id, bool(result[0]), result[1], result[2])
             return (True, result[0], result[1])  # we have it, success, response
         else:
             return (False, None, None)  # we have it, success, response
 
 
-@time_function
-def get_data_from_disk(calls: list[Call], blocks: list[int], cache_path: Path) -> tuple[pd.DataFrame, pd.DataFrame]:
+def get_cached_data_in_block_range(call: Call, from_block: int, to_block: int, cache_path: Path) -> pd.DataFrame:
     """
-    Read from disk in chunks to manage memory and performance. Returns found_df and not_found_df.
+    Every cached result of call between from_block and to_block (inclusive), from a single range scan.
+    Returns a df with columns block, success, response ordered by block.
     """
-    multicall = Multicall(calls)
-    # todo, speed up with threading, can be slow at scale
-    empty_df = pd.DataFrame.from_records(flatten([multicall.to_list_of_empty_records(block) for block in blocks]))
-    call_ids = empty_df["callId"].to_list()
-
-    chunk_size = 100_000
-    found_dfs = []
-
-    with sqlite3.connect(cache_path) as conn:
-        for i in range(0, len(call_ids), chunk_size):
-            # Prepare the SQL query with placeholders for current chunk
-            current_ids = call_ids[i : i + chunk_size]
-            placeholders = ",".join("?" for _ in current_ids)
-            query = f"""
-                SELECT * FROM multicallCache
-                WHERE callId IN ({placeholders})
+    if is_sharded(cache_path):
+        shards = existing_shards_in_block_range(cache_path, call.get_chain_id(), from_block, to_block)
+        dfs = [get_cached_data_in_block_range(call, from_block, to_block, path) for path in shards]
+        if len(dfs) == 0:
+            return pd.DataFrame({"block": [], "success": [], "response": []})
+        return pd.concat(dfs, ignore_index=True)
+
+    with get_connection(cache_path) as conn:
+        rows = conn.execute(
             """
-            # Fetch data for the current chunk
-            chunk_df = pd.read_sql_query(query, conn, params=current_ids)
-            chunk_df.columns = COLUMNS
-            found_dfs.append(chunk_df)
-
-    # Concatenate all dataframes from each chunk
-    found_df = pd.concat(found_dfs, ignore_index=True) if found_dfs else pd.DataFrame()
-
-    # Determine which call_ids were not found in the cache
-    call_ids_not_already_found = set(call_ids).difference(found_df["callId"])
-    not_found_df = empty_df[empty_df["callId"].isin(call_ids_not_already_found)]
-
-    return found_df, not_found_df
+            SELECT r.block, r.success, b.response
+            FROM callIdentity i
+            JOIN callResult r ON r.callKey = i.callKey
+            JOIN responseBlob b ON b.responseKey = r.responseKey
+            WHERE i.callHash = ? AND r.block BETWEEN ? AND ?
+            ORDER BY r.block
+            """,
+            (call.to_key(), from_block, to_block),
+        ).fetchall()
 
+    df = pd.DataFrame(rows, columns=["block", "success", "response"])
+    df["success"] = df["success"].astype(bool)
+    return df
 
-# def get_data_from_disk(calls: list[Call], blocks: list[int], cache_path: Path) -> tuple[pd.DataFrame, pd.DataFrame]:
-#     """
-#     Read from disk. Returns found_df and not_found_df
-#     """
-#     multicall = Multicall(calls)
-#     empty_df = pd.DataFrame.from_records(flatten([multicall.to_list_of_empty_records(block) for block in blocks]))
-#     call_ids = empty_df["callId"].to_list()
 
-#     with sqlite3.connect(cache_path) as conn:
-#         query = f"""
-#             SELECT * FROM multicallCache
-#             WHERE callId IN ({','.join('?' * len(call_ids))})
-#         """
-#         found_df = pd.read_sql_query(query, conn, params=call_ids)
-#         found_df.columns = COLUMNS
+def get_cached_blocks(call: Call, from_block: int, to_block: int, cache_path: Path) -> list[int]:
+    """Every block between from_block and to_block (inclusive) that call is cached at, from a single range scan"""
+    if is_sharded(cache_path):
+        shards = existing_shards_in_block_range(cache_path, call.get_chain_id(), from_block, to_block)
+        return [block for path in shards for block in get_cached_blocks(call, from_block, to_block, path)]
 
-#     call_ids_not_already_found = set(empty_df["callId"]).difference(found_df["callId"])
-#     not_found_df = empty_df[empty_df["callId"].isin(call_ids_not_already_found)]
+    with get_connection(cache_path) as conn:
+        rows = conn.execute(
+            """
+            SELECT r.block
+            FROM callIdentity i
+            JOIN callResult r ON r.callKey = i.callKey
+            WHERE i.callHash = ? AND r.block BETWEEN ? AND ?
+            ORDER BY r.block
+            """,
+            (call.to_key(), from_block, to_block),
+        ).fetchall()
+    return [row[0] for row in rows]
 
-#     return found_df, not_found_df
 
-# @timeFunction
-# def get_data_from_disk(calls, blocks, cache_path) -> tuple[pd.DataFrame, pd.DataFrame]:
-#     """
-#     Read from disk. Returns found_df and not_found_df by using a temporary table to handle large numbers of call_ids efficiently.
-#     """
-#     multicall = Multicall(calls)
-#     empty_df = pd.DataFrame.from_records(flatten([multicall.to_list_of_empty_records(block) for block in blocks]))
-#     call_ids = empty_df["callId"].to_list()
+@time_function
+def get_data_from_disk(calls: list[Call], blocks: list[int], cache_path: Path) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Look up every (call, block) pair in the cache. Returns found_df and not_found_df.
 
-#     with sqlite3.connect(str(cache_path)) as conn:
-#         # Create a temporary table to store call_ids
-#         conn.execute("CREATE TEMP TABLE IF NOT EXISTS temp_call_ids (id BLOB)")
-#         # Insert call_ids into the temporary table
-#         conn.executemany("INSERT INTO temp_call_ids (id) VALUES (?)", ((id,) for id in call_ids))
+    Only the call keys and blocks are sent to the db, they are bulk loaded into two temp tables and joined against
+    callResult in a single query. When the blocks are dense each call's block range is read with one range scan,
+    otherwise each (call, block) pair is an index seek. The misses are whatever pairs did not come back.
+    The in memory cache and the bloom filter, when they are enabled, are checked before the db.
+    A sharded cache is read one shard per thread and the results are merged.
 
-#         # Select data joining the temporary table with the main cache table
-#         query = """
-#             SELECT mc.* FROM multicallCache mc
-#             JOIN temp_call_ids tc ON mc.callId = tc.id
-#         """
-#         found_df = pd.read_sql_query(query, conn)
-#         found_df.columns = COLUMNS  # Assuming COLUMNS is defined somewhere globally
+    found_df columns: callIndex, block, success, response, decoded
+    not_found_df columns: callIndex, block
+    callIndex is the position of the call in calls. Both are ordered by block then callIndex.
+    """
+    blocks = list(dict.fromkeys(int(b) for b in blocks))  # drop duplicate blocks, keep the order
+    if is_sharded(cache_path):
+        found_df = _get_found_rows_from_shards(calls, blocks, cache_path)
+    else:
+        found_df = _get_found_rows(calls, blocks, cache_path)
+    return split_found_and_not_found(found_df, len(calls), blocks)
+
+
+def _get_found_rows(calls: list[Call], blocks: list[int], cache_path: Path) -> pd.DataFrame:
+    """Unordered found_df of calls x blocks in a single sqlite file"""
+    memory_cache = get_memory_cache()
+    if memory_cache is not None:
+        found_df = _get_data_from_memory(memory_cache, calls, blocks, cache_path)
+        if found_df is not None:
+            return found_df
+
+    call_indexes_to_query, blocks_to_query = range(len(calls)), blocks
+    bloom_filter = get_bloom_filter(cache_path)
+    if bloom_filter is not None:
+        # skip the db for every call and block that the bloom filter says is definitely not cached
+        call_ids = [call_id for call_ids in call_ids_by_call(calls, blocks) for call_id in call_ids]
+        might_be_cached = bloom_filter.contains_many(call_ids).reshape(len(calls), len(blocks))
+        call_indexes_to_query = np.flatnonzero(might_be_cached.any(axis=1)).tolist()
+        blocks_to_query = [blocks[i] for i in np.flatnonzero(might_be_cached.any(axis=0))]
+
+    if len(call_indexes_to_query) > 0 and len(blocks_to_query) > 0:
+        rows = _select_cached_rows(calls, call_indexes_to_query, blocks_to_query, cache_path)
+    else:
+        rows = []
+
+    if memory_cache is not None:
+        for call_index, block, success, response, decoded in rows:
+            memory_cache.put(cache_path, calls[call_index].to_id(block), bool(success), response, decoded)
+
+    return pd.DataFrame(rows, columns=FOUND_COLUMNS)
+
+
+def _get_found_rows_from_shards(calls: list[Call], blocks: list[int], cache_path: Path) -> pd.DataFrame:
+    """Unordered found_df of calls x blocks, every shard they fall in is read in its own thread"""
+    blocks_per_shard = get_blocks_per_shard(cache_path)
+    call_indexes_by_chain: dict[int, list[int]] = {}
+    for call_index, call in enumerate(calls):
+        call_indexes_by_chain.setdefault(call.get_chain_id(), []).append(call_index)
+    blocks_by_shard_start: dict[int, list[int]] = {}
+    for block in blocks:
+        blocks_by_shard_start.setdefault(shard_start(block, blocks_per_shard), []).append(block)
+
+    lookups = []  # (shard, callIndexes, blocks) for every shard that exists
+    for chain, call_indexes in call_indexes_by_chain.items():
+        for start, shard_blocks in blocks_by_shard_start.items():
+            path = shard_path(cache_path, chain, start)
+            if os.path.exists(path):
+                lookups.append((path, call_indexes, shard_blocks))
+
+    def lookup(path: Path, call_indexes: list[int], shard_blocks: list[int]) -> pd.DataFrame:
+        found_df = _get_found_rows([calls[i] for i in call_indexes], shard_blocks, path)
+        found_df["callIndex"] = np.asarray(call_indexes, dtype=np.int64)[found_df["callIndex"].to_numpy(dtype=np.int64)]
+        return found_df
+
+    found_dfs = map_over_shards(lambda shard: lookup(*shard), lookups)
+    if len(found_dfs) == 0:
+        return pd.DataFrame(columns=FOUND_COLUMNS)
+    return pd.concat(found_dfs, ignore_index=True)
+
+
+def split_found_and_not_found(
+    found_df: pd.DataFrame, num_calls: int, blocks: list[int]
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Sort the cached rows in found_df (callIndex, block, success, response, decoded) by block then callIndex
+    and make not_found_df (callIndex, block) from every pair of range(num_calls) x blocks that is not in it.
+    """
+    found_df["success"] = found_df["success"].astype(bool)
+    found_call_indexes = found_df["callIndex"].to_numpy(dtype=np.int64)
+    found_block_indexes = pd.Index(blocks).get_indexer(found_df["block"])
+    found_df = found_df.iloc[np.lexsort((found_call_indexes, found_block_indexes))].reset_index(drop=True)
+
+    is_cached = np.zeros((len(blocks), num_calls), dtype=bool)
+    is_cached[found_block_indexes, found_call_indexes] = True
+    missing_block_indexes, missing_call_indexes = np.nonzero(~is_cached)
+    not_found_df = pd.DataFrame(
+        {"callIndex": missing_call_indexes, "block": np.asarray(blocks, dtype=np.int64)[missing_block_indexes]}
+    )
+    return found_df, not_found_df
 
-#         # Cleanup the temporary table
-#         conn.execute("DROP TABLE temp_call_ids")
 
-#     # Determine which call_ids were not found in the cache
-#     call_ids_not_already_found = set(call_ids).difference(found_df["callId"])
-#     not_found_df = empty_df[empty_df["callId"].isin(call_ids_not_already_found)]
+def _select_cached_rows(
+    calls: list[Call], call_indexes: list[int], blocks: list[int], cache_path: Path
+) -> list[tuple[int, int, bool, bytes]]:
+    """(callIndex, block, success, response, decoded) of every cached pair of calls[call_indexes] x blocks"""
+    from_block, to_block = min(blocks), max(blocks)
+    is_dense = len(blocks) / (to_block - from_block + 1) >= RANGE_SCAN_MIN_BLOCK_DENSITY
 
-#     return found_df, not_found_df
+    with get_connection(cache_path) as conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS requestedCalls (callIndex INTEGER PRIMARY KEY, callKey INTEGER)")
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS requestedBlocks (block INTEGER PRIMARY KEY)")
+        conn.execute("DELETE FROM temp.requestedCalls")
+        conn.execute("DELETE FROM temp.requestedBlocks")
+        conn.executemany(
+            """
+            INSERT INTO temp.requestedCalls (callIndex, callKey)
+            VALUES (?, (SELECT callKey FROM callIdentity WHERE callHash = ?))
+            """,
+            [(call_index, calls[call_index].to_key()) for call_index in call_indexes],
+        )
+        conn.executemany("INSERT INTO temp.requestedBlocks (block) VALUES (?)", [(b,) for b in blocks])
+
+        if is_dense:
+            query = """
+            SELECT c.callIndex, r.block, r.success, b.response, b.decoded
+            FROM temp.requestedCalls c
+            JOIN callResult r ON r.callKey = c.callKey AND r.block BETWEEN ? AND ?
+            JOIN responseBlob b ON b.responseKey = r.responseKey
+            WHERE r.block IN temp.requestedBlocks
+            """
+            rows = conn.execute(query, (from_block, to_block)).fetchall()
+        else:
+            query = """
+            SELECT c.callIndex, q.block, r.success, b.response, b.decoded
+            FROM temp.requestedBlocks q
+            CROSS JOIN temp.requestedCalls c
+            JOIN callResult r ON r.callKey = c.callKey AND r.block = q.block
+            JOIN responseBlob b ON b.responseKey = r.responseKey
+            """
+            rows = conn.execute(query).fetchall()
 
+        conn.execute("DELETE FROM temp.requestedCalls")
+        conn.execute("DELETE FROM temp.requestedBlocks")
 
-def df_to_CallRawData(df: pd.DataFrame, calls: list[Call], blocks: list[int]) -> list[CallRawData]:
+    return rows
 
-    callIds_to_call_and_block = dict()  # callId -> tuple(call, block)
 
-    for call in calls:
-        for block in blocks:
-            call_id = call.to_id(block)
-            callIds_to_call_and_block[call_id] = (call, block)
+def _get_data_from_memory(
+    memory_cache: LRUCache, calls: list[Call], blocks: list[int], cache_path: Path
+) -> pd.DataFrame | None:
+    """found_df built from the in memory cache if it has every (call, block) pair, otherwise None"""
+    rows = []
+    call_ids = call_ids_by_call(calls, blocks)
+    for block_index, block in enumerate(blocks):
+        for call_index, ids_of_call in enumerate(call_ids):
+            in_memory = memory_cache.get(cache_path, ids_of_call[block_index])
+            if in_memory is None:
+                return None
+            rows.append((call_index, block, *in_memory))
+    return pd.DataFrame(rows, columns=FOUND_COLUMNS)
 
-    call_id_to_success_and_response = df.set_index("callId")[["success", "response"]].apply(tuple, axis=1).to_dict()
 
+def df_to_CallRawData(df: pd.DataFrame, calls: list[Call]) -> list[CallRawData]:
+    """Convert found_df from get_data_from_disk back into CallRawData"""
+    responses = df["response"].tolist()
+    all_decoded = load_all_decoded([calls[i].signature for i in df["callIndex"]], responses, df["decoded"])
     all_raw_call_data = []
-    for call_id in df["callId"]:
-        call, block = callIds_to_call_and_block[call_id]
-        success, response = call_id_to_success_and_response[call_id]
-        a_call_raw_data = CallRawData(call=call, block=block, success=success, response=response)
+    for call_index, block, success, response, decoded in zip(
+        df["callIndex"], df["block"], df["success"], responses, all_decoded
+    ):
+        a_call_raw_data = CallRawData(
+            call=calls[call_index],
+            block=int(block),
+            success=bool(success),
+            response=response,
+            decoded=decoded,
+        )
         all_raw_call_data.append(a_call_raw_data)
 
     return all_raw_call_data
@@ -258,48 +836,202 @@ def df_to_CallRawData(df: pd.DataFrame, calls: list[Call], blocks: list[int]) ->
 
 def fetch_all_data(cache: Path = "default") -> pd.DataFrame:
     cache_path = CACHE_PATH if cache == "default" else cache
-    with sqlite3.connect(cache_path) as conn:
-        df = pd.read_sql_query("SELECT * FROM multicallCache LIMIT 1", conn)
+    if is_sharded(cache_path):
+        dfs = [fetch_all_data(path) for path in existing_shard_paths(cache_path)]
+        return pd.concat(dfs, ignore_index=True).head(1) if len(dfs) > 0 else pd.DataFrame()
+    with get_connection(cache_path) as conn:
+        df = pd.read_sql_query(
+            """
+            SELECT i.chainId, i.target, i.signature, i.argumentsAsStr, i.argumentsAsPickle, r.block, r.success, b.response
+            FROM callResult r
+            JOIN callIdentity i ON i.callKey = r.callKey
+            JOIN responseBlob b ON b.responseKey = r.responseKey
+            LIMIT 1
+            """,
+            conn,
+        )
     return df
 
 
 def get_db_size(cache_path: Path) -> int:
-    with sqlite3.connect(cache_path) as conn:
-        # TODO not efficient
-        df = pd.read_sql_query("SELECT * FROM multicallCache", conn)
-        return len(df)
+    if is_sharded(cache_path):
+        return sum(map_over_shards(get_db_size, existing_shard_paths(cache_path)))
+    with get_connection(cache_path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM callResult").fetchone()[0]
 
 
 def create_db(db_path: Path):
     if os.path.exists(db_path):
         raise ValueError(f"cannot create a db at {db_path=} because it already exists")
     else:
+        close_connections(db_path)  # any pooled connection to this path points at a deleted file
         with open(db_path, "w") as fp:
             del fp
             pass
 
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-    CREATE TABLE IF NOT EXISTS multicallCache (
-        callId BLOB PRIMARY KEY,
-        target TEXT,
-        signature TEXT,
-        argumentsAsStr TEXT,
-        argumentsAsPickle bytes,
-        block INTEGER,
-        chainId INTEGER,
-        success BOOLEAN,
-        response BLOB
-    )
+    _create_schema(db_path)
+
+
+def _create_schema(db_path: Path) -> None:
+    with get_connection(db_path) as conn:
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+
+
+def create_sharded_db(db_dir: Path, blocks_per_shard: int = DEFAULT_BLOCKS_PER_SHARD) -> None:
+    """
+    Make db_dir a sharded cache. Pass db_dir anywhere a cache path is expected and the results are routed
+    to one sqlite file per chain and per blocks_per_shard blocks, eg db_dir/chain_1/blocks_18000000_18999999.sqlite.
+    The shards are created as they are first written to.
     """
+    if os.path.exists(db_dir):
+        raise ValueError(f"cannot create a sharded db at {db_dir=} because it already exists")
+    os.makedirs(db_dir)
+    write_shards_config(db_dir, blocks_per_shard)
+
+
+def create_bloom_filter(
+    cache_path: Path, capacity: int = DEFAULT_CAPACITY, false_positive_rate: float = DEFAULT_FALSE_POSITIVE_RATE
+) -> BloomFilter | list[BloomFilter]:
+    """
+    Build a bloom filter of every call id in cache_path and store it next to it as `cache_path`.bloom.
+    From then on save_data keeps it up to date and get_data_from_disk skips the db for the definite misses.
+
+    capacity is how many cached results it is sized for, past that the false positive rate climbs.
+    The filter takes about -capacity * ln(false_positive_rate) / ln(2)^2 bits of memory and disk,
+    1.2MB per million results at the default 1%.
+
+    A sharded cache gets one filter per shard, each sized for capacity, and returns them in the order of
+    existing_shard_paths(). Shards created afterwards start with an empty filter of the same size.
+
+    The filter is only used once it is built, results saved by other threads while it is built can be missing
+    from it and are then fetched once more.
+    """
+    if is_sharded(cache_path):
+        bloom_filter_config = {"capacity": capacity, "false_positive_rate": false_positive_rate}
+        write_shards_config(cache_path, get_blocks_per_shard(cache_path), bloom_filter_config)
+        return map_over_shards(
+            lambda path: create_bloom_filter(path, capacity, false_positive_rate), existing_shard_paths(cache_path)
         )
-        conn.commit()
+
+    # only registered once it is built and saved, until then saves and lookups go to the db alone
+    bloom_filter = BloomFilter.for_capacity(bloom_filter_path(cache_path), capacity, false_positive_rate)
+    with get_connection(cache_path) as conn:
+        identities = conn.execute(
+            "SELECT callKey, chainId, target, signature, argumentsAsStr FROM callIdentity"
+        ).fetchall()
+        for call_key, chain, target, signature, arguments_as_str in identities:
+            prefix = call_id_prefix(chain, target, signature, arguments_as_str)
+            blocks = conn.execute("SELECT block FROM callResult WHERE callKey = ?", (call_key,)).fetchall()
+            bloom_filter.add_many(
+                [hashlib.sha256((prefix + str(block)).encode("utf-8")).digest() for (block,) in blocks]
+            )
+    return register_bloom_filter(cache_path, bloom_filter)
+
+
+def _call_hash_from_identity(chain: int, target: str, signature: str, arguments_as_str: str) -> bytes:
+    """Call.to_key() rebuilt from the stored identity columns"""
+    return hashlib.sha256(call_id_prefix(chain, target, signature, arguments_as_str).encode("utf-8")).digest()
+
+
+def _response_hash_from_signature(signature: str, response: bytes) -> bytes:
+    return _response_hash(parse_signature(signature)[2], response)
+
+
+def _migrate_from_flat_multicall_cache(conn: sqlite3.Connection) -> None:
+    """
+    version 0 -> 1, split the flat multicallCache table into callIdentity, responseBlob and callResult.
+    The flat table has no decoded outputs nor block hashes, its responses are decoded again when they are read.
+    """
+    conn.create_function("call_hash", 4, _call_hash_from_identity, deterministic=True)
+    conn.create_function("response_hash", 2, _response_hash_from_signature, deterministic=True)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO callIdentity (callHash, chainId, target, signature, argumentsAsStr, argumentsAsPickle)
+        SELECT call_hash(chainId, target, signature, argumentsAsStr), chainId, target, signature, argumentsAsStr,
+            argumentsAsPickle
+        FROM multicallCache
+        GROUP BY chainId, target, signature, argumentsAsStr
+        """
+    )
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO responseBlob (responseHash, response)
+        SELECT response_hash(signature, response), response
+        FROM multicallCache
+        """
+    )
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO callResult (callKey, block, success, responseKey)
+        SELECT i.callKey, m.block, m.success, b.responseKey
+        FROM multicallCache m
+        JOIN callIdentity i ON i.callHash = call_hash(m.chainId, m.target, m.signature, m.argumentsAsStr)
+        JOIN responseBlob b ON b.responseHash = response_hash(m.signature, m.response)
+        """
+    )
+    conn.execute("DROP TABLE multicallCache")
+
+
+MIGRATIONS = {
+    0: _migrate_from_flat_multicall_cache,
+}
+
+
+def migrate_db(db_path: Path) -> None:
+    """
+    Upgrade a cache made by an older version of create_db() to the current schema, in place.
+    Does nothing if it is already up to date. The file is vacuumed afterwards to give the freed pages back to the OS.
+    """
+    if is_sharded(db_path):
+        map_over_shards(migrate_db, existing_shard_paths(db_path))
+        return
+
+    # not pooled, get_connection() refuses a cache that still has to be migrated
+    conn = sqlite3.connect(db_path)
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+
+        while version < SCHEMA_VERSION:
+            # sqlite3 only opens a transaction before INSERT, UPDATE and DELETE. BEGIN also holds the CREATE and
+            # DROP TABLE statements of the step, so it and its version bump are committed or rolled back together
+            conn.execute("BEGIN")
+            try:
+                MIGRATIONS[version](conn)
+                conn.execute(f"PRAGMA user_version = {version + 1}")
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+            version += 1
+
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
 
 
 def delete_db(db_path: Path):
-    if os.path.exists(db_path):
+    if is_sharded(db_path):
+        for path in existing_shard_paths(db_path):
+            delete_db(path)
+        forget_shards_config(db_path)
+        shutil.rmtree(db_path)
+    elif os.path.exists(db_path):
+        close_connections(db_path)
+        if get_memory_cache() is not None:
+            get_memory_cache().remove_cache_path(db_path)
+        forget_bloom_filter(db_path)
+        if os.path.exists(bloom_filter_path(db_path)):
+            os.remove(bloom_filter_path(db_path))
         os.remove(db_path)
+        for wal_file in (f"{db_path}-wal", f"{db_path}-shm"):
+            if os.path.exists(wal_file):
+                os.remove(wal_file)
     else:
         raise ValueError(f"Cannot remove a db at {db_path=} because it does not exist")
@@ -1,5 +1,7 @@
-from typing import Any, Callable, Tuple
+from typing import Any, Callable, Iterable, Tuple
+import functools
 import hashlib
+import operator
 from pathlib import Path
 
 import inspect
@@ -9,9 +11,10 @@ from web3 import Web3, exceptions
 
 
 # from multicall.cache import get_one_value # circular import issues
-from multicallcache.signature import Signature
+from multicallcache.signature import Signature, get_signature
 from multicallcache.constants import CACHE_PATH
 from multicallcache.utils import chain_id
+from multicallcache.finalized import get_finalized_block_tracker
 
 
 # single tx gas limit. Using Alchemy's max value, not relevent for view only calls where gas is free.
@@ -48,6 +51,57 @@ class FailedToBuildCalldata(Exception):
         super().__init__(self.message)
 
 
+def call_id_prefix(chain: int, target: str, signature: str, arguments_as_str: str) -> str:
+    """
+    The block independent part of a call id. Call.to_key() is the sha256 of this and Call.to_id(block) is the sha256
+    of this + str(block). Shared with the cache so it can rebuild keys from the stored columns.
+    """
+    return str(chain) + " " + target + " " + signature + " " + arguments_as_str + " "
+
+
+def decode_output(
+    signature: Signature,
+    data_labels: tuple[str],
+    handling_functions: tuple[Callable],
+    raw_bytes_output: bytes,
+    decoded_output: tuple = None,
+) -> dict[str, Any]:
+    """Call.decode_output() without the Call, so it can run where the Call's Web3 instance can't be sent"""
+    if len(raw_bytes_output) == 0:
+        label_to_output = {}
+        # calls to addresses that don't have any code at that block return HexBytes('0x')
+        for label in data_labels:
+            label_to_output[label] = NOT_A_CONTRACT_REVERT_MESSAGE
+        return label_to_output
+
+    if decoded_output is None:
+        decoded_output = signature.decode_data(raw_bytes_output)
+
+    if len(data_labels) != len(decoded_output):
+        raise ReturnDataAndHandlingFunctionLengthMismatch(f"{len(data_labels)=} != {len(decoded_output)=}=")
+
+    label_to_output = {}
+
+    for label, handling_function, decoded_value in zip(data_labels, handling_functions, decoded_output):
+        label_to_output[label] = handling_function(decoded_value)
+    return label_to_output
+
+
+# many calls share a target, and checksumming it hashes the address with keccak
+_to_checksum_address = functools.lru_cache(maxsize=100_000)(to_checksum_address)
+
+
+def _encode_blocks(blocks: Iterable[int]) -> list[bytes]:
+    """The block part of the string hashed into call ids, str(block).encode("utf-8")"""
+    return [b"%d" % operator.index(block) for block in blocks]
+
+
+def call_ids_by_call(calls: list["Call"], blocks: Iterable[int]) -> list[list[bytes]]:
+    """[call.to_ids(blocks) for call in calls], with blocks encoded once for all the calls"""
+    encoded_blocks = _encode_blocks(blocks)
+    return [call._to_ids_of_encoded_blocks(encoded_blocks) for call in calls]
+
+
 class Call:
     # todo, if handling functions is empty, default to the identity function
     def __init__(
@@ -58,6 +112,7 @@ class Call:
         data_labels: tuple[str] | str,
         handling_functions: Tuple[Callable] | Callable,
         w3: Web3,
+        allow_failure: bool = True,
     ) -> None:
         """
         target: the address that you want to make a function call on.
@@ -65,6 +120,7 @@ class Call:
         arguments: the tuple of arguments to pass to the function
         return_data_labels: what to label the returning data as
         handling_functions: what function to pass in the pythonic output of return_data_label into
+        allow_failure: False makes a Multicall with the aggregate3 engine revert as a whole when this call reverts
         """
         arguments = arguments if isinstance(arguments, tuple) else (arguments,)
         data_labels = data_labels if isinstance(data_labels, tuple) else (data_labels,)
@@ -74,11 +130,14 @@ class Call:
 
         self.data_labels = data_labels
         self.handling_functions = handling_functions
-        self.target = to_checksum_address(target)
-        self.signature = Signature(signature)
+        self.target = _to_checksum_address(target)
+        self.signature = get_signature(signature)
         self.arguments = arguments
         self.calldata = self.signature.encode_data(self.arguments)
         self.w3 = w3
+        self.allow_failure = allow_failure
+        self._chain_id: int | None = None
+        self._prefix_hash = None  # sha256 state after hashing _id_prefix(), copied to hash each block
 
     def to_rpc_call_args(self, block_id: int | str):
         """Convert this call into the format to send to a rpc node api request"""
@@ -93,48 +152,56 @@ class Call:
         ]
         return args
 
-    def decode_output(self, raw_bytes_output: bytes) -> dict[str, Any]:
-        """applies the handling function and converts raw_bytes_output to a dict of pythonic objects"""
+    def decode_output(self, raw_bytes_output: bytes, decoded_output: tuple = None) -> dict[str, Any]:
+        """
+        applies the handling function and converts raw_bytes_output to a dict of pythonic objects
+        decoded_output is raw_bytes_output already abi decoded, eg by the cache, it skips decoding again
+        """
+        return decode_output(
+            self.signature, self.data_labels, self.handling_functions, raw_bytes_output, decoded_output
+        )
 
-        if len(raw_bytes_output) == 0:
-            label_to_output = {}
-            # calls to addresses that don't have any code at that block return HexBytes('0x')
-            for label in self.data_labels:
-                label_to_output[label] = NOT_A_CONTRACT_REVERT_MESSAGE
-            return label_to_output
+    def get_chain_id(self) -> int:
+        """chain_id(self.w3), looked up once per Call"""
+        if self._chain_id is None:
+            self._chain_id = chain_id(self.w3)
+        return self._chain_id
 
-        decoded_output = self.signature.decode_data(raw_bytes_output)
+    def _id_prefix(self) -> str:
+        """The block independent part of the string hashed into the call id"""
+        return call_id_prefix(self.get_chain_id(), self.target, self.signature.signature, str(self.arguments))
 
-        if len(self.data_labels) != len(decoded_output):
-            raise ReturnDataAndHandlingFunctionLengthMismatch(f"{len(self.data_labels)=} != {len(decoded_output)=}=")
+    def _get_prefix_hash(self):
+        if self._prefix_hash is None:
+            self._prefix_hash = hashlib.sha256(self._id_prefix().encode("utf-8"))
+        return self._prefix_hash
 
-        label_to_output = {}
-
-        for label, handling_function, decoded_value in zip(self.data_labels, self.handling_functions, decoded_output):
-            label_to_output[label] = handling_function(decoded_value)
-        return label_to_output
+    def to_key(self) -> bytes:
+        """A unique identifer of this call across every block, sha256(chainId, target, signature, arguments)"""
+        return self._get_prefix_hash().digest()
 
     def to_id(self, block: int) -> bytes:
         """A unique identifer of the immutable charactaristics of this call"""
         if not isinstance(block, int):
             raise ValueError("Must define a block to make a call ID")
 
-        call_id = (
-            str(chain_id(self.w3))
-            + " "
-            + self.target
-            + " "
-            + self.signature.signature
-            + " "
-            + str(self.arguments)
-            + " "
-            + str(block)
-        )
-
-        hash_object = hashlib.sha256()
-        hash_object.update(call_id.encode("utf-8"))
+        hash_object = self._get_prefix_hash().copy()
+        hash_object.update(str(block).encode("utf-8"))
         return hash_object.digest()
 
+    def to_ids(self, blocks: Iterable[int]) -> list[bytes]:
+        """[self.to_id(block) for block in blocks], also for numpy ints, the block independent prefix is hashed once"""
+        return self._to_ids_of_encoded_blocks(_encode_blocks(blocks))
+
+    def _to_ids_of_encoded_blocks(self, encoded_blocks: list[bytes]) -> list[bytes]:
+        copy_prefix_hash = self._get_prefix_hash().copy
+        call_ids = []
+        for encoded_block in encoded_blocks:
+            hash_object = copy_prefix_hash()
+            hash_object.update(encoded_block)
+            call_ids.append(hash_object.digest())
+        return call_ids
+
     def __call__(self, block_id: int | str = "latest", cache="default") -> dict[str, Any]:
         """Primary entry point, for fast naive use"""
         # happy path
@@ -155,7 +222,7 @@ class Call:
                 else:
                     raise exceptions.ContractLogicError()
 
-            if block_id < self.w3.eth.get_block("finalized").number:
+            if get_finalized_block_tracker(self.w3).is_finalized(block_id):
                 _save_data(self.w3, self, block_id, cache_path)
                 # TODO gets external data, saves it, then reads it from disk
                 # one read is redundent, can remove
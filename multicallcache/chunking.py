@@ -0,0 +1,254 @@
+import threading
+from typing import Awaitable, Callable, Iterator
+
+from eth_abi.exceptions import ParseError
+from eth_abi.grammar import ABIType, TupleType, parse
+from web3 import Web3
+
+from multicallcache.call import Call
+from multicallcache.multicall import CallRawData, Multicall
+from multicallcache.rpc_call import SPLITTABLE_ERRORS
+from multicallcache.signature import Signature
+from multicallcache.utils import provider_key
+
+DEFAULT_CALLS_PER_RPC_CALL = 300  # where a ChunkSizer starts
+MAX_CALLS_PER_RPC_CALL = 10_000  # the most a ChunkSizer grows to
+GROWTH_DIVISOR = 16  # once a multicall has failed, grow by 1/16th of the size per success at the size
+
+TARGET_RESPONSE_BYTES = 1_000_000  # return data a CostModel packs into one multicall
+TARGET_RPC_SECONDS = 2.0  # node time a CostModel packs into one multicall, well under the rpc timeouts
+RESULT_OVERHEAD_BYTES = 96  # tryAggregate returns each result as (bool, bytes): an offset, the bool and a length
+DYNAMIC_VALUE_BYTES = 32 * 32  # guessed size of a string, bytes or array output until responses are seen
+SMOOTHING = 0.2  # weight of the latest multicall in the moving averages of a CostModel
+
+
+class ChunkSizer:
+    """
+    Learns how many calls fit in one multicall for a provider and signature mix.
+
+    Doubles the size after each success at the current size until a multicall fails, then shrinks
+    to 3/4 of the calls that failed and only grows by size // GROWTH_DIVISOR from there, so the size settles
+    just under the provider's limit on payload, gas and time and keeps probing it in case it moves.
+    Results of multicalls smaller than the current size, eg sent before it changed, do not grow it.
+    """
+
+    def __init__(self, initial: int = DEFAULT_CALLS_PER_RPC_CALL, max_size: int = MAX_CALLS_PER_RPC_CALL) -> None:
+        self.max_size = max_size
+        self.size = max(1, min(initial, max_size))
+        self.num_failures = 0
+        self._lock = threading.Lock()
+
+    def record_success(self, num_calls: int) -> None:
+        with self._lock:
+            if num_calls < self.size:
+                return
+            growth = self.size if self.num_failures == 0 else max(1, self.size // GROWTH_DIVISOR)
+            self.size = min(self.max_size, self.size + growth)
+
+    def record_failure(self, num_calls: int) -> None:
+        with self._lock:
+            self.num_failures += 1
+            self.size = max(1, min(self.size, num_calls * 3 // 4))
+
+    def chunk_size(self, max_calls_per_rpc_call: int | None = None) -> int:
+        """The size to plan the next multicalls with, never more than max_calls_per_rpc_call"""
+        return self.size if max_calls_per_rpc_call is None else max(1, min(self.size, max_calls_per_rpc_call))
+
+
+_chunk_sizers: dict[tuple[str, tuple[str]], ChunkSizer] = {}  # (provider, signatures) -> its sizer
+_chunk_sizers_lock = threading.Lock()
+
+
+def get_chunk_sizer(w3: Web3, calls: list[Call]) -> ChunkSizer:
+    """
+    The ChunkSizer shared by every fetch of calls with the same signatures from the same provider as w3.
+    The signatures decide how much gas and how many bytes a call takes, not the targets or arguments.
+    """
+    key = (provider_key(w3), tuple(sorted({call.signature.signature for call in calls})))
+    with _chunk_sizers_lock:
+        if key not in _chunk_sizers:
+            _chunk_sizers[key] = ChunkSizer()
+        return _chunk_sizers[key]
+
+
+def _halves(multicall: Multicall) -> tuple[Multicall, Multicall]:
+    middle = len(multicall.calls) // 2
+    return Multicall(multicall.calls[:middle], multicall.engine), Multicall(multicall.calls[middle:], multicall.engine)
+
+
+async def async_fetch_splitting_on_failure(
+    fetch: Callable[[Multicall, int], Awaitable[list[CallRawData]]],
+    multicall: Multicall,
+    block: int,
+    chunk_sizer: ChunkSizer | None = None,
+) -> list[CallRawData]:
+    """
+    await fetch(multicall, block). When the node refuses the multicall as too large, out of gas or too slow
+    it is split in half and the halves are fetched one after the other, splitting again as needed down to
+    single calls. A single call that still fails raises. Every outcome is reported to chunk_sizer.
+    """
+    try:
+        call_raw_data = await fetch(multicall, block)
+    except SPLITTABLE_ERRORS:
+        if len(multicall.calls) == 1:
+            raise
+        if chunk_sizer is not None:
+            chunk_sizer.record_failure(len(multicall.calls))
+        call_raw_data = []
+        for half in _halves(multicall):
+            call_raw_data.extend(await async_fetch_splitting_on_failure(fetch, half, block, chunk_sizer))
+        return call_raw_data
+
+    if chunk_sizer is not None:
+        chunk_sizer.record_success(len(multicall.calls))
+    return call_raw_data
+
+
+def fetch_splitting_on_failure(
+    fetch: Callable[[Multicall, int], list[CallRawData]],
+    multicall: Multicall,
+    block: int,
+    chunk_sizer: ChunkSizer | None = None,
+) -> list[CallRawData]:
+    """Synchronous version of async_fetch_splitting_on_failure()"""
+    try:
+        call_raw_data = fetch(multicall, block)
+    except SPLITTABLE_ERRORS:
+        if len(multicall.calls) == 1:
+            raise
+        if chunk_sizer is not None:
+            chunk_sizer.record_failure(len(multicall.calls))
+        call_raw_data = []
+        for half in _halves(multicall):
+            call_raw_data.extend(fetch_splitting_on_failure(fetch, half, block, chunk_sizer))
+        return call_raw_data
+
+    if chunk_sizer is not None:
+        chunk_sizer.record_success(len(multicall.calls))
+    return call_raw_data
+
+
+def _abi_type_bytes(abi_type: ABIType) -> int:
+    """Bytes abi_type takes in return data, a guess for dynamic types"""
+    if isinstance(abi_type, TupleType) and not abi_type.arrlist:
+        return sum(_abi_type_bytes(component) for component in abi_type.components)
+    if abi_type.is_dynamic:
+        return 32 + DYNAMIC_VALUE_BYTES  # the offset in the head and the value
+    if abi_type.arrlist:
+        return abi_type.arrlist[-1][0] * _abi_type_bytes(abi_type.item_type)
+    return 32
+
+
+def estimate_response_bytes(output_types: str) -> int:
+    """Bytes of return data one call with output_types adds to a tryAggregate response, from the types alone"""
+    try:
+        return _abi_type_bytes(parse(output_types)) + RESULT_OVERHEAD_BYTES
+    except ParseError:
+        return 32 + DYNAMIC_VALUE_BYTES + RESULT_OVERHEAD_BYTES
+
+
+class CostModel:
+    """
+    What one call of each signature costs a multicall on a provider, in response bytes and node seconds.
+
+    The bytes start from the width of Signature.output_types and the seconds are unknown. Both then follow
+    moving averages of what the fetched multicalls returned and how long the node took to answer them.
+    The seconds of a multicall are what it took over the quickest one seen, the cost of the request itself,
+    spread over its calls by their response bytes.
+
+    cost() is the fraction of a multicall one call takes, so chunk_lengths() can pack calls until the
+    response is near target_bytes and the node time near target_seconds, whichever comes first.
+    """
+
+    def __init__(self, target_bytes: int = TARGET_RESPONSE_BYTES, target_seconds: float = TARGET_RPC_SECONDS) -> None:
+        self.target_bytes = target_bytes
+        self.target_seconds = target_seconds
+        self._response_bytes: dict[str, float] = {}  # signature -> bytes per call
+        self._seconds: dict[str, float] = {}  # signature -> node seconds per call
+        self._quickest_rpc_seconds: float | None = None
+        self._lock = threading.Lock()
+
+    def response_bytes(self, signature: Signature) -> float:
+        response_bytes = self._response_bytes.get(signature.signature)
+        return estimate_response_bytes(signature.output_types) if response_bytes is None else response_bytes
+
+    def seconds(self, signature: Signature) -> float | None:
+        return self._seconds.get(signature.signature)
+
+    def cost(self, signature: Signature) -> float:
+        """The fraction of a multicall's budget one call of signature takes"""
+        cost = self.response_bytes(signature) / self.target_bytes
+        seconds = self.seconds(signature)
+        return cost if seconds is None else max(cost, seconds / self.target_seconds)
+
+    def record(self, call_raw_data: list[CallRawData], seconds: float | None = None) -> None:
+        """Learn from the results of one multicall, fetched in seconds"""
+        if len(call_raw_data) == 0:
+            return
+        observed_bytes: dict[str, list[int]] = {}
+        for data in call_raw_data:
+            response_bytes = RESULT_OVERHEAD_BYTES + (0 if data.response is None else len(data.response))
+            observed_bytes.setdefault(data.call.signature.signature, []).append(response_bytes)
+        total_bytes = sum(sum(sizes) for sizes in observed_bytes.values())
+
+        with self._lock:
+            for signature, sizes in observed_bytes.items():
+                self._response_bytes[signature] = _moving_average(
+                    self._response_bytes.get(signature), sum(sizes) / len(sizes)
+                )
+            if seconds is None:
+                return
+            if self._quickest_rpc_seconds is None or seconds < self._quickest_rpc_seconds:
+                self._quickest_rpc_seconds = seconds
+            node_seconds = seconds - self._quickest_rpc_seconds
+            for signature, sizes in observed_bytes.items():
+                seconds_per_call = node_seconds * (sum(sizes) / total_bytes) / len(sizes)
+                self._seconds[signature] = _moving_average(self._seconds.get(signature), seconds_per_call)
+
+
+def _moving_average(average: float | None, value: float) -> float:
+    return value if average is None else (1 - SMOOTHING) * average + SMOOTHING * value
+
+
+_cost_models: dict[str, CostModel] = {}  # provider -> its cost model
+_cost_models_lock = threading.Lock()
+
+
+def get_cost_model(w3: Web3) -> CostModel:
+    """The CostModel shared by every fetch from the same provider as w3"""
+    key = provider_key(w3)
+    with _cost_models_lock:
+        if key not in _cost_models:
+            _cost_models[key] = CostModel()
+        return _cost_models[key]
+
+
+def chunk_lengths(calls: list[Call], max_calls: int, cost_model: CostModel | None = None) -> tuple[int]:
+    """
+    The lengths of consecutive chunks of calls to send as one multicall each. Every chunk has at most
+    max_calls calls and, with a cost_model, ends before its calls cost more than one multicall's budget.
+    """
+    if cost_model is None:
+        return tuple(min(max_calls, len(calls) - start) for start in range(0, len(calls), max_calls))
+    costs: dict[Signature, float] = {}
+    lengths = []
+    length, budget_used = 0, 0.0
+    for call in calls:
+        if call.signature not in costs:
+            costs[call.signature] = cost_model.cost(call.signature)
+        cost = costs[call.signature]
+        if length > 0 and (length == max_calls or budget_used + cost > 1.0):
+            lengths.append(length)
+            length, budget_used = 0, 0.0
+        length += 1
+        budget_used += cost
+    if length > 0:
+        lengths.append(length)
+    return tuple(lengths)
+
+
+def split_by_lengths(calls: list[Call], lengths: tuple[int]) -> Iterator[list[Call]]:
+    start = 0
+    for length in lengths:
+        yield calls[start : start + length]
+        start += length
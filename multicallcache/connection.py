@@ -0,0 +1,92 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+# applied to every new connection, see https://www.sqlite.org/pragma.html
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # readers don't block the writer and the writer doesn't block readers
+    "synchronous": "NORMAL",  # safe with WAL, only fsyncs at checkpoints
+    "cache_size": -64_000,  # negative values are in KiB, ~64MB page cache per connection
+    "mmap_size": 268_435_456,  # 256MB of the db file memory mapped
+    "busy_timeout": 5_000,  # ms to wait on a locked db before raising
+    "temp_store": "MEMORY",
+}
+
+_thread_local = threading.local()
+_lock = threading.Lock()
+# cache_path -> bumped each time its connections are closed. A connection belongs to the thread that opened it,
+# the other threads close theirs when they next ask for it and see it is of an older generation.
+_generations: dict[str, int] = {}
+
+
+def _to_key(cache_path: Path) -> str:
+    return os.path.abspath(str(cache_path))
+
+
+def _open_connection(cache_path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(cache_path)
+    for pragma, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return conn
+
+
+def _raise_if_flat_cache(conn: sqlite3.Connection, cache_path: Path) -> None:
+    """A cache made before the normalized schema only has the flat multicallCache table and user_version 0"""
+    if (
+        conn.execute("PRAGMA user_version").fetchone()[0] == 0
+        and conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'multicallCache'").fetchone()
+    ):
+        raise ValueError(
+            f"{cache_path=} was made by an older version of multicallcache, "
+            "upgrade it with multicallcache.cache.migrate_db(cache_path) before using it"
+        )
+
+
+def get_connection(cache_path: Path) -> sqlite3.Connection:
+    """
+    Return a long lived connection to cache_path for the current thread, opening one the first time.
+
+    Connections are reused across calls so repeated lookups skip the connection setup and keep a warm page cache.
+    Use as `with get_connection(cache_path) as conn:`, this commits or rolls back but does not close the connection.
+    Raises a ValueError if cache_path is a cache of the old flat schema that migrate_db() has not upgraded yet.
+    """
+    key = _to_key(cache_path)
+
+    if getattr(_thread_local, "pid", None) != os.getpid():
+        # connections can't be shared across a fork
+        _thread_local.pid = os.getpid()
+        _thread_local.connections = {}
+
+    generation, conn = _thread_local.connections.get(key, (None, None))
+    if conn is None or generation != _generations.get(key, 0):
+        if conn is not None:  # close_connections() was called from another thread since it was opened
+            del _thread_local.connections[key]
+            conn.close()
+        with _lock:
+            generation = _generations.setdefault(key, 0)
+        conn = _open_connection(cache_path)
+        try:
+            _raise_if_flat_cache(conn, cache_path)
+        except ValueError:
+            conn.close()
+            raise
+        _thread_local.connections[key] = (generation, conn)
+    return conn
+
+
+def close_connections(cache_path: Path | None = None) -> None:
+    """
+    Close the pooled connections to cache_path, or to every path if cache_path is None.
+    The calling thread's connection is closed now. Another thread may be in the middle of a query on its own,
+    so it is only marked stale and that thread closes it and opens a new one the next time it calls get_connection().
+    """
+    with _lock:
+        keys = list(_generations) if cache_path is None else [_to_key(cache_path)]
+        for key in keys:
+            _generations[key] = _generations.get(key, 0) + 1
+    if getattr(_thread_local, "pid", None) == os.getpid():
+        for key in keys:
+            _, conn = _thread_local.connections.pop(key, (None, None))
+            if conn is not None:
+                conn.close()
@@ -1,4 +1,11 @@
 import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+import itertools
+import pickle
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Iterator
+import warnings
 import aiohttp
 
 
@@ -6,15 +13,35 @@ import pandas as pd
 from web3 import Web3
 import numpy as np
 from pathlib import Path
+import pyarrow as pa
 from aiolimiter import AsyncLimiter
 import nest_asyncio
 
 
-from multicallcache.call import Call
-from multicallcache.multicall import Multicall
-from multicallcache.utils import flatten, time_function
-from multicallcache.cache import save_data, get_data_from_disk
+from multicallcache.call import Call, decode_output, NOT_A_CONTRACT_REVERT_MESSAGE
+from multicallcache.chunking import (
+    ChunkSizer,
+    CostModel,
+    async_fetch_splitting_on_failure,
+    chunk_lengths,
+    fetch_splitting_on_failure,
+    get_chunk_sizer,
+    get_cost_model,
+    split_by_lengths,
+)
+from multicallcache.multicall import CallRawData, Multicall, DEFAULT_MULTICALL_ENGINE
+from multicallcache.rpc_call import SPLITTABLE_ERRORS, async_rpc_eth_call_batch
+from multicallcache.signature import Signature
+from multicallcache.utils import chunks, flatten, time_function
+from multicallcache.cache import save_data, get_data_from_disk, load_all_decoded
 from multicallcache.constants import CACHE_PATH
+from multicallcache.writer import BackgroundWriter
+
+DEFAULT_MAX_CONCURRENT_REQUESTS = 20
+DEFAULT_BLOCKS_PER_CHUNK = 1_000  # blocks read from the cache at once by async_iter_fetch_save_and_return()
+OUTPUT_FORMATS = ("wide", "long", "arrow")
+MAX_PLANNED_MISSING_CALL_SETS = 64  # distinct sets of missing calls _plan_multicalls_for_missing_data() keeps built
+INT64_MIN, INT64_MAX = -(2**63), 2**63 - 1
 
 nest_asyncio.apply()
 
@@ -27,15 +54,40 @@ def fetch_save_and_return(
     w3: Web3,  # TODO, w3 here should not be needed since it is already in each call
     max_calls_per_second: int = 10,
     cache="default",
-    max_calls_per_rpc_call: int = 300,
-) -> pd.DataFrame:
+    max_calls_per_rpc_call: int | None = None,
+    max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+    decode_workers: int = 1,
+    output_format: str = "wide",
+    rpc_batch_size: int = 1,
+    engine: str = DEFAULT_MULTICALL_ENGINE,
+) -> pd.DataFrame | pa.Table:
     """
     Primary Entry Point
 
     Get all the data that already exists
     externally fetch  and sve all the data that is missing
     read entire saved data from disk and return it processed.
+
+    max_calls_per_second caps the rate of rpc calls, max_concurrent_requests caps how many are in flight at once.
+    The number of calls per multicall is learned per provider and signature mix, see ChunkSizer, a multicall the
+    node refuses as too large, out of gas or too slow is split in half and retried.
+    max_calls_per_rpc_call caps the learned size, None leaves it to the ChunkSizer.
+    Within that size the calls are packed by their response bytes and node time, see CostModel.
+    rpc_batch_size > 1 sends that many multicalls, usually of different blocks, in each json rpc batch request,
+    worth it for few calls across many blocks where each request is mostly overhead.
+    engine is the Multicall3 function the calls are made through, see Multicall. "tryBlockAndAggregate" also
+    records the hash of each fetched block in the cache.
+    decode_workers > 1 decodes the result in that many processes, worth it for reads of millions of cells.
+
+    output_format picks the shape of the result:
+        "wide": a DataFrame with a block column and one column per data label, one row per block
+        "long": a DataFrame with block, label and value columns, one row per (block, data label)
+        "arrow": a pyarrow Table shaped like "wide", with a typed column per data label
+    "long" is built a column at a time without a record per block, the cheapest for thousands of data labels.
+    decode_workers only applies to "wide".
     """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"{output_format=} must be one of {OUTPUT_FORMATS}")
     # TODO add some kind of progress bar
     # reading locally
     # progress bar
@@ -48,23 +100,28 @@ def fetch_save_and_return(
 
     found_df, not_found_df = get_data_from_disk(calls, blocks, cache_path)
     print(f"{found_df.shape=}      {not_found_df.shape=} \n")
-    blocks_left = [int(b) for b in not_found_df["block"].unique()]
 
     # TODO, currently fails in jupyter, can't use asycio.run inside of jupyter
-    if len(blocks_left) > 0:
+    if len(not_found_df) > 0:
         # TODO fix timeout errors
+        num_blocks_to_fetch = not_found_df["block"].nunique()
         print(
-            f"Some data not found, making {len(blocks_left)} external calls at a rate of {max_calls_per_second} call /second \n"
+            f"Some data not found, fetching {num_blocks_to_fetch} blocks at a rate of {max_calls_per_second} call /second \n"
         )
+        chunk_sizer, cost_model = get_chunk_sizer(w3, calls), get_cost_model(w3)
         asyncio.run(
-            async_fetch_multicalls_across_blocks_and_save(
-                calls=calls,
-                blocks=blocks,
+            async_fetch_planned_multicalls_and_save(
+                planned_multicalls=_plan_multicalls_for_missing_data(
+                    calls, not_found_df, max_calls_per_rpc_call, chunk_sizer, cost_model, engine
+                ),
                 w3=w3,
                 rate_limit_per_second=max_calls_per_second,
                 cache_path=cache_path,
                 save=True,
-                max_calls_per_rpc_call=max_calls_per_rpc_call,
+                max_concurrent_requests=max_concurrent_requests,
+                chunk_sizer=chunk_sizer,
+                cost_model=cost_model,
+                rpc_batch_size=rpc_batch_size,
             )
         )
         found_df, not_found_df = get_data_from_disk(calls, blocks, cache_path)
@@ -78,24 +135,276 @@ def fetch_save_and_return(
         print(not_found_df.head())
         raise ValueError("failed to save everything to disk")
 
-    processed_block_wise_data_df = _raw_bytes_data_df_to_processed_block_wise_data_df(found_df, calls, blocks)
+    if output_format == "long":
+        return _raw_bytes_data_df_to_long_df(found_df, calls, blocks)
+    if output_format == "arrow":
+        return _raw_bytes_data_df_to_arrow_table(found_df, calls, blocks)
+
+    processed_block_wise_data_df = _raw_bytes_data_df_to_processed_block_wise_data_df(
+        found_df, calls, blocks, decode_workers
+    )
     return processed_block_wise_data_df
 
 
+def iter_fetch_save_and_return(
+    calls: list[Call],
+    blocks: list[int],
+    w3: Web3,
+    max_calls_per_second: int = 10,
+    cache="default",
+    max_calls_per_rpc_call: int | None = None,
+    max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+    in_block_order: bool = True,
+    blocks_per_chunk: int = DEFAULT_BLOCKS_PER_CHUNK,
+    rpc_batch_size: int = 1,
+    engine: str = DEFAULT_MULTICALL_ENGINE,
+) -> Iterator[dict[str, any]]:
+    """Synchronous version of async_iter_fetch_save_and_return(), for use outside of an event loop"""
+    loop = asyncio.new_event_loop()
+    rows = async_iter_fetch_save_and_return(
+        calls,
+        blocks,
+        w3,
+        max_calls_per_second,
+        cache,
+        max_calls_per_rpc_call,
+        max_concurrent_requests,
+        in_block_order,
+        blocks_per_chunk,
+        rpc_batch_size,
+        engine,
+    )
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(rows.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(rows.aclose())
+        loop.close()
+
+
+async def async_iter_fetch_save_and_return(
+    calls: list[Call],
+    blocks: list[int],
+    w3: Web3,
+    max_calls_per_second: int = 10,
+    cache="default",
+    max_calls_per_rpc_call: int | None = None,
+    max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+    in_block_order: bool = True,
+    blocks_per_chunk: int = DEFAULT_BLOCKS_PER_CHUNK,
+    rpc_batch_size: int = 1,
+    engine: str = DEFAULT_MULTICALL_ENGINE,
+) -> AsyncIterator[dict[str, any]]:
+    """
+    Streaming version of fetch_save_and_return(). Yields one row per block, {label: value, ..., "block": block},
+    as soon as that block is complete instead of returning every block in one DataFrame at the end.
+
+    The blocks are handled blocks_per_chunk at a time, so only one chunk is ever held in memory.
+    Within a chunk the cached blocks are ready at once and the fetched blocks as their multicalls land.
+    in_block_order=True yields the rows in the order of blocks, holding back blocks that finish early.
+    in_block_order=False yields the cached blocks first and then the fetched blocks in the order they complete.
+    Fetched data is saved as it arrives and multicalls are sized, batched and made like fetch_save_and_return().
+    """
+    if len(calls) == 0:
+        raise ValueError("len(calls) cannot be 0")
+    if len(blocks) == 0:
+        raise ValueError("len(blocks) cannot be 0")
+
+    cache_path = CACHE_PATH if cache == "default" else cache
+    blocks = list(dict.fromkeys(int(b) for b in blocks))
+    rate_limiter = AsyncLimiter(max_calls_per_second, time_period=1)
+    timeout = aiohttp.ClientTimeout(total=10)
+    connector = aiohttp.TCPConnector(limit=max_concurrent_requests)
+    chunk_sizer, cost_model = get_chunk_sizer(w3, calls), get_cost_model(w3)
+
+    with BackgroundWriter(cache_path) as writer:
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            fetch_batch = _rpc_fetch_batches(w3, session, rate_limiter, chunk_sizer, cost_model)
+
+            async def fetch_and_write(planned: list[tuple[Multicall, int]]) -> list[list[CallRawData]]:
+                all_call_raw_data = await fetch_batch(planned)
+                for call_raw_data in all_call_raw_data:
+                    await writer.async_put(call_raw_data)
+                return all_call_raw_data
+
+            for chunk_of_blocks in chunks(blocks, blocks_per_chunk):
+                async for row in _iter_chunk_of_blocks(
+                    calls,
+                    chunk_of_blocks,
+                    cache_path,
+                    fetch_and_write,
+                    max_calls_per_rpc_call,
+                    max_concurrent_requests,
+                    in_block_order,
+                    chunk_sizer,
+                    cost_model,
+                    rpc_batch_size,
+                    engine,
+                ):
+                    yield row
+
+
+async def _iter_chunk_of_blocks(
+    calls: list[Call],
+    blocks: list[int],
+    cache_path: Path,
+    fetch_batch: Callable[[list[tuple[Multicall, int]]], Awaitable[list[list[CallRawData]]]],
+    max_calls_per_rpc_call: int | None,
+    max_concurrent_requests: int,
+    in_block_order: bool,
+    chunk_sizer: ChunkSizer | None = None,
+    cost_model: CostModel | None = None,
+    rpc_batch_size: int = 1,
+    engine: str = DEFAULT_MULTICALL_ENGINE,
+) -> AsyncIterator[dict[str, any]]:
+    """The rows of blocks for async_iter_fetch_save_and_return(), reading what is cached and fetching the rest"""
+    found_df, not_found_df = get_data_from_disk(calls, blocks, cache_path)
+
+    call_indexes = {call: call_index for call_index, call in enumerate(calls)}
+    outputs: dict[int, dict[int, dict[str, any]]] = {block: {} for block in blocks}  # block -> callIndex -> outputs
+    responses = found_df["response"].tolist()
+    all_decoded = load_all_decoded([calls[i].signature for i in found_df["callIndex"]], responses, found_df["decoded"])
+    for call_index, block, raw_bytes_output, decoded in zip(
+        found_df["callIndex"], found_df["block"], responses, all_decoded
+    ):
+        outputs[int(block)][int(call_index)] = calls[call_index].decode_output(raw_bytes_output, decoded)
+    num_missing_calls = {int(block): int(n) for block, n in not_found_df.groupby("block", sort=False).size().items()}
+
+    def to_row(block: int) -> dict[str, any]:
+        row = {}
+        for _, label_to_output in sorted(outputs.pop(block).items()):
+            row.update(label_to_output)
+        row["block"] = block
+        return row
+
+    next_position = 0  # in_block_order: the position in blocks of the next row to yield
+
+    def ready_rows() -> Iterator[dict[str, any]]:
+        nonlocal next_position
+        while next_position < len(blocks) and blocks[next_position] not in num_missing_calls:
+            yield to_row(blocks[next_position])
+            next_position += 1
+
+    if in_block_order:
+        for row in ready_rows():
+            yield row
+    else:
+        for block in blocks:
+            if block not in num_missing_calls:
+                yield to_row(block)
+
+    if len(num_missing_calls) == 0:
+        return
+
+    results: asyncio.Queue = asyncio.Queue()
+
+    async def fetch_and_report(planned: list[tuple[Multicall, int]]) -> None:
+        for call_raw_data in await fetch_batch(planned):
+            await results.put(call_raw_data)
+
+    async def fetch_missing() -> None:
+        try:
+            planned_multicalls = _plan_multicalls_for_missing_data(
+                calls, not_found_df, max_calls_per_rpc_call, chunk_sizer, cost_model, engine
+            )
+            await _run_with_bounded_concurrency(
+                fetch_and_report, _batches(planned_multicalls, rpc_batch_size), max_concurrent_requests
+            )
+        finally:
+            results.put_nowait(None)
+
+    fetching = asyncio.ensure_future(fetch_missing())
+    try:
+        while (call_raw_data := await results.get()) is not None:
+            block = call_raw_data[0].block
+            for data in call_raw_data:
+                outputs[block][call_indexes[data.call]] = data.to_label_to_output()
+            num_missing_calls[block] -= len(call_raw_data)
+            if num_missing_calls[block] > 0:
+                continue
+            del num_missing_calls[block]
+            if in_block_order:
+                for row in ready_rows():
+                    yield row
+            else:
+                yield to_row(block)
+        await fetching  # raises the error that stopped the fetch, if any
+    finally:
+        fetching.cancel()
+
+    if len(num_missing_calls) > 0:
+        raise ValueError(f"failed to fetch {len(num_missing_calls)} blocks")
+
+
 def simple_sequential_fetch_multicalls_across_blocks_and_save(
-    calls: list[Call], blocks: list[int], w3: Web3, cache_path: Path
+    calls: list[Call], blocks: list[int], w3: Web3, cache_path: Path, engine: str = DEFAULT_MULTICALL_ENGINE
 ) -> None:
-    """make and save all the data from calls, blocks"""
+    """make and save all the data from calls, blocks, splitting the multicall when the node refuses it"""
+
+    multicall = Multicall(calls, engine)
+    chunk_sizer, cost_model = get_chunk_sizer(w3, calls), get_cost_model(w3)
+
+    def fetch(multicall: Multicall, block: int) -> list[CallRawData]:
+        timings = []
+        data = multicall.make_external_calls_to_raw_data(w3, block, timings)
+        cost_model.record(data, timings[-1])
+        return data
 
-    multicall = Multicall(calls)
     call_raw_data = []
     for block_id in blocks:
-        data = multicall.make_external_calls_to_raw_data(w3, block_id)
+        data = fetch_splitting_on_failure(fetch, multicall, block_id, chunk_sizer)
         call_raw_data.extend(data)
 
     save_data(call_raw_data, cache_path)
 
 
+def _plan_multicalls_for_missing_data(
+    calls: list[Call],
+    not_found_df: pd.DataFrame,
+    max_calls_per_rpc_call: int | None,
+    chunk_sizer: ChunkSizer | None = None,
+    cost_model: CostModel | None = None,
+    engine: str = DEFAULT_MULTICALL_ENGINE,
+) -> Iterator[tuple[Multicall, int]]:
+    """
+    Group the (call, block) pairs that are not in the cache by block and build one Multicall per block
+    (or per chunk of max_calls_per_rpc_call) from only the missing calls.
+
+    With a chunk_sizer the chunks are the size it has learned so far, capped by max_calls_per_rpc_call,
+    and with a cost_model they also end where the calls fill the budget of one rpc call, see chunk_lengths().
+    Both are read again for every block so the plan follows them as the fetch reports back.
+
+    Blocks that are missing the same set of calls share the same Multicall objects, so the calldata is
+    only encoded once per distinct set of missing calls while the chunk lengths stay the same. Only the
+    MAX_PLANNED_MISSING_CALL_SETS most recently used sets are kept, with the lengths they were built for,
+    so memory stays flat however many blocks stream through. The plan is yielded lazily as the fetch consumes it.
+    """
+    if max_calls_per_rpc_call is None and chunk_sizer is None:
+        raise ValueError("max_calls_per_rpc_call or chunk_sizer is needed to size the multicalls")
+    # missing call indexes -> (chunk lengths, the multicalls of those chunks), least recently used first
+    missing_call_indexes_to_multicalls: OrderedDict[tuple[int], tuple[tuple[int], list[Multicall]]] = OrderedDict()
+
+    for block, missing_df in not_found_df.groupby("block", sort=False):
+        missing_call_indexes = tuple(sorted(int(i) for i in missing_df["callIndex"]))
+        missing_calls = [calls[i] for i in missing_call_indexes]
+        chunk_size = max_calls_per_rpc_call if chunk_sizer is None else chunk_sizer.chunk_size(max_calls_per_rpc_call)
+        lengths = chunk_lengths(missing_calls, chunk_size, cost_model)
+
+        planned = missing_call_indexes_to_multicalls.get(missing_call_indexes)
+        if planned is None or planned[0] != lengths:
+            planned = (lengths, [Multicall(c, engine) for c in split_by_lengths(missing_calls, lengths)])
+            missing_call_indexes_to_multicalls[missing_call_indexes] = planned
+        missing_call_indexes_to_multicalls.move_to_end(missing_call_indexes)
+        if len(missing_call_indexes_to_multicalls) > MAX_PLANNED_MISSING_CALL_SETS:
+            missing_call_indexes_to_multicalls.popitem(last=False)
+
+        for multicall in planned[1]:
+            yield multicall, int(block)
+
+
 async def async_fetch_multicalls_across_blocks_and_save(
     calls: list[Call],
     blocks: list[int],
@@ -104,61 +413,258 @@ async def async_fetch_multicalls_across_blocks_and_save(
     cache_path: Path,
     save: bool = True,
     max_calls_per_rpc_call: int = 3_000,
+    max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+    rpc_batch_size: int = 1,
+    engine: str = DEFAULT_MULTICALL_ENGINE,
 ):
-    num_calls = len(calls)
-    if num_calls < max_calls_per_rpc_call:
-        # base case
-        multicalls = [Multicall(calls)]
-    else:
-        chunks_of_calls = np.array_split(calls, (len(calls) // max_calls_per_rpc_call) + 1)
-        multicalls = [Multicall(list(c)) for c in chunks_of_calls]
+    # one plan for every block, packed by what each call is expected to cost rather than in equal counts
+    cost_model = get_cost_model(w3)
+    lengths = chunk_lengths(calls, max_calls_per_rpc_call, cost_model)
+    multicalls = [Multicall(c, engine) for c in split_by_lengths(calls, lengths)]
+
+    planned_multicalls = ((multicall, block) for multicall in multicalls for block in blocks)
+    return await async_fetch_planned_multicalls_and_save(
+        planned_multicalls,
+        w3,
+        rate_limit_per_second,
+        cache_path,
+        save,
+        max_concurrent_requests,
+        get_chunk_sizer(w3, calls),
+        cost_model,
+        rpc_batch_size,
+    )
+
+
+async def async_fetch_planned_multicalls_and_save(
+    planned_multicalls: Iterable[tuple[Multicall, int]],
+    w3: Web3,
+    rate_limit_per_second: int,
+    cache_path: Path,
+    save: bool = True,
+    max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+    chunk_sizer: ChunkSizer | None = None,
+    cost_model: CostModel | None = None,
+    rpc_batch_size: int = 1,
+):
+    """
+    Make every (multicall, block) external call in planned_multicalls and save or return the results.
+    A multicall the node refuses as too large, out of gas or too slow is split in half and retried,
+    the outcomes are reported to chunk_sizer and the response sizes and latencies to cost_model.
+    rpc_batch_size consecutive multicalls of the plan are sent together as one json rpc batch request.
 
+    At most max_concurrent_requests calls are in flight at once, independent of rate_limit_per_second,
+    and planned_multicalls is only consumed as fast as they complete, so memory does not grow with the number of blocks.
+
+    When saving, each multicall's results are handed to a BackgroundWriter as soon as they arrive and committed
+    in batches while the rest are fetched. If a request fails or the run is interrupted everything fetched so far
+    is still committed, running fetch_save_and_return again then only fetches what is missing.
+    """
     rate_limiter = AsyncLimiter(rate_limit_per_second, time_period=1)
     timeout = aiohttp.ClientTimeout(total=10)
-    tasks = []
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        for multicall in multicalls:
-            tasks.extend(
-                [multicall.async_make_each_call_to_raw_call_data(w3, block, session, rate_limiter) for block in blocks]
+    connector = aiohttp.TCPConnector(limit=max_concurrent_requests)
+
+    if not save:
+        call_raw_data = []
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+
+            fetch_batch = _rpc_fetch_batches(w3, session, rate_limiter, chunk_sizer, cost_model)
+
+            async def fetch_and_keep(planned: list[tuple[Multicall, int]]) -> None:
+                for data in await fetch_batch(planned):
+                    call_raw_data.extend(data)
+
+            await _run_with_bounded_concurrency(
+                fetch_and_keep, _batches(planned_multicalls, rpc_batch_size), max_concurrent_requests
             )
+        return call_raw_data
 
-        call_raw_data = await asyncio.gather(*tasks)
+    with BackgroundWriter(cache_path) as writer:
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
 
-    call_raw_data = flatten(call_raw_data)
+            fetch_batch = _rpc_fetch_batches(w3, session, rate_limiter, chunk_sizer, cost_model)
 
-    if save:
-        save_data(call_raw_data, cache_path)
-    else:
+            async def fetch_and_write(planned: list[tuple[Multicall, int]]) -> None:
+                for data in await fetch_batch(planned):
+                    await writer.async_put(data)
+
+            await _run_with_bounded_concurrency(
+                fetch_and_write, _batches(planned_multicalls, rpc_batch_size), max_concurrent_requests
+            )
+
+
+def _rpc_fetch(
+    w3: Web3, session: aiohttp.ClientSession, rate_limiter: AsyncLimiter, cost_model: CostModel | None
+) -> Callable[[Multicall, int], Awaitable[list[CallRawData]]]:
+    """fetch(multicall, block) from the node, reporting the response sizes and latency to cost_model"""
+
+    async def fetch(multicall: Multicall, block: int) -> list[CallRawData]:
+        timings = []
+        call_raw_data = await multicall.async_make_each_call_to_raw_call_data(w3, block, session, rate_limiter, timings)
+        if cost_model is not None:
+            cost_model.record(call_raw_data, timings[-1])
         return call_raw_data
 
+    return fetch
+
+
+def _rpc_fetch_batches(
+    w3: Web3,
+    session: aiohttp.ClientSession,
+    rate_limiter: AsyncLimiter,
+    chunk_sizer: ChunkSizer | None,
+    cost_model: CostModel | None,
+) -> Callable[[list[tuple[Multicall, int]]], Awaitable[list[list[CallRawData]]]]:
+    """
+    fetch_batch(planned), the CallRawData of each (multicall, block) in planned, sent in one json rpc batch.
+
+    A batch the node refuses as a whole, eg as too large, is halved and the halves are sent one after the other.
+    A multicall that fails inside the batch on payload, gas or time, or that the node left out of its answer,
+    is fetched again on its own and split as needed, see async_fetch_splitting_on_failure(). Any other error raises.
+    A batch of one multicall is a plain eth_call. The latency of a batch is not reported to cost_model,
+    it can't be told apart per multicall.
+    """
+    fetch = _rpc_fetch(w3, session, rate_limiter, cost_model)
+
+    async def fetch_batch(planned: list[tuple[Multicall, int]]) -> list[list[CallRawData]]:
+        if len(planned) == 1:
+            return [await async_fetch_splitting_on_failure(fetch, *planned[0], chunk_sizer)]
+        all_rpc_args = [multicall.to_rpc_call_args(block) for multicall, block in planned]
+        try:
+            results = await async_rpc_eth_call_batch(w3, all_rpc_args, session, rate_limiter)
+        except SPLITTABLE_ERRORS:
+            middle = len(planned) // 2
+            return await fetch_batch(planned[:middle]) + await fetch_batch(planned[middle:])
+
+        all_call_raw_data = []
+        for (multicall, block), result in zip(planned, results):
+            if isinstance(result, SPLITTABLE_ERRORS):
+                call_raw_data = await async_fetch_splitting_on_failure(fetch, multicall, block, chunk_sizer)
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                call_raw_data = multicall.to_call_raw_data(result, block)
+                if chunk_sizer is not None:
+                    chunk_sizer.record_success(len(multicall.calls))
+                if cost_model is not None:
+                    cost_model.record(call_raw_data)
+            all_call_raw_data.append(call_raw_data)
+        return all_call_raw_data
+
+    return fetch_batch
+
+
+def _batches(
+    planned_multicalls: Iterable[tuple[Multicall, int]], rpc_batch_size: int
+) -> Iterator[tuple[list[tuple[Multicall, int]]]]:
+    """Consecutive lists of rpc_batch_size planned multicalls, each as the only argument of a fetch_batch()"""
+    if rpc_batch_size < 1:
+        raise ValueError(f"{rpc_batch_size=} must be at least 1")
+    planned_multicalls = iter(planned_multicalls)
+    while batch := list(itertools.islice(planned_multicalls, rpc_batch_size)):
+        yield (batch,)
+
+
+async def _run_with_bounded_concurrency(
+    fetch: Callable[..., Awaitable[None]],
+    all_args: Iterable[tuple],
+    max_concurrent_requests: int,
+) -> None:
+    """
+    await fetch(*args) for each args in all_args from a pool of max_concurrent_requests workers.
+    The fetches are given _batches() of the planned multicalls, so each args is a 1-tuple of a batch.
+
+    all_args is fed through a queue of twice the pool size, so only a window of it is pending at any time.
+    After the first failure no more work is started, the requests already in flight finish and then it is raised.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=2 * max_concurrent_requests)
+    errors: list[Exception] = []
+
+    async def worker() -> None:
+        while True:
+            args = await queue.get()
+            if args is None:
+                return
+            if len(errors) == 0:
+                try:
+                    await fetch(*args)
+                except Exception as e:
+                    errors.append(e)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max_concurrent_requests)]
+    try:
+        for args in all_args:
+            if len(errors) > 0:
+                break
+            await queue.put(args)  # waits while the window is full
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+
+    if len(errors) > 0:
+        raise errors[0]
+
 
 # fast enough even at size
 def _raw_bytes_data_df_to_processed_block_wise_data_df(
-    raw_bytes_data_df: pd.DataFrame, calls: list[Call], blocks: list[int]
+    raw_bytes_data_df: pd.DataFrame, calls: list[Call], blocks: list[int], decode_workers: int = 1
 ) -> pd.DataFrame:
-    call_id_to_success_and_response = dict()
+    """
+    Decode found_df from get_data_from_disk into one row per block and one column per data label.
+    decode_workers > 1 splits the blocks into that many ranges and decodes them in a process pool.
+    """
+    if decode_workers > 1:
+        processed_outputs = _decode_block_wise_in_process_pool(raw_bytes_data_df, calls, decode_workers)
+    else:
+        processed_outputs = _decode_block_wise(
+            [(call.signature, call.data_labels, call.handling_functions) for call in calls],
+            raw_bytes_data_df["callIndex"],
+            raw_bytes_data_df["block"],
+            raw_bytes_data_df["response"],
+            raw_bytes_data_df["decoded"],
+        )
 
-    for callId, success, response in zip(
-        raw_bytes_data_df["callId"], raw_bytes_data_df["success"], raw_bytes_data_df["response"]
-    ):
-        call_id_to_success_and_response[callId] = (success, response)
+    # at ths point  processed_outputs looks like
+
+    # {
+    #     XXX: {'weth_balance_of': AAA,  'usdcDecimals': BBB, 'lastTimestampUpdate': CCC},
+    #     YYY: {'weth_balance_of': EEE,  'usdcDecimals': BBB, 'lastTimestampUpdate': DDD},
+    # }
 
-    callIds_to_call_and_block = dict()
+    # needs to be turned into a dataframe
 
-    for call in calls:
-        for block in blocks:
-            call_id = call.to_id(block)
-            callIds_to_call_and_block[call_id] = (call, block)
+    records = []
+    for block, all_processed_data_for_block in processed_outputs.items():
+        all_processed_data_for_block["block"] = block
+        records.append(all_processed_data_for_block)
 
-    # label, handeling function, decoded value
-    # TODO duplicate logic as in cache.py pick one and stick with it
-    processed_outputs: dict[int, list[dict[str, any]]] = {}
+    processed_block_wise_data_df = pd.DataFrame.from_records(records)
 
-    for callId, call_block in callIds_to_call_and_block.items():
-        (call, block) = call_block
-        (success, raw_bytes_output) = call_id_to_success_and_response[callId]  # should never fail
+    return processed_block_wise_data_df
 
-        processed_response: dict[str, any] = call.decode_output(raw_bytes_output)
+
+def _decode_block_wise(
+    decoders: list[tuple[Signature, tuple[str], tuple[Callable]]],
+    call_indexes: Iterable[int],
+    blocks: Iterable[int],
+    responses: Iterable[bytes],
+    all_decoded: Iterable[bytes | None],
+) -> dict[int, dict[str, any]]:
+    """
+    block -> {label: value} of every call at that block. decoders[callIndex] is the (signature, data_labels,
+    handling_functions) of the call, everything decode_output needs without the Call itself, so it can be
+    sent to another process.
+    """
+    processed_outputs: dict[int, dict[str, any]] = {}
+    call_indexes, responses = list(call_indexes), list(responses)
+    all_decoded = load_all_decoded([decoders[i][0] for i in call_indexes], responses, all_decoded)
+
+    for call_index, block, raw_bytes_output, decoded in zip(call_indexes, blocks, responses, all_decoded):
+        block = int(block)
+        processed_response: dict[str, any] = decode_output(*decoders[call_index], raw_bytes_output, decoded)
 
         if block in processed_outputs:
             processed_outputs[block].update(processed_response)
@@ -181,20 +687,128 @@ def _raw_bytes_data_df_to_processed_block_wise_data_df(
         # | ZZZ      | AAA                  | BBB           | CCC                 |
         # | YYY      | EEE                  | BBB           | DDD                 |
 
-    # at ths point  processed_outputs looks like
+    return processed_outputs
 
-    # {
-    #     XXX: {'weth_balance_of': AAA,  'usdcDecimals': BBB, 'lastTimestampUpdate': CCC},
-    #     YYY: {'weth_balance_of': EEE,  'usdcDecimals': BBB, 'lastTimestampUpdate': DDD},
-    # }
-
-    # needs to be turned into a dataframe
 
-    records = []
-    for block, all_processed_data_for_block in processed_outputs.items():
-        all_processed_data_for_block["block"] = block
-        records.append(all_processed_data_for_block)
+def _decode_block_wise_in_process_pool(
+    raw_bytes_data_df: pd.DataFrame, calls: list[Call], decode_workers: int
+) -> dict[int, dict[str, any]]:
+    """
+    _decode_block_wise() of contiguous block ranges of raw_bytes_data_df, one per worker process, merged back in order.
+    Falls back to decoding in this process when a handling function can't be pickled, eg a lambda.
+    """
+    decoders = [(call.signature, call.data_labels, call.handling_functions) for call in calls]
+    try:
+        pickle.dumps(decoders)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        warnings.warn(f"decoding in this process, the handling functions can't be sent to a process pool: {e}")
+        columns = [raw_bytes_data_df[c] for c in ("callIndex", "block", "response", "decoded")]
+        return _decode_block_wise(decoders, *columns)
+
+    # stable sort by first appearance of the block, so each worker gets every row of a contiguous range of blocks
+    # and the blocks come back in the order the serial decode would return them
+    block_positions = pd.factorize(raw_bytes_data_df["block"])[0]
+    order = np.argsort(block_positions, kind="stable")
+    block_positions = block_positions[order]
+    columns = [raw_bytes_data_df[c].to_numpy()[order].tolist() for c in ("callIndex", "block", "response", "decoded")]
+    num_blocks = block_positions.max() + 1 if len(block_positions) > 0 else 0
+    range_starts = np.searchsorted(block_positions, [num_blocks * i // decode_workers for i in range(decode_workers)])
+    range_stops = list(range_starts[1:]) + [len(block_positions)]
+
+    processed_outputs: dict[int, dict[str, any]] = {}
+    with ProcessPoolExecutor(max_workers=decode_workers) as executor:
+        futures = [
+            executor.submit(_decode_block_wise, decoders, *(column[start:stop] for column in columns))
+            for start, stop in zip(range_starts, range_stops)
+            if stop > start
+        ]
+        for future in futures:
+            processed_outputs.update(future.result())
+    return processed_outputs
+
+
+def _decode_column_wise(
+    raw_bytes_data_df: pd.DataFrame, calls: list[Call], blocks: list[int]
+) -> dict[str, tuple[np.ndarray, list[any]]]:
+    """
+    label -> (blocks, values) of every data label, with the blocks in the order of blocks.
+    Decoded one call at a time from the rows of found_df, without building a record per block.
+    Like the wide format, when calls share a data label the last one wins.
+    """
+    block_positions = pd.Index(list(dict.fromkeys(blocks))).get_indexer(raw_bytes_data_df["block"])
+    call_indexes = raw_bytes_data_df["callIndex"].to_numpy()
+    order = np.lexsort((block_positions, call_indexes))
+    call_indexes = call_indexes[order]
+    found_blocks = raw_bytes_data_df["block"].to_numpy(dtype=np.int64)[order]
+    responses = raw_bytes_data_df["response"].to_numpy()[order]
+    all_decoded = raw_bytes_data_df["decoded"].to_numpy()[order]
+
+    starts = np.searchsorted(call_indexes, np.arange(len(calls)), side="left")
+    stops = np.searchsorted(call_indexes, np.arange(len(calls)), side="right")
+
+    columns: dict[str, tuple[np.ndarray, list[any]]] = {}
+    for call, start, stop in zip(calls, starts, stops):
+        values = [[] for _ in call.data_labels]
+        call_responses = responses[start:stop]
+        call_decoded = load_all_decoded([call.signature] * (stop - start), call_responses, all_decoded[start:stop])
+        for raw_bytes_output, decoded in zip(call_responses, call_decoded):
+            label_to_output = call.decode_output(raw_bytes_output, decoded)
+            for label_values, label in zip(values, call.data_labels):
+                label_values.append(label_to_output[label])
+        for label, label_values in zip(call.data_labels, values):
+            columns[label] = (found_blocks[start:stop], label_values)
+    return columns
+
+
+def _raw_bytes_data_df_to_long_df(
+    raw_bytes_data_df: pd.DataFrame, calls: list[Call], blocks: list[int]
+) -> pd.DataFrame:
+    """
+    found_df decoded into one row per (block, data label), ordered by data label then block.
+    label is categorical and value is an object column, since different data labels hold different types.
+    """
+    columns = _decode_column_wise(raw_bytes_data_df, calls, blocks)
+    labels = list(columns)
+    lengths = [len(label_values) for _, label_values in columns.values()]
+    label_blocks = [label_blocks for label_blocks, _ in columns.values()]
+
+    values = list(itertools.chain.from_iterable(label_values for _, label_values in columns.values()))
+    return pd.DataFrame(
+        {
+            "block": np.concatenate(label_blocks) if label_blocks else np.array([], dtype=np.int64),
+            "label": pd.Categorical.from_codes(np.repeat(np.arange(len(labels)), lengths), categories=labels),
+            "value": pd.Series(values, dtype=object),
+        }
+    )
+
+
+def _raw_bytes_data_df_to_arrow_table(
+    raw_bytes_data_df: pd.DataFrame, calls: list[Call], blocks: list[int]
+) -> pa.Table:
+    """found_df decoded into a block column and a typed column per data label, one row per block in the order of blocks"""
+    columns = _decode_column_wise(raw_bytes_data_df, calls, blocks)
+    arrays = {"block": pa.array(list(dict.fromkeys(int(block) for block in blocks)), type=pa.int64())}
+    for label, (_, label_values) in columns.items():
+        arrays[label] = _to_arrow_array(label_values)
+    return pa.table(arrays)
 
-    processed_block_wise_data_df = pd.DataFrame.from_records(records)
 
-    return processed_block_wise_data_df
+def _to_arrow_array(values: list[any]) -> pa.Array:
+    """
+    The type pyarrow infers for values. Calls to addresses without code become nulls, ints that don't fit in
+    an int64, eg uint256 balances, become decimal256(76, 0) and whatever else pyarrow can't type becomes strings.
+    """
+    values = [None if isinstance(value, str) and value == NOT_A_CONTRACT_REVERT_MESSAGE else value for value in values]
+    ints = [value for value in values if type(value) is int]
+    if len(ints) > 0 and len(ints) == len(values) - values.count(None):
+        # checked up front, letting pyarrow raise OverflowError column after column is slow for thousands of columns
+        if INT64_MIN <= min(ints) and max(ints) <= INT64_MAX:
+            return pa.array(values, type=pa.int64())
+        if max(abs(value) for value in ints) < 10**76:
+            return pa.array([None if value is None else Decimal(value) for value in values], type=pa.decimal256(76, 0))
+    else:
+        try:
+            return pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            pass
+    return pa.array([None if value is None else str(value) for value in values], type=pa.string())
@@ -0,0 +1,99 @@
+import threading
+import time
+
+import eth_retry
+from web3 import Web3
+
+from multicallcache.utils import provider_key
+
+# seconds a fetched finalized block number is trusted. Mainnet finalizes an epoch about every 6.4 minutes,
+# so waiting a minute to notice a new one only delays caching the newest blocks, it is never wrong
+DEFAULT_FINALIZED_BLOCK_TTL = 60.0
+
+
+@eth_retry.auto_retry
+def _get_finalized_block_number(w3: Web3) -> int:
+    return w3.eth.get_block("finalized").number  # makes a http call
+
+
+class FinalizedBlockTracker:
+    """
+    The finalized block number of one rpc provider, fetched at most once every ttl seconds.
+
+    The finalized block only moves forward, so a block below the last number fetched is finalized
+    no matter how old that number is. Only blocks at or after it need a fresh number, and only once per ttl.
+    start_background_refresh() keeps the number fresh from a daemon thread so callers never wait on the rpc.
+    """
+
+    def __init__(self, w3: Web3, ttl: float = DEFAULT_FINALIZED_BLOCK_TTL) -> None:
+        self.w3 = w3
+        self.ttl = ttl
+        self._number: int | None = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._stop_refreshing: threading.Event | None = None
+
+    def number(self) -> int:
+        """The finalized block number, fetched again if the last one is more than ttl seconds old"""
+        with self._lock:
+            if self._number is None or time.monotonic() - self._fetched_at >= self.ttl:
+                self._refresh_locked()
+            return self._number
+
+    def is_finalized(self, block: int) -> bool:
+        """If block is before the finalized block, so every call on it can be cached"""
+        number = self._number
+        if number is not None and block < number:
+            return True
+        return block < self.number()
+
+    def refresh(self) -> int:
+        """Fetch the finalized block number now, whatever its age"""
+        with self._lock:
+            self._refresh_locked()
+            return self._number
+
+    def _refresh_locked(self) -> None:
+        number = _get_finalized_block_number(self.w3)
+        # a node behind a load balancer can briefly answer with an older finalized block, never go back
+        self._number = number if self._number is None else max(self._number, number)
+        self._fetched_at = time.monotonic()
+
+    def start_background_refresh(self, interval: float | None = None) -> None:
+        """Refresh every interval seconds, ttl by default, from a daemon thread until stop_background_refresh()"""
+        if self._stop_refreshing is not None:
+            return
+        self._stop_refreshing = threading.Event()
+        thread = threading.Thread(
+            target=self._refresh_until_stopped,
+            args=(self._stop_refreshing, self.ttl if interval is None else interval),
+            name="multicallcache-finalized-block",
+            daemon=True,
+        )
+        thread.start()
+
+    def stop_background_refresh(self) -> None:
+        if self._stop_refreshing is not None:
+            self._stop_refreshing.set()
+            self._stop_refreshing = None
+
+    def _refresh_until_stopped(self, stop: threading.Event, interval: float) -> None:
+        while not stop.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                pass  # keep the last number, number() fetches it again once it is stale
+            stop.wait(interval)
+
+
+_trackers: dict[str, FinalizedBlockTracker] = {}  # provider endpoint -> its tracker
+_trackers_lock = threading.Lock()
+
+
+def get_finalized_block_tracker(w3: Web3) -> FinalizedBlockTracker:
+    """The FinalizedBlockTracker shared by every Web3 instance connected to the same endpoint as w3"""
+    key = provider_key(w3)
+    with _trackers_lock:
+        if key not in _trackers:
+            _trackers[key] = FinalizedBlockTracker(w3)
+        return _trackers[key]
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+import os
+from pathlib import Path
+import threading
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+ENTRY_OVERHEAD_BYTES = 200  # rough size of the key, the tuple and the OrderedDict node around each response
+
+
+class LRUCache:
+    """
+    In process cache of (success, response, decoded) keyed by (cache_path, callId), bounded by the total bytes it holds.
+    Evicts the least recently used entries once it is over max_bytes.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple[str, bytes], tuple[bool, bytes, bytes | None]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cache_path: Path, call_id: bytes) -> tuple[bool, bytes, bytes | None] | None:
+        key = (_to_key(cache_path), call_id)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, cache_path: Path, call_id: bytes, success: bool, response: bytes, decoded: bytes = None) -> None:
+        key = (_to_key(cache_path), call_id)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = (success, response, decoded)
+            self.current_bytes += _entry_size(self._entries[key])
+            while self.current_bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= _entry_size(evicted)
+
+    def remove(self, cache_path: Path, call_id: bytes) -> None:
+        with self._lock:
+            value = self._entries.pop((_to_key(cache_path), call_id), None)
+            if value is not None:
+                self.current_bytes -= _entry_size(value)
+
+    def remove_cache_path(self, cache_path: Path) -> None:
+        """Drop every entry of cache_path, eg when the db is deleted"""
+        path_key = _to_key(cache_path)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == path_key]:
+                self.current_bytes -= _entry_size(self._entries.pop(key))
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _to_key(cache_path: Path) -> str:
+    return os.path.abspath(str(cache_path))
+
+
+def _entry_size(entry: tuple[bool, bytes | None, bytes | None]) -> int:
+    _, response, decoded = entry
+    return ENTRY_OVERHEAD_BYTES + sum(len(b) for b in (response, decoded) if b is not None)
+
+
+_memory_cache: LRUCache | None = None  # off until enable_memory_cache() is called
+
+
+def enable_memory_cache(max_bytes: int = DEFAULT_MAX_BYTES) -> LRUCache:
+    """Put a bounded in memory cache in front of the sqlite cache for every lookup in this process"""
+    global _memory_cache
+    _memory_cache = LRUCache(max_bytes)
+    return _memory_cache
+
+
+def disable_memory_cache() -> None:
+    global _memory_cache
+    _memory_cache = None
+
+
+def get_memory_cache() -> LRUCache | None:
+    return _memory_cache
@@ -4,42 +4,55 @@ from aiolimiter import AsyncLimiter
 import pickle
 
 from multicallcache.call import Call, GAS_LIMIT, CALL_FAILED_REVERT_MESSAGE
-from multicallcache.signature import Signature
+from multicallcache.signature import get_signature
 from multicallcache.rpc_call import sync_rpc_eth_call, async_rpc_eth_call
-from multicallcache.constants import CACHE_PATH, MULTICALL3_ADDRESSES, Network
+from multicallcache.constants import (
+    CACHE_PATH,
+    MULTICALL3_ADDRESSES,
+    MULTICALL3_BYTECODE,
+    MULTICALL3_DEPLOYMENT_BLOCKS,
+    MULTICALL3_OVERRIDE_MIN_BLOCKS,
+    Network,
+)
 from multicallcache.utils import chain_id
+from multicallcache.finalized import get_finalized_block_tracker
 
-COLUMNS = [
-    "callId",
-    "target",
-    "signature",
-    "argumentsAsStr",
-    "argumentsAsPickle",
-    "block",
-    "chainId",
-    "success",
-    "response",
-]
+# engine -> the Multicall3 function a Multicall calls
+MULTICALL_ENGINES = {
+    # function tryAggregate(bool requireSuccess, Call[] calls) returns (Result[] returnData)
+    "tryAggregate": "tryAggregate(bool,(address,bytes)[])((bool,bytes)[])",
+    # function aggregate3(Call3[] calls) returns (Result[] returnData), with a Call3.allowFailure per call
+    "aggregate3": "aggregate3((address,bool,bytes)[])((bool,bytes)[])",
+    # function tryBlockAndAggregate(bool requireSuccess, Call[] calls)
+    #   returns (uint256 blockNumber, bytes32 blockHash, Result[] returnData)
+    "tryBlockAndAggregate": "tryBlockAndAggregate(bool,(address,bytes)[])(uint256,bytes32,(bool,bytes)[])",
+}
+DEFAULT_MULTICALL_ENGINE = "tryAggregate"
 
 
 class CallRawData:
     # TODO consider some type validation
-    def __init__(self, call: Call, block: int, success: bool = None, response: bytes = None) -> None:
+    def __init__(
+        self,
+        call: Call,
+        block: int,
+        success: bool = None,
+        response: bytes = None,
+        decoded: tuple = None,
+        block_hash: bytes = None,
+    ) -> None:
         self.call: Call = call
         self.success: bool = success
         self.response: bytes = response
+        self.decoded: tuple | None = decoded  # response abi decoded, when it was read back decoded from the cache
         self.block: int = block
-        self.chainID = chain_id(call.w3)
+        self.block_hash: bytes | None = block_hash  # of the block the call ran on, from tryBlockAndAggregate
+        self.chainID = call.get_chain_id()
         self.call_id: bytes = self.call.to_id(self.block)
 
     def to_label_to_output(self) -> dict[str, any]:
         # not certain this will work with all not a contract, and failed to run contract
-        return self.call.decode_output(self.response)
-
-    def convert_to_format_to_save_in_cache_db(self):
-        record = self.to_record()
-        to_save_format = tuple([record[c] for c in COLUMNS])
-        return to_save_format
+        return self.call.decode_output(self.response, self.decoded)
 
     def to_record(self) -> dict[str:any]:
         return {
@@ -63,12 +76,21 @@ class Multicall:
     def __init__(
         self,
         calls: list[Call],
+        engine: str = DEFAULT_MULTICALL_ENGINE,
     ):
+        """
+        engine picks the Multicall3 function the calls are made through, see MULTICALL_ENGINES.
+            "tryAggregate": every call may fail
+            "aggregate3": each call may fail unless its allow_failure is False, cheaper on gas
+            "tryBlockAndAggregate": every call may fail, also returns the hash of the block the calls ran on
+        """
         if len(calls) == 0:
             raise ValueError("Must supply more than 0 calls")
+        if engine not in MULTICALL_ENGINES:
+            raise ValueError(f"{engine=} must be one of {tuple(MULTICALL_ENGINES)}")
         self.calls = calls
-        # function tryAggregate(bool requireSuccess, Call[] memory calls) public returns (Result[] memory returnData)
-        self.multicall_sig = Signature("tryAggregate(bool,(address,bytes)[])((bool,bytes)[])")
+        self.engine = engine
+        self.multicall_sig = get_signature(MULTICALL_ENGINES[engine])
         self.w3 = self.calls[0].w3
         self.multicall_address = MULTICALL3_ADDRESSES[Network(chain_id(self.w3))]
 
@@ -76,11 +98,18 @@ class Multicall:
         self._ensure_no_duplicate_names_in_calls(calls)
 
         for call in self.calls:
-            single_call_calldata = call.signature.encode_data(call.arguments)
-
-            multicall_args.append((call.target, single_call_calldata))
+            # call.target is already checksummed, as 20 bytes eth_abi doesn't check it with keccak again
+            target = bytes.fromhex(call.target[2:])
+            if engine == "aggregate3":
+                multicall_args.append((target, call.allow_failure, call.calldata))
+            else:
+                multicall_args.append((target, call.calldata))
 
-        self.calldata = f"0x{self.multicall_sig.encode_data((False, tuple(multicall_args))).hex()}"
+        if engine == "aggregate3":
+            encoded = self.multicall_sig.encode_data((tuple(multicall_args),))
+        else:
+            encoded = self.multicall_sig.encode_data((False, tuple(multicall_args)))
+        self.calldata = f"0x{encoded.hex()}"
 
     def _ensure_block_keyword_is_not_in_multicall(self, calls: list[Call]):
         for call in calls:
@@ -99,14 +128,39 @@ class Multicall:
                 else:
                     found_data_labels.add(label)
 
-    def to_rpc_call_args(self, block: int):
-        """Convert this multicall into the format required fo for a rpc node api request"""
+    def to_rpc_call_args(self, block: int, block_hash: bytes | None = None):
+        """
+        Convert this multicall into the format required fo for a rpc node api request
+        With a block_hash the call is pinned to that block (EIP-1898), it fails rather than run on another block
+        with the same number after a reorg.
+        Before Multicall3 was deployed its code is injected at its address as a state override, the third
+        parameter of eth_call, so old blocks are multicalled like new ones. The node has to support state overrides.
+        """
+        block_parameter = hex(int(block)) if block_hash is None else {"blockHash": f"0x{bytes(block_hash).hex()}"}
         rpc_args = [
             {"to": self.multicall_address, "data": self.calldata, "gas": hex(GAS_LIMIT)},
-            hex(int(block)),
+            block_parameter,
         ]
+        if self._predates_multicall(block):
+            rpc_args.append({self.multicall_address: {"code": MULTICALL3_BYTECODE}})
         return rpc_args
 
+    def _predates_multicall(self, block: int | str) -> bool:
+        """
+        If block is before Multicall3 was deployed, False for tags like "latest" and chains without a known deployment.
+        Raises ValueError when block is also before MULTICALL3_OVERRIDE_MIN_BLOCKS, the Multicall3 code can't run there.
+        """
+        chain = chain_id(self.w3)
+        deployment_block = MULTICALL3_DEPLOYMENT_BLOCKS.get(chain)
+        if deployment_block is None or isinstance(block, str) or int(block) >= deployment_block:
+            return False
+        if int(block) < MULTICALL3_OVERRIDE_MIN_BLOCKS[chain]:
+            raise ValueError(
+                f"can't multicall {block=} on {chain=}, Multicall3 was deployed at block {deployment_block} "
+                f"and its code can only be injected from block {MULTICALL3_OVERRIDE_MIN_BLOCKS[chain]}"
+            )
+        return True
+
     def to_call_ids(self, block: int) -> list[str]:
         """Convert all the calls, block ot their call_ids"""
         call_ids = [c.to_id(block) for c in self.calls]
@@ -116,22 +170,34 @@ class Multicall:
         return list([CallRawData(call, block, None, None).to_record() for call in self.calls])
 
     def process_raw_bytes_output(self, raw_bytes_output, block):
-        decoded_outputs = self.multicall_sig.decode_data(raw_bytes_output)[0]
-        # decoded_outputs list[tuple[success, data]]
-        call_raw_data = self._decoded_outputs_to_call_raw_data(decoded_outputs, block)
+        call_raw_data = self.to_call_raw_data(raw_bytes_output, block)
         label_to_output = self._handle_raw_data(call_raw_data)
         label_to_output["block"] = block
         return label_to_output
 
+    def to_call_raw_data(self, raw_bytes_output: bytes, block: int) -> list[CallRawData]:
+        """The CallRawData of each call from what the multicall contract returned at block"""
+        decoded = self.multicall_sig.decode_data(raw_bytes_output)
+        if self.engine == "tryBlockAndAggregate":
+            block_number, block_hash, decoded_outputs = decoded
+            if isinstance(block, int) and block_number != block:
+                raise ValueError(f"asked for {block=} and the node ran the calls on block {block_number}")
+        else:
+            block_hash, decoded_outputs = None, decoded[0]
+        # decoded_outputs list[tuple[success, data]]
+        return self._decoded_outputs_to_call_raw_data(decoded_outputs, block, block_hash)
+
     def get_all_call_ids(self, block: int) -> list[CallRawData]:
         ids = [call.to_id(block) for call in self.calls]
         return ids
 
-    def _decoded_outputs_to_call_raw_data(self, decoded_outputs, block):
+    def _decoded_outputs_to_call_raw_data(self, decoded_outputs, block, block_hash=None):
         call_raw_data = []
         for result, call in zip(decoded_outputs, self.calls):
             success, response = result
-            call_raw_data.append(CallRawData(call=call, block=block, success=success, response=response))
+            call_raw_data.append(
+                CallRawData(call=call, block=block, success=success, response=response, block_hash=block_hash)
+            )
         return call_raw_data
 
     def _handle_raw_data(self, call_raw_data: list[CallRawData]) -> dict[str, any]:
@@ -148,37 +214,42 @@ class Multicall:
 
     ############################### external calls #####################################################3
     async def async_make_each_call_to_raw_call_data(
-        self, w3: Web3, block: int, session: aiohttp.ClientSession, rate_limiter: AsyncLimiter
+        self,
+        w3: Web3,
+        block: int,
+        session: aiohttp.ClientSession,
+        rate_limiter: AsyncLimiter,
+        timings: list[float] | None = None,
     ):
         rpc_args = self.to_rpc_call_args(block)
-        raw_bytes_output = await async_rpc_eth_call(w3, rpc_args, session, rate_limiter)
-        decoded_outputs = self.multicall_sig.decode_data(raw_bytes_output)[0]
-        call_raw_data_list = self._decoded_outputs_to_call_raw_data(decoded_outputs, block)
-        return call_raw_data_list
+        raw_bytes_output = await async_rpc_eth_call(w3, rpc_args, session, rate_limiter, timings)
+        return self.to_call_raw_data(raw_bytes_output, block)
 
-    def make_external_calls_to_raw_data(self, w3: Web3, block: int) -> list[CallRawData]:
-        rpc_args = self.to_rpc_call_args(block)
-        raw_bytes_output = sync_rpc_eth_call(w3, rpc_args)
-        decoded_outputs = self.multicall_sig.decode_data(raw_bytes_output)[0]
-        records = []
-        for call, success_bytes_tuple in zip(self.calls, decoded_outputs):
-            success, response = success_bytes_tuple
-            data = CallRawData(call, block, success, response)
-            records.append(data)
-        return records
+    def make_external_calls_to_raw_data(
+        self, w3: Web3, block: int, timings: list[float] | None = None, block_hash: bytes | None = None
+    ) -> list[CallRawData]:
+        rpc_args = self.to_rpc_call_args(block, block_hash)
+        raw_bytes_output = sync_rpc_eth_call(w3, rpc_args, timings)
+        return self.to_call_raw_data(raw_bytes_output, block)
 
     def __call__(self, block_id: int | str = "latest", cache="default") -> dict[str, any]:
         cache_path = CACHE_PATH if cache == "default" else cache
 
-        if isinstance(block_id, int):
+        finalized = isinstance(block_id, int) and get_finalized_block_tracker(self.w3).is_finalized(block_id)
+        if isinstance(block_id, int) and not finalized and self.engine == "tryBlockAndAggregate":
+            return self._call_pinned_to_block_hash(block_id, cache_path)
+
+        if finalized:
 
             from multicallcache.cache import get_data_from_disk, df_to_CallRawData
 
+            self._promote_pending_results(block_id, cache_path)
+
             # we have everything already, happy path
             found_df, not_found_df = get_data_from_disk(self.calls, [block_id], cache_path)
             if len(not_found_df) == 0:
                 # most happy path we have everything so we can return it
-                all_raw_call_data = df_to_CallRawData(found_df, self.calls, [block_id])
+                all_raw_call_data = df_to_CallRawData(found_df, self.calls)
                 all_label_to_outputs = [data.to_label_to_output() for data in all_raw_call_data]
                 label_to_output = dict()
                 for l_to_o in all_label_to_outputs:
@@ -187,33 +258,67 @@ class Multicall:
                 return label_to_output
 
             # we don't have at least one call, get everything
+            # we should finalize this
+            from multicallcache.fetch_multicall_across_blocks import (
+                simple_sequential_fetch_multicalls_across_blocks_and_save,
+            )
 
-            if block_id < self.w3.eth.get_block("finalized").number:
-                # we should finalize this
-                from multicallcache.fetch_multicall_across_blocks import (
-                    simple_sequential_fetch_multicalls_across_blocks_and_save,
-                )
-
-                simple_sequential_fetch_multicalls_across_blocks_and_save(
-                    calls=self.calls, blocks=[block_id], w3=self.w3, cache_path=cache_path
-                )
-
-                found_df, not_found_df = get_data_from_disk(self.calls, [block_id], cache_path)
-
-                if len(not_found_df) == 0:  # maybe add redundnet check for len(found_df) == len(calls)
-                    # most happy path we have everything so we can return it
-                    all_raw_call_data = df_to_CallRawData(found_df, self.calls, [block_id])
-                    all_label_to_outputs = [data.to_label_to_output() for data in all_raw_call_data]
-                    label_to_output = dict()
-                    for l_to_o in all_label_to_outputs:
-                        label_to_output.update(l_to_o)
-                    label_to_output["block"] = block_id
-                    return label_to_output
-                else:
-                    raise ValueError("Expected to save data and did not find it in the db")
+            simple_sequential_fetch_multicalls_across_blocks_and_save(
+                calls=self.calls, blocks=[block_id], w3=self.w3, cache_path=cache_path, engine=self.engine
+            )
+
+            found_df, not_found_df = get_data_from_disk(self.calls, [block_id], cache_path)
+
+            if len(not_found_df) == 0:  # maybe add redundnet check for len(found_df) == len(calls)
+                # most happy path we have everything so we can return it
+                all_raw_call_data = df_to_CallRawData(found_df, self.calls)
+                all_label_to_outputs = [data.to_label_to_output() for data in all_raw_call_data]
+                label_to_output = dict()
+                for l_to_o in all_label_to_outputs:
+                    label_to_output.update(l_to_o)
+                label_to_output["block"] = block_id
+                return label_to_output
+            else:
+                raise ValueError("Expected to save data and did not find it in the db")
 
         # not finalized and should not be
         rpc_args = self.to_rpc_call_args(block_id)
         raw_bytes_output = sync_rpc_eth_call(self.w3, rpc_args)
         label_to_output = self.process_raw_bytes_output(raw_bytes_output, block_id)
         return label_to_output
+
+    def _call_pinned_to_block_hash(self, block: int, cache_path) -> dict[str, any]:
+        """
+        The calls at a block that is not finalized yet, cached as pending results under the hash of the block.
+
+        The pending results are only read back while that block is still the canonical block at its number,
+        after a reorg the calls are made again and their results replace the ones of the orphaned block.
+        Nothing but this reads pending results, they move to the cache everything else reads once the block
+        is finalized, see _promote_pending_results().
+        The calls are pinned to the canonical block hash (EIP-1898), so a reorg while they run can't mix
+        two blocks, and tryBlockAndAggregate returns the hash of the block they ran on to check it.
+        """
+        from multicallcache.cache import get_pending_data, save_data
+
+        canonical_block_hash = bytes(self.w3.eth.get_block(block).hash)  # makes a http call
+        all_raw_call_data = get_pending_data(self.calls, block, canonical_block_hash, cache_path)
+        if all_raw_call_data is None:
+            all_raw_call_data = self.make_external_calls_to_raw_data(self.w3, block, block_hash=canonical_block_hash)
+            if any(bytes(data.block_hash) != canonical_block_hash for data in all_raw_call_data):
+                raise ValueError(f"the node ran the calls on another block than {canonical_block_hash.hex()=}")
+            save_data(all_raw_call_data, cache_path, pending=True)
+
+        label_to_output = dict()
+        for data in all_raw_call_data:
+            label_to_output.update(data.to_label_to_output())
+        label_to_output["block"] = block
+        return label_to_output
+
+    def _promote_pending_results(self, block: int, cache_path) -> None:
+        """Move the pending results saved at block, now finalized, into the cache if they ran on its canonical hash"""
+        from multicallcache.cache import has_pending_results, promote_pending_results
+
+        chain = chain_id(self.w3)
+        if has_pending_results(chain, block, cache_path):
+            canonical_block_hash = bytes(self.w3.eth.get_block(block).hash)  # makes a http call
+            promote_pending_results(chain, block, canonical_block_hash, cache_path)
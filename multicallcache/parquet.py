@@ -0,0 +1,140 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from multicallcache.cache import FOUND_COLUMNS, split_found_and_not_found
+from multicallcache.call import Call
+from multicallcache.connection import get_connection
+from multicallcache.shards import existing_shard_paths, is_sharded
+from multicallcache.utils import time_function
+
+DEFAULT_BLOCKS_PER_PARTITION = 100_000
+DEFAULT_BATCH_SIZE = 100_000
+DATASET_INFO_FILE = "_multicallcache.json"  # blocks_per_partition of the dataset, read back by get_data_from_parquet
+
+PARQUET_SCHEMA = pa.schema(
+    [
+        ("callHash", pa.binary(32)),
+        ("target", pa.string()),
+        ("signature", pa.string()),
+        ("argumentsAsStr", pa.string()),
+        ("block", pa.int64()),
+        ("success", pa.bool_()),
+        ("response", pa.binary()),
+        ("decoded", pa.binary()),
+        ("chainId", pa.int64()),
+        ("blockRange", pa.int64()),  # first block of the partition
+    ]
+)
+PARTITIONING = ds.partitioning(pa.schema([("chainId", pa.int64()), ("blockRange", pa.int64())]), flavor="hive")
+
+
+@time_function
+def export_cache_to_parquet(
+    cache_path: Path,
+    dataset_dir: Path,
+    blocks_per_partition: int = DEFAULT_BLOCKS_PER_PARTITION,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> None:
+    """
+    Write every cached (call, block) result in cache_path to a parquet dataset in dataset_dir,
+    hive partitioned as chainId=<chainId>/blockRange=<first block>/.
+
+    The db is streamed batch_size rows at a time so the whole cache never has to fit in memory.
+    Rows come out ordered by callHash then block, so each row group covers a narrow callHash range
+    and get_data_from_parquet() can skip most of them from their statistics.
+    Partitions that are written to are replaced, exporting again refreshes the dataset.
+    A sharded cache is exported one shard after the other into the same dataset.
+    """
+    os.makedirs(dataset_dir, exist_ok=True)
+    with open(os.path.join(dataset_dir, DATASET_INFO_FILE), "w") as f:
+        json.dump({"blocks_per_partition": blocks_per_partition}, f)
+
+    def record_batches():
+        for path in existing_shard_paths(cache_path) if is_sharded(cache_path) else [cache_path]:
+            yield from _record_batches(path, blocks_per_partition, batch_size)
+
+    ds.write_dataset(
+        pa.RecordBatchReader.from_batches(PARQUET_SCHEMA, record_batches()),
+        dataset_dir,
+        format="parquet",
+        partitioning=PARTITIONING,
+        basename_template="part-{i}.parquet",
+        existing_data_behavior="delete_matching",
+    )
+
+
+def _record_batches(cache_path: Path, blocks_per_partition: int, batch_size: int):
+    with get_connection(cache_path) as conn:
+        cursor = conn.execute(
+            """
+            SELECT i.callHash, i.target, i.signature, i.argumentsAsStr, r.block, r.success, b.response, b.decoded,
+                i.chainId
+            FROM callIdentity i
+            JOIN callResult r ON r.callKey = i.callKey
+            JOIN responseBlob b ON b.responseKey = r.responseKey
+            ORDER BY i.callHash, r.block
+            """
+        )
+        while rows := cursor.fetchmany(batch_size):
+            columns = list(zip(*rows))
+            blocks = np.asarray(columns[4], dtype=np.int64)
+            yield pa.RecordBatch.from_arrays(
+                [
+                    pa.array(columns[0], type=pa.binary(32)),
+                    pa.array(columns[1], type=pa.string()),
+                    pa.array(columns[2], type=pa.string()),
+                    pa.array(columns[3], type=pa.string()),
+                    pa.array(blocks),
+                    pa.array(np.asarray(columns[5], dtype=bool)),
+                    pa.array(columns[6], type=pa.binary()),
+                    pa.array(columns[7], type=pa.binary()),
+                    pa.array(columns[8], type=pa.int64()),
+                    pa.array(blocks - blocks % blocks_per_partition),
+                ],
+                schema=PARQUET_SCHEMA,
+            )
+
+
+@time_function
+def get_data_from_parquet(calls: list[Call], blocks: list[int], dataset_dir: Path) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Look up every (call, block) pair in a dataset written by export_cache_to_parquet().
+    Returns found_df and not_found_df in the same shape as cache.get_data_from_disk().
+
+    Only the partitions of the requested chains and block ranges are opened, and only the callHash,
+    block, success, response and decoded columns of the row groups whose statistics can match are read.
+    """
+    blocks = list(dict.fromkeys(int(b) for b in blocks))
+    with open(os.path.join(dataset_dir, DATASET_INFO_FILE)) as f:
+        blocks_per_partition = json.load(f)["blocks_per_partition"]
+
+    call_indexes_by_hash: dict[bytes, list[int]] = {}
+    for call_index, call in enumerate(calls):
+        call_indexes_by_hash.setdefault(call.to_key(), []).append(call_index)
+
+    chain_ids = list({call.get_chain_id() for call in calls})
+    block_ranges = list({block - block % blocks_per_partition for block in blocks})
+    dataset = ds.dataset(dataset_dir, format="parquet", partitioning=PARTITIONING)
+    table = dataset.to_table(
+        columns=["callHash", "block", "success", "response", "decoded"],
+        filter=(
+            ds.field("chainId").isin(chain_ids)
+            & ds.field("blockRange").isin(block_ranges)
+            & ds.field("callHash").isin(pa.array(list(call_indexes_by_hash), type=pa.binary(32)))
+            & ds.field("block").isin(blocks)
+        ),
+    )
+
+    rows_df = table.to_pandas()
+    call_indexes_df = pd.DataFrame(
+        [(call_hash, i) for call_hash, indexes in call_indexes_by_hash.items() for i in indexes],
+        columns=["callHash", "callIndex"],
+    )
+    found_df = rows_df.merge(call_indexes_df, on="callHash")[FOUND_COLUMNS]
+    return split_found_and_not_found(found_df, len(calls), blocks)
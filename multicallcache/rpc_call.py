@@ -9,64 +9,182 @@ import requests
 
 RETRY_COUNT = 3  # Number of retries for the HTTP request
 
+# lowercase parts of the json rpc error messages nodes answer an eth_call with, by what went wrong
+OUT_OF_GAS_MESSAGES = ("out of gas", "gas required exceeds", "exceeds block gas limit", "gas limit reached")
+TOO_LARGE_MESSAGES = ("too large", "larger than", "size exceeded", "response size", "request entity")
+TIMEOUT_MESSAGES = ("timeout", "timed out", "execution aborted")
 
-async def async_rpc_eth_call(w3: HTTPProvider, rpc_args, session: aiohttp.ClientSession, rate_limiter: AsyncLimiter):
+
+class RpcCallFailed(Exception):
+    """The node could not answer an rpc call"""
+
+
+class PayloadTooLarge(RpcCallFailed):
+    """HTTP 413, or the node refused the size of the request or of its response"""
+
+
+class OutOfGas(RpcCallFailed):
+    """The eth_call ran out of gas"""
+
+
+class RpcTimeout(RpcCallFailed):
+    """The node reported that the call ran out of time, or left it out of its answer to a batch"""
+
+
+# a multicall that fails with one of these can be split into smaller multicalls that succeed.
+# They are all what the node answered, a request that gets no answer is retried as is, see _async_post()
+SPLITTABLE_ERRORS = (PayloadTooLarge, OutOfGas, RpcTimeout)
+
+
+def _result_or_raise(data: dict) -> bytes:
+    """The bytes returned by a json rpc eth_call, or the RpcCallFailed its error message describes"""
+    if "error" in data:
+        error = data["error"]
+        message = str(error.get("message", error)) if isinstance(error, dict) else str(error)
+        lowercase_message = message.lower()
+        if any(m in lowercase_message for m in OUT_OF_GAS_MESSAGES):
+            raise OutOfGas(message)
+        if any(m in lowercase_message for m in TOO_LARGE_MESSAGES):
+            raise PayloadTooLarge(message)
+        if any(m in lowercase_message for m in TIMEOUT_MESSAGES):
+            raise RpcTimeout(message)
+        raise RpcCallFailed(message)
+    return bytes.fromhex(data["result"][2:])
+
+
+def _batch_results(answers: list[dict] | dict, num_requests: int) -> list[bytes | RpcCallFailed]:
+    """
+    The answers to a json rpc batch of num_requests eth_calls with ids 0 to num_requests - 1, in the order of the ids.
+    Each is the returned bytes or the RpcCallFailed of its error. A request the node left out of the batch is
+    an RpcTimeout so it is retried on its own. A single error object instead of a list is about the whole batch and raised.
+    """
+    if isinstance(answers, dict):
+        _result_or_raise(answers)
+        raise RpcCallFailed(f"expected a list of answers to a batch, got {answers}")
+    results: list[bytes | RpcCallFailed] = [RpcTimeout("no answer to this request in the batch")] * num_requests
+    for answer in answers:
+        request_id = answer.get("id")
+        if not isinstance(request_id, int) or not 0 <= request_id < num_requests:
+            continue
+        try:
+            results[request_id] = _result_or_raise(answer)
+        except RpcCallFailed as e:
+            results[request_id] = e
+    return results
+
+
+async def async_rpc_eth_call(
+    w3: HTTPProvider,
+    rpc_args,
+    session: aiohttp.ClientSession,
+    rate_limiter: AsyncLimiter,
+    timings: list[float] | None = None,
+):
+    """
+    The bytes returned by the eth_call rpc_args. If timings is passed the seconds the successful
+    request took are appended to it, not counting the wait for rate_limiter.
+    """
+    data = json.dumps({"params": rpc_args, "method": "eth_call", "id": 1, "jsonrpc": "2.0"})
+    return _result_or_raise(await _async_post(w3, data, session, rate_limiter, 1, timings))
+
+
+async def async_rpc_eth_call_batch(
+    w3: HTTPProvider,
+    all_rpc_args: list,
+    session: aiohttp.ClientSession,
+    rate_limiter: AsyncLimiter,
+    timings: list[float] | None = None,
+) -> list[bytes | RpcCallFailed]:
+    """
+    One eth_call per rpc_args sent in a single json rpc batch, so they share one http request.
+    Returns what each eth_call returned or the RpcCallFailed it failed with, in the order of all_rpc_args
+    whatever order the node answered in. Failures of the batch as a whole raise, like async_rpc_eth_call.
+    Each eth_call counts against rate_limiter, providers meter the calls in a batch one by one.
+    """
+    data = json.dumps(
+        [
+            {"params": rpc_args, "method": "eth_call", "id": request_id, "jsonrpc": "2.0"}
+            for request_id, rpc_args in enumerate(all_rpc_args)
+        ]
+    )
+    answers = await _async_post(w3, data, session, rate_limiter, len(all_rpc_args), timings)
+    return _batch_results(answers, len(all_rpc_args))
+
+
+async def _async_post(
+    w3: HTTPProvider,
+    data: str,
+    session: aiohttp.ClientSession,
+    rate_limiter: AsyncLimiter,
+    num_requests: int,
+    timings: list[float] | None,
+) -> list[dict] | dict:
+    """POST the json rpc request data, worth num_requests against rate_limiter, and return the parsed answer"""
     # Note not very robust to rate limiting problems
     # TODO make more robust
-    async with rate_limiter:
-        for attempt in range(RETRY_COUNT):
-            try:
-                async with session.post(
-                    w3.provider.endpoint_uri,
-                    headers={"content-type": "application/json"},
-                    data=json.dumps(
-                        {
-                            "params": rpc_args,
-                            "method": "eth_call",
-                            "id": 1,
-                            "jsonrpc": "2.0",
-                        }
-                    ),
-                    timeout=20,  # consider making this a parameter
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return bytes.fromhex(data["result"][2:])
-                    elif response.status == 413:
-                        print("the payload is too large, you need to have less calls per multicall")
-                        response.raise_for_status()
-
-                    elif (response.status == 429) and (attempt < RETRY_COUNT - 1):
-                        print(
-                            f"429 error, waiting to retry, exceeded alchemy compute units /s {attempt=} with {rate_limiter.max_rate=} rpc calls / second"
-                        )
-                        await asyncio.sleep(2**attempt)
-            except Exception as e:
-                if attempt < RETRY_COUNT - 1:
-                    print(str(e), type(e), attempt, "now sleeping")
+    for acquired in range(0, num_requests, max(1, int(rate_limiter.max_rate))):
+        # one token per request, acquire() can't take more than max_rate at once
+        await rate_limiter.acquire(min(num_requests - acquired, rate_limiter.max_rate))
+    for attempt in range(RETRY_COUNT):
+        started_at = time.monotonic()
+        try:
+            async with session.post(
+                w3.provider.endpoint_uri,
+                headers={"content-type": "application/json"},
+                data=data,
+                timeout=20,  # consider making this a parameter
+            ) as response:
+                if response.status == 200:
+                    answer = await response.json()
+                    if timings is not None:
+                        timings.append(time.monotonic() - started_at)
+                    return answer
+                elif response.status == 413:
+                    raise PayloadTooLarge("the payload is too large, you need to have less calls per multicall")
+
+                elif (response.status == 429) and (attempt < RETRY_COUNT - 1):
+                    print(
+                        f"429 error, waiting to retry, exceeded alchemy compute units /s {attempt=} with {rate_limiter.max_rate=} rpc calls / second"
+                    )
                     await asyncio.sleep(2**attempt)
                 else:
-                    raise e
+                    response.raise_for_status()
+        except RpcCallFailed:
+            raise
+        except Exception as e:
+            # also asyncio.TimeoutError, not hearing back is more often the network than the size of the multicall
+            if attempt < RETRY_COUNT - 1:
+                print(str(e), type(e), attempt, "now sleeping")
+                await asyncio.sleep(2**attempt)
+            else:
+                raise e
 
     raise ValueError("should never get here")
 
 
-def sync_rpc_eth_call(w3, rpc_args):
+def sync_rpc_eth_call(w3, rpc_args, timings: list[float] | None = None):
     endpoint_uri = w3.provider.endpoint_uri  # Assuming this is accessible like this
     headers = {"content-type": "application/json"}
     data = json.dumps({"params": rpc_args, "method": "eth_call", "id": 1, "jsonrpc": "2.0"})
 
     for attempt in range(RETRY_COUNT):
+        started_at = time.monotonic()
         try:
             response = requests.post(endpoint_uri, headers=headers, data=data, timeout=10)
-        except TimeoutError:
-            continue
+        except requests.exceptions.Timeout as e:
+            # retried as is like in _async_post(), only the timeouts the node reports split the multicall
+            if attempt < RETRY_COUNT - 1:
+                print(str(e), type(e), attempt, "now sleeping")
+                time.sleep(2**attempt)
+                continue
+            raise e
         if response.status_code == 200:
-            data = response.json()
-            return bytes.fromhex(data["result"][2:])
+            result = _result_or_raise(response.json())
+            if timings is not None:
+                timings.append(time.monotonic() - started_at)
+            return result
         elif response.status_code == 413:
-            print("the payload is too large, you need to break up the calls")
-            raise Exception("Payload too large")
+            raise PayloadTooLarge("the payload is too large, you need to break up the calls")
         elif response.status_code == 429 and attempt < RETRY_COUNT - 1:
             print(f"429 error, waiting to retry, attempt {attempt}")
             time.sleep(2**attempt)  # Exponential backoff
@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+from typing import Callable, TypeVar
+
+SHARDS_CONFIG_FILE = "shards.json"
+DEFAULT_BLOCKS_PER_SHARD = 1_000_000
+# sqlite releases the GIL while it runs a query, so threads are enough to read several shards at once
+MAX_SHARD_THREADS = min(32, os.cpu_count() or 1)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_shards_configs: dict[str, dict] = {}  # sharded cache dir -> its config, read once from SHARDS_CONFIG_FILE
+
+
+def is_sharded(cache_path: Path) -> bool:
+    """A sharded cache is a directory made by create_sharded_db(), a plain cache is a single sqlite file"""
+    return os.path.isdir(cache_path)
+
+
+def write_shards_config(cache_path: Path, blocks_per_shard: int, bloom_filter: dict | None = None) -> None:
+    """bloom_filter is the capacity and false_positive_rate every shard's bloom filter is made with, if they have one"""
+    config = {"blocks_per_shard": blocks_per_shard}
+    if bloom_filter is not None:
+        config["bloom_filter"] = bloom_filter
+    with open(os.path.join(cache_path, SHARDS_CONFIG_FILE), "w") as f:
+        json.dump(config, f)
+    _shards_configs[os.path.abspath(str(cache_path))] = config
+
+
+def get_shards_config(cache_path: Path) -> dict:
+    key = os.path.abspath(str(cache_path))
+    if key not in _shards_configs:
+        with open(os.path.join(cache_path, SHARDS_CONFIG_FILE)) as f:
+            _shards_configs[key] = json.load(f)
+    return _shards_configs[key]
+
+
+def get_blocks_per_shard(cache_path: Path) -> int:
+    return get_shards_config(cache_path)["blocks_per_shard"]
+
+
+def forget_shards_config(cache_path: Path) -> None:
+    _shards_configs.pop(os.path.abspath(str(cache_path)), None)
+
+
+def shard_start(block: int, blocks_per_shard: int) -> int:
+    return block - block % blocks_per_shard
+
+
+def shard_path(cache_path: Path, chain: int, block: int) -> Path:
+    """The shard of cache_path that holds the results of chain at block, eg chain_1/blocks_18000000_18999999.sqlite"""
+    blocks_per_shard = get_blocks_per_shard(cache_path)
+    start = shard_start(block, blocks_per_shard)
+    return Path(cache_path) / f"chain_{chain}" / f"blocks_{start}_{start + blocks_per_shard - 1}.sqlite"
+
+
+def existing_shard_paths(cache_path: Path) -> list[Path]:
+    return sorted(Path(cache_path).glob("chain_*/blocks_*.sqlite"))
+
+
+def existing_shards_in_block_range(cache_path: Path, chain: int, from_block: int, to_block: int) -> list[Path]:
+    blocks_per_shard = get_blocks_per_shard(cache_path)
+    starts = range(shard_start(from_block, blocks_per_shard), to_block + 1, blocks_per_shard)
+    return [path for path in (shard_path(cache_path, chain, start) for start in starts) if os.path.exists(path)]
+
+
+def map_over_shards(func: Callable[[T], R], items: list[T]) -> list[R]:
+    """[func(item) for item in items], run in parallel threads when there is more than one shard to touch"""
+    if len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(len(items), MAX_SHARD_THREADS)) as executor:
+        return list(executor.map(func, items))
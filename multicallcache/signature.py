@@ -1,9 +1,10 @@
-from typing import Any, List, Optional, Tuple
-import eth_abi
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from eth_abi.decoding import ContextFramesBytesIO
+from eth_abi.exceptions import DecodingError, ParseError
+from eth_abi.grammar import BasicType, TupleType, parse
+from eth_abi.registry import registry
 from eth_typing.abi import Decodable
-from eth_utils import function_signature_to_4byte_selector
-
-import warnings
+from eth_utils import function_signature_to_4byte_selector, is_bytes
 
 # TODO: switch to the latest version of eth_abi for eth_abi.abi.encode and eth_abi.abi.encode
 # requires changing parse_signature()
@@ -44,21 +45,140 @@ class Signature:
         self.signature = signature
         self.function, self.input_types, self.output_types = parse_signature(signature)
         self.fourbyte = function_signature_to_4byte_selector(self.function)
+        # what eth_abi.encode_single and decode_single look up on every call, without their deprecation warnings
+        self._encoder = registry.get_encoder(self.input_types)
+        self._decoder = registry.get_decoder(self.output_types)
+        self._word_decoders = _static_word_decoders(self.output_types)
+
+    def __reduce__(self):
+        # sent to other processes as the signature string, and interned again there
+        return get_signature, (self.signature,)
 
     def encode_data(self, args: Optional[Any] = None) -> bytes:
         # TODO: add error catching
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", category=DeprecationWarning, module="eth_abi.codec")
-
-            if args is not None:
-                args_encoded_with_types = eth_abi.encode_single(self.input_types, args)
-                return self.fourbyte + args_encoded_with_types
-            else:
-                return self.fourbyte
+        if args is not None:
+            args_encoded_with_types = self._encoder(args)
+            return self.fourbyte + args_encoded_with_types
+        else:
+            return self.fourbyte
 
     def decode_data(self, output: Decodable) -> Any:
         # TODO: add error catching
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", category=DeprecationWarning, module="eth_abi.codec")
-            decoded_output = eth_abi.decode_single(self.output_types, output)
-            return decoded_output
+        if not is_bytes(output):
+            raise TypeError(f"The `output` value must be of bytes type. Got {type(output)}")
+        return self._decoder(ContextFramesBytesIO(output))
+
+    def decode_many(self, outputs: Sequence[Decodable]) -> List[Optional[Any]]:
+        """
+        decode_data() of every output, None for the outputs that do not decode as the output types.
+        When the output types are all static, eg (uint256) or (address,bool), each 32 byte word is
+        read directly instead of going through eth_abi. Words eth_abi would reject, eg non zero padding,
+        are left to decode_data() so they fail the same way.
+        """
+        word_decoders = self._word_decoders
+        single_word_decoder = word_decoders[0] if word_decoders is not None and len(word_decoders) == 1 else None
+        decoded_outputs = []
+        for output in outputs:
+            if type(output) is not bytes:
+                output = bytes(output)  # eg HexBytes, whose slices and hex() differ from bytes
+            decoded = _NOT_STATIC
+            if single_word_decoder is not None and len(output) >= 32:
+                value = single_word_decoder(output[:32])
+                if value is not _NOT_STATIC:
+                    decoded = (value,)
+            elif word_decoders is not None and len(output) >= 32 * len(word_decoders):
+                decoded = tuple(decode(output[32 * i : 32 * i + 32]) for i, decode in enumerate(word_decoders))
+                if any(value is _NOT_STATIC for value in decoded):
+                    decoded = _NOT_STATIC
+            if decoded is _NOT_STATIC:
+                try:
+                    decoded = self.decode_data(output)
+                except DecodingError:
+                    decoded = None
+            decoded_outputs.append(decoded)
+        return decoded_outputs
+
+
+_NOT_STATIC = object()  # returned by a word decoder for a word that has to go through eth_abi
+_ZERO_WORD = bytes(32)
+
+
+def _static_word_decoders(output_types: str) -> Optional[List[Callable[[bytes], Any]]]:
+    """
+    One function per 32 byte word of output_types that returns what eth_abi decodes the word to, or _NOT_STATIC.
+    None unless every output type is a static uint, int, address, bool or bytes1..32.
+    """
+    try:
+        abi_type = parse(output_types)
+    except ParseError:
+        return None
+    if not isinstance(abi_type, TupleType) or abi_type.arrlist or len(abi_type.components) == 0:
+        return None
+    word_decoders = []
+    for component in abi_type.components:
+        if not isinstance(component, BasicType) or component.arrlist:
+            return None
+        word_decoder = _static_word_decoder(component.base, component.sub)
+        if word_decoder is None:
+            return None
+        word_decoders.append(word_decoder)
+    return word_decoders
+
+
+def _static_word_decoder(base: str, sub: Any) -> Optional[Callable[[bytes], Any]]:
+    if base == "uint" and isinstance(sub, int):
+        padding = 32 - sub // 8
+
+        def decode_uint(word: bytes) -> Any:
+            return int.from_bytes(word, "big") if word[:padding] == _ZERO_WORD[:padding] else _NOT_STATIC
+
+        return decode_uint
+
+    if base == "int" and isinstance(sub, int):
+        low, high = -(1 << (sub - 1)), 1 << (sub - 1)
+
+        def decode_int(word: bytes) -> Any:
+            value = int.from_bytes(word, "big", signed=True)
+            return value if low <= value < high else _NOT_STATIC  # out of range means bad sign extension
+
+        return decode_int
+
+    if base == "address":
+
+        def decode_address(word: bytes) -> Any:
+            return "0x" + word[12:].hex() if word[:12] == _ZERO_WORD[:12] else _NOT_STATIC
+
+        return decode_address
+
+    if base == "bool":
+
+        def decode_bool(word: bytes) -> Any:
+            if word == _ZERO_WORD:
+                return False
+            return True if word[31] == 1 and word[:31] == _ZERO_WORD[:31] else _NOT_STATIC
+
+        return decode_bool
+
+    if base == "bytes" and isinstance(sub, int):
+
+        def decode_bytes(word: bytes) -> Any:
+            return word[:sub] if word[sub:] == _ZERO_WORD[sub:] else _NOT_STATIC
+
+        return decode_bytes
+
+    return None
+
+
+_signatures: Dict[str, Signature] = {}
+
+
+def get_signature(signature: str) -> Signature:
+    """
+    The shared Signature of a signature string, parsed once no matter how many calls use it.
+    Signatures are never mutated after they are made, so every Call can hold the same one.
+    """
+    try:
+        return _signatures[signature]
+    except KeyError:
+        _signatures[signature] = Signature(signature)
+        return _signatures[signature]
@@ -1,11 +1,20 @@
-from typing import Any, Dict, Iterable, List
+from typing import Any, Dict, Iterable, List, Optional
+import hashlib
+import json
+import os
+from urllib.parse import urlparse
 
 import eth_retry
 from web3 import Web3
 
 import time
 
+from multicallcache import constants
+
 chainids: Dict[Web3, int] = {}
+# sha256 of an endpoint -> its chain id, read once from constants.CHAIN_IDS_PATH. Hashed so api keys in urls stay off disk
+_saved_chainids: Optional[Dict[str, int]] = None
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "0.0.0.0", "::1")
 
 
 def flatten(nested_list: list):
@@ -27,14 +36,65 @@ def chunks(lst: List, n: int):
 def chain_id(w3: Web3) -> int:
     """
     Returns chain id for an instance of Web3. Helps save repeat calls to node.
+    The chain id of a remote endpoint is also saved to disk, so later runs don't ask the node again.
     """
     try:
         return chainids[w3]
     except KeyError:
-        chainids[w3] = w3.eth.chain_id  # makes a http call
+        endpoint_key = _saved_chain_id_key(w3)
+        saved_chainids = _load_saved_chain_ids()
+        if endpoint_key is not None and endpoint_key in saved_chainids:
+            chainids[w3] = saved_chainids[endpoint_key]
+        else:
+            chainids[w3] = w3.eth.chain_id  # makes a http call
+            if endpoint_key is not None:
+                _save_chain_id(endpoint_key, chainids[w3])
         return chainids[w3]
 
 
+def _saved_chain_id_key(w3: Web3) -> Optional[str]:
+    """None for endpoints that aren't saved, a local node can be restarted as a fork of another chain"""
+    try:
+        endpoint = get_endpoint(w3)
+    except AttributeError:
+        return None  # eg an IPC provider
+    if not endpoint or urlparse(endpoint).hostname in LOCAL_HOSTS:
+        return None
+    return hashlib.sha256(endpoint.encode("utf-8")).hexdigest()
+
+
+def _load_saved_chain_ids() -> Dict[str, int]:
+    global _saved_chainids
+    if _saved_chainids is None:
+        try:
+            with open(constants.CHAIN_IDS_PATH) as f:
+                _saved_chainids = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            _saved_chainids = {}
+    return _saved_chainids
+
+
+def _save_chain_id(endpoint_key: str, chain: int) -> None:
+    saved_chainids = _load_saved_chain_ids()
+    saved_chainids[endpoint_key] = chain
+    tmp_path = f"{constants.CHAIN_IDS_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(saved_chainids, f)
+        os.replace(tmp_path, constants.CHAIN_IDS_PATH)  # readers never see a half written file
+    except OSError:
+        pass  # eg a read only install, the chain id is still cached for this process
+
+
+def forget_saved_chain_ids() -> None:
+    """Delete the chain ids saved to disk, eg after pointing an endpoint at a different chain"""
+    global _saved_chainids
+    _saved_chainids = None
+    chainids.clear()
+    if os.path.exists(constants.CHAIN_IDS_PATH):
+        os.remove(constants.CHAIN_IDS_PATH)
+
+
 def get_endpoint(w3: Web3) -> str:
     provider = w3.provider
     if isinstance(provider, str):
@@ -44,6 +104,14 @@ def get_endpoint(w3: Web3) -> str:
     return provider.endpoint_uri
 
 
+def provider_key(w3: Web3) -> str:
+    """The endpoint of w3, or an id of its provider when it has none, eg IPC. Shared by Web3 instances on it."""
+    try:
+        return get_endpoint(w3)
+    except AttributeError:
+        return f"provider at {id(w3.provider)}"
+
+
 def raise_if_exception(obj: Any) -> None:
     if isinstance(obj, Exception):
         raise obj
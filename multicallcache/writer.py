@@ -0,0 +1,114 @@
+import asyncio
+from pathlib import Path
+import queue
+import threading
+import time
+
+from multicallcache.cache import save_data
+from multicallcache.multicall import CallRawData
+
+DEFAULT_BATCH_SIZE = 10_000  # rows per transaction
+DEFAULT_FLUSH_INTERVAL = 1.0  # seconds a row waits for its batch to fill before it is committed anyway
+DEFAULT_MAX_QUEUED = (
+    1_000  # put() blocks, and async_put() waits, once this many lists of results are waiting to be written
+)
+
+_STOP = object()
+
+
+class BackgroundWriter:
+    """
+    Saves CallRawData to cache_path from a background thread while the caller keeps fetching.
+
+    Results are committed in transactions of about batch_size rows, or after flush_interval seconds if they
+    trickle in slower than that. Use it as a context manager: leaving the block waits until everything put()
+    so far is committed, also when it is left because of an exception or a KeyboardInterrupt, so a failed
+    backfill keeps what it already fetched and a rerun only fetches the rest.
+    """
+
+    def __init__(
+        self,
+        cache_path: Path,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        max_queued: int = DEFAULT_MAX_QUEUED,
+    ) -> None:
+        self.cache_path = cache_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows_saved = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self._error: Exception | None = None
+        self._thread = threading.Thread(target=self._run, name="multicallcache-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, data: list[CallRawData]) -> None:
+        """Queue data to be saved, raises the error of an earlier failed save"""
+        self._raise_if_failed()
+        self._queue.put(data)
+
+    async def async_put(self, data: list[CallRawData]) -> None:
+        """
+        put() for coroutines. When the queue is full it waits in a worker thread, so the event loop and the
+        requests in flight on it keep running while the writer catches up.
+        """
+        self._raise_if_failed()
+        try:
+            self._queue.put_nowait(data)
+        except queue.Full:
+            await asyncio.get_running_loop().run_in_executor(None, self.put, data)
+
+    def close(self) -> None:
+        """Commit everything queued and stop the writer thread"""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._raise_if_failed()
+
+    def __enter__(self) -> "BackgroundWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            try:
+                self.close()
+            except Exception:
+                pass  # don't hide the exception that is already propagating
+
+    def _raise_if_failed(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _run(self) -> None:
+        pending: list[CallRawData] = []
+        deadline = None  # when the oldest pending row has waited flush_interval
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._save(pending)
+                return
+            if item is not None:
+                pending.extend(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if len(pending) >= self.batch_size or (deadline is not None and time.monotonic() >= deadline):
+                self._save(pending)
+                pending = []
+                deadline = None
+
+    def _save(self, data: list[CallRawData]) -> None:
+        if len(data) == 0 or self._error is not None:
+            return  # after a failure the queue is still drained so put() never blocks forever
+        try:
+            save_data(data, self.cache_path)
+            self.rows_saved += len(data)
+        except Exception as e:
+            self._error = e
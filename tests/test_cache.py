@@ -1,7 +1,45 @@
-from multicallcache.cache import isCached
-from multicallcache.multicall import Multicall
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
 
-from helpers import weth_bal, usdc_bal, refresh_testing_db, TEST_BLOCK
+import pytest
+
+from multicallcache.cache import (
+    isCached,
+    get_data_from_disk,
+    migrate_db,
+    get_db_size,
+    delete_db,
+    delete_call,
+    dump_decoded,
+    get_cached_blocks,
+    get_cached_data_in_block_range,
+    create_bloom_filter,
+    create_sharded_db,
+    forget_block,
+    get_block_hash,
+    get_pending_data,
+    has_pending_results,
+    load_decoded,
+    promote_pending_results,
+    save_data,
+)
+from multicallcache.bloom import BloomFilter, get_bloom_filter
+from multicallcache.fetch_multicall_across_blocks import fetch_save_and_return
+from multicallcache.multicall import CallRawData, Multicall
+from multicallcache.connection import get_connection, close_connections
+from multicallcache.memory_cache import enable_memory_cache, disable_memory_cache
+from multicallcache.parquet import export_cache_to_parquet, get_data_from_parquet
+from multicallcache.shards import existing_shard_paths
+from multicallcache import bloom as bloom_module, cache as cache_module, writer as writer_module
+from multicallcache.writer import BackgroundWriter
+
+from helpers import weth_bal, usdc_bal, target_has_no_code, refresh_testing_db, TEST_BLOCK, test_data_path
 from multicallcache.constants import TEST_CACHE_PATH, W3
 
 
@@ -36,3 +74,375 @@ def test_Multicall__call__caches_only_finalized_blocks():
     multi(latest_block, TEST_CACHE_PATH)  # don't cache a call on the latest, non finalized block
     assert not isCached(weth_bal, latest_block, TEST_CACHE_PATH)
     assert not isCached(usdc_bal, latest_block, TEST_CACHE_PATH)
+
+
+@refresh_testing_db
+def test_connections_are_pooled_per_thread():
+    conn = get_connection(TEST_CACHE_PATH)
+    assert conn is get_connection(TEST_CACHE_PATH)
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    other_thread = ThreadPoolExecutor(1)
+    other_thread_conn = other_thread.submit(get_connection, TEST_CACHE_PATH).result()
+    assert other_thread_conn is not conn
+
+    close_connections(TEST_CACHE_PATH)
+    assert get_connection(TEST_CACHE_PATH) is not conn
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute("SELECT 1")
+    # another thread's connection is left to it, it swaps it for a new one the next time it asks
+    assert other_thread.submit(lambda: other_thread_conn.execute("SELECT 1").fetchone()).result() == (1,)
+    assert other_thread.submit(get_connection, TEST_CACHE_PATH).result() is not other_thread_conn
+    with pytest.raises(sqlite3.ProgrammingError):
+        other_thread.submit(other_thread_conn.execute, "SELECT 1").result()
+    other_thread.shutdown()
+
+
+@refresh_testing_db
+def test_get_data_from_disk_splits_hits_and_misses():
+    weth_bal(TEST_BLOCK, TEST_CACHE_PATH)
+
+    found_df, not_found_df = get_data_from_disk([weth_bal, usdc_bal], [TEST_BLOCK, TEST_BLOCK + 1], TEST_CACHE_PATH)
+
+    assert found_df[["callIndex", "block"]].values.tolist() == [[0, TEST_BLOCK]]
+    assert not_found_df[["callIndex", "block"]].values.tolist() == [
+        [1, TEST_BLOCK],
+        [0, TEST_BLOCK + 1],
+        [1, TEST_BLOCK + 1],
+    ]
+
+
+def _make_flat_multicall_cache(old_db_path):
+    with sqlite3.connect(old_db_path) as conn:
+        conn.execute(
+            """
+            CREATE TABLE multicallCache (
+                callId BLOB PRIMARY KEY, target TEXT, signature TEXT, argumentsAsStr TEXT, argumentsAsPickle bytes,
+                block INTEGER, chainId INTEGER, success BOOLEAN, response BLOB
+            )
+            """
+        )
+        conn.execute(
+            "INSERT INTO multicallCache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                weth_bal.to_id(TEST_BLOCK),
+                weth_bal.target,
+                weth_bal.signature.signature,
+                str(weth_bal.arguments),
+                pickle.dumps(weth_bal.arguments),
+                TEST_BLOCK,
+                1,
+                True,
+                (10).to_bytes(32, "big"),
+            ),
+        )
+    conn.close()
+
+
+def test_migrate_db_from_flat_multicall_cache():
+    old_db_path = test_data_path / "old_multicallCache.sqlite"
+    _make_flat_multicall_cache(old_db_path)
+
+    try:
+        with pytest.raises(ValueError, match="migrate_db"):
+            isCached(weth_bal, TEST_BLOCK, old_db_path)
+        migrate_db(old_db_path)
+        assert get_db_size(old_db_path) == 1
+        assert isCached(weth_bal, TEST_BLOCK, old_db_path)
+        assert weth_bal(TEST_BLOCK, old_db_path) == {"weth_bal": "10"}
+    finally:
+        delete_db(old_db_path)
+
+
+def test_interrupted_migration_leaves_the_flat_cache_to_migrate_again(monkeypatch):
+    old_db_path = test_data_path / "old_multicallCache.sqlite"
+    _make_flat_multicall_cache(old_db_path)
+
+    def interrupted(signature, response):
+        raise KeyboardInterrupt
+
+    try:
+        with monkeypatch.context() as m:
+            m.setattr(cache_module, "_response_hash_from_signature", interrupted)
+            with pytest.raises(sqlite3.OperationalError):
+                migrate_db(old_db_path)
+
+        with sqlite3.connect(old_db_path) as conn:
+            assert conn.execute("PRAGMA user_version").fetchone()[0] == 0
+            tables = [name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        conn.close()
+        assert tables == ["multicallCache"]  # the tables created before the interruption were rolled back
+
+        migrate_db(old_db_path)
+        assert weth_bal(TEST_BLOCK, old_db_path) == {"weth_bal": "10"}
+    finally:
+        delete_db(old_db_path)
+
+
+@refresh_testing_db
+def test_block_range_queries():
+    blocks = [TEST_BLOCK, TEST_BLOCK + 1, TEST_BLOCK + 5]
+    fetch_save_and_return([weth_bal], blocks, W3, 10, cache=TEST_CACHE_PATH)
+
+    assert get_cached_blocks(weth_bal, TEST_BLOCK, TEST_BLOCK + 10, TEST_CACHE_PATH) == blocks
+    assert get_cached_blocks(weth_bal, TEST_BLOCK + 1, TEST_BLOCK + 4, TEST_CACHE_PATH) == [TEST_BLOCK + 1]
+    assert get_cached_blocks(usdc_bal, TEST_BLOCK, TEST_BLOCK + 10, TEST_CACHE_PATH) == []
+
+    df = get_cached_data_in_block_range(weth_bal, TEST_BLOCK, TEST_BLOCK + 10, TEST_CACHE_PATH)
+    assert df["block"].tolist() == blocks
+    assert df["success"].all()
+
+    # dense requests are range scanned, sparse ones are seeked, both have to agree
+    dense_found_df, dense_not_found_df = get_data_from_disk(
+        [weth_bal], range(TEST_BLOCK, TEST_BLOCK + 6), TEST_CACHE_PATH
+    )
+    sparse_found_df, sparse_not_found_df = get_data_from_disk([weth_bal], blocks + [TEST_BLOCK + 1000], TEST_CACHE_PATH)
+    assert dense_found_df.equals(sparse_found_df)
+    assert dense_not_found_df["block"].tolist() == [TEST_BLOCK + 2, TEST_BLOCK + 3, TEST_BLOCK + 4]
+    assert sparse_not_found_df["block"].tolist() == [TEST_BLOCK + 1000]
+
+
+@refresh_testing_db
+def test_memory_cache_in_front_of_sqlite():
+    memory_cache = enable_memory_cache(max_bytes=10_000)
+    try:
+        first = weth_bal(TEST_BLOCK, TEST_CACHE_PATH)
+        close_connections(TEST_CACHE_PATH)
+        hits_before = memory_cache.stats()["hits"]
+        assert weth_bal(TEST_BLOCK, TEST_CACHE_PATH) == first
+        assert memory_cache.stats()["hits"] == hits_before + 1
+
+        found_df, not_found_df = get_data_from_disk([weth_bal], [TEST_BLOCK], TEST_CACHE_PATH)
+        assert len(found_df) == 1 and len(not_found_df) == 0
+
+        assert delete_call(weth_bal, TEST_BLOCK, TEST_CACHE_PATH)
+        assert not isCached(weth_bal, TEST_BLOCK, TEST_CACHE_PATH)
+
+        # a result that is already saved is kept, the memory cache must not answer with the refetched one
+        save_data([CallRawData(weth_bal, TEST_BLOCK, True, (1).to_bytes(32, "big"))], TEST_CACHE_PATH)
+        memory_cache.remove(TEST_CACHE_PATH, weth_bal.to_id(TEST_BLOCK))
+        save_data([CallRawData(weth_bal, TEST_BLOCK, True, (2).to_bytes(32, "big"))], TEST_CACHE_PATH)
+        assert weth_bal(TEST_BLOCK, TEST_CACHE_PATH) == {"weth_bal": "1"}
+
+        for i in range(100):
+            memory_cache.put(TEST_CACHE_PATH, i.to_bytes(32, "big"), True, bytes(32))
+        assert memory_cache.stats()["bytes"] <= 10_000
+    finally:
+        disable_memory_cache()
+
+
+@refresh_testing_db
+def test_bloom_filter_tracks_saved_call_ids():
+    weth_bal(TEST_BLOCK, TEST_CACHE_PATH)
+    bloom_filter = create_bloom_filter(TEST_CACHE_PATH, capacity=1_000, false_positive_rate=0.01)
+    assert weth_bal.to_id(TEST_BLOCK) in bloom_filter
+
+    usdc_bal(TEST_BLOCK, TEST_CACHE_PATH)  # save_data keeps the filter up to date
+    assert usdc_bal.to_id(TEST_BLOCK) in BloomFilter.load(bloom_filter.path)
+
+    found_df, not_found_df = get_data_from_disk([weth_bal, usdc_bal], [TEST_BLOCK, TEST_BLOCK + 1], TEST_CACHE_PATH)
+    assert found_df[["callIndex", "block"]].values.tolist() == [[0, TEST_BLOCK], [1, TEST_BLOCK]]
+    assert not_found_df[["callIndex", "block"]].values.tolist() == [[0, TEST_BLOCK + 1], [1, TEST_BLOCK + 1]]
+
+
+@refresh_testing_db
+def test_bloom_filter_is_saved_before_it_is_used_and_sees_other_processes_keys():
+    weth_bal(TEST_BLOCK, TEST_CACHE_PATH)
+    registered_with_a_file = []
+
+    class Registry(dict):
+        def __setitem__(self, key, bloom_filter):
+            registered_with_a_file.append(os.path.exists(bloom_filter.path))
+            super().__setitem__(key, bloom_filter)
+
+    with pytest.MonkeyPatch.context() as m:
+        m.setattr(bloom_module, "_bloom_filters", Registry())
+        bloom_filter = create_bloom_filter(TEST_CACHE_PATH, capacity=1_000, false_positive_rate=0.01)
+    assert registered_with_a_file == [True]
+
+    loaded = get_bloom_filter(TEST_CACHE_PATH)
+    other_process_filter = BloomFilter.load(bloom_filter.path)
+    usdc_bal(TEST_BLOCK, TEST_CACHE_PATH)
+    other_process_filter.add_many([usdc_bal.to_id(TEST_BLOCK + 1)])
+    other_process_filter.flush()
+    assert usdc_bal.to_id(TEST_BLOCK + 1) not in loaded
+    assert get_bloom_filter(TEST_CACHE_PATH) is loaded
+    assert usdc_bal.to_id(TEST_BLOCK + 1) in loaded
+    assert loaded.count == 3
+
+
+def test_bloom_filter_of_a_sharded_cache_has_one_filter_per_shard():
+    sharded_path = test_data_path / "sharded_cache"
+    create_sharded_db(sharded_path, blocks_per_shard=1_000)
+    try:
+        fetch_save_and_return([weth_bal], [TEST_BLOCK, TEST_BLOCK + 1_500], W3, cache=sharded_path)
+        bloom_filters = create_bloom_filter(sharded_path, capacity=1_000, false_positive_rate=0.01)
+        assert [f.path for f in bloom_filters] == [f"{path}.bloom" for path in existing_shard_paths(sharded_path)]
+        assert weth_bal.to_id(TEST_BLOCK) in bloom_filters[0]
+        assert weth_bal.to_id(TEST_BLOCK + 1_500) in bloom_filters[1]
+
+        fetch_save_and_return([weth_bal], [TEST_BLOCK + 2_500], W3, cache=sharded_path)  # in a new shard
+        new_shard = existing_shard_paths(sharded_path)[2]
+        assert weth_bal.to_id(TEST_BLOCK + 2_500) in BloomFilter.load(f"{new_shard}.bloom")
+
+        blocks = [TEST_BLOCK, TEST_BLOCK + 1, TEST_BLOCK + 2_500]
+        found_df, not_found_df = get_data_from_disk([weth_bal], blocks, sharded_path)
+        assert found_df["block"].tolist() == [TEST_BLOCK, TEST_BLOCK + 2_500]
+        assert not_found_df["block"].tolist() == [TEST_BLOCK + 1]
+    finally:
+        delete_db(sharded_path)
+
+
+@refresh_testing_db
+def test_parquet_export_answers_lookups_like_the_db():
+    weth_bal(TEST_BLOCK, TEST_CACHE_PATH)
+    usdc_bal(TEST_BLOCK, TEST_CACHE_PATH)
+    dataset_dir = test_data_path / "parquet_export"
+
+    try:
+        export_cache_to_parquet(TEST_CACHE_PATH, dataset_dir, blocks_per_partition=1_000)
+        calls, blocks = [weth_bal, usdc_bal], [TEST_BLOCK, TEST_BLOCK + 1]
+        parquet_found_df, parquet_not_found_df = get_data_from_parquet(calls, blocks, dataset_dir)
+        db_found_df, db_not_found_df = get_data_from_disk(calls, blocks, TEST_CACHE_PATH)
+        assert parquet_found_df.values.tolist() == db_found_df.values.tolist()
+        assert parquet_not_found_df.values.tolist() == db_not_found_df.values.tolist()
+    finally:
+        shutil.rmtree(dataset_dir)
+
+
+def test_sharded_cache_routes_by_chain_and_block_range():
+    sharded_path = test_data_path / "sharded_cache"
+    create_sharded_db(sharded_path, blocks_per_shard=1_000)
+    try:
+        calls, blocks = [weth_bal, usdc_bal], [TEST_BLOCK, TEST_BLOCK + 1_500]
+        fetch_save_and_return(calls, blocks, W3, cache=sharded_path)
+        assert sorted(path.name for path in existing_shard_paths(sharded_path)) == [
+            "blocks_18000000_18000999.sqlite",
+            "blocks_18001000_18001999.sqlite",
+        ]
+        assert get_db_size(sharded_path) == 4
+        assert isCached(weth_bal, TEST_BLOCK + 1_500, sharded_path)
+        assert not isCached(weth_bal, TEST_BLOCK + 2_500, sharded_path)
+        assert get_cached_blocks(weth_bal, TEST_BLOCK, TEST_BLOCK + 2_000, sharded_path) == blocks
+
+        found_df, not_found_df = get_data_from_disk(calls, blocks + [TEST_BLOCK + 2_500], sharded_path)
+        assert found_df[["callIndex", "block"]].values.tolist() == [[i, b] for b in blocks for i in range(2)]
+        assert not_found_df.values.tolist() == [[0, TEST_BLOCK + 2_500], [1, TEST_BLOCK + 2_500]]
+    finally:
+        delete_db(sharded_path)
+
+
+@refresh_testing_db
+def test_decoded_output_is_saved_with_the_response():
+    weth_bal(TEST_BLOCK, TEST_CACHE_PATH)
+    found_df, _ = get_data_from_disk([weth_bal], [TEST_BLOCK], TEST_CACHE_PATH)
+    response, decoded = found_df["response"][0], found_df["decoded"][0]
+    assert load_decoded(decoded) == weth_bal.signature.decode_data(response)
+    assert weth_bal.decode_output(response, load_decoded(decoded)) == weth_bal.decode_output(response)
+
+    decoded = (True, 2**255, "0x" + "11" * 20, b"\x00\x01", ((1, 2), [b"\x02"]), Decimal("1.5"))
+    assert load_decoded(dump_decoded(decoded)) == decoded
+    assert dump_decoded((object(),)) is None
+    assert load_decoded(pickle.dumps((1,))) is None  # never unpickled, the response is decoded again
+
+
+@refresh_testing_db
+def test_repeated_responses_are_stored_once():
+    blocks = [TEST_BLOCK, TEST_BLOCK + 1, TEST_BLOCK + 2]
+    fetch_save_and_return([weth_bal, target_has_no_code], blocks, W3, cache=TEST_CACHE_PATH)
+    with get_connection(TEST_CACHE_PATH) as conn:
+        num_no_code_responses = conn.execute(
+            """
+            SELECT COUNT(DISTINCT r.responseKey)
+            FROM callResult r
+            JOIN callIdentity i ON i.callKey = r.callKey
+            WHERE i.callHash = ?
+            """,
+            (target_has_no_code.to_key(),),
+        ).fetchone()[0]
+    assert num_no_code_responses == 1
+    assert get_db_size(TEST_CACHE_PATH) == 6
+
+
+@refresh_testing_db
+def test_background_writer_commits_what_it_was_given_when_interrupted():
+    data = Multicall([weth_bal, usdc_bal]).make_external_calls_to_raw_data(W3, TEST_BLOCK)
+    with pytest.raises(KeyboardInterrupt):
+        with BackgroundWriter(TEST_CACHE_PATH, batch_size=1_000, flush_interval=60) as writer:
+            writer.put(data)
+            raise KeyboardInterrupt
+    assert writer.rows_saved == 2
+    assert isCached(weth_bal, TEST_BLOCK, TEST_CACHE_PATH) and isCached(usdc_bal, TEST_BLOCK, TEST_CACHE_PATH)
+
+
+def test_background_writer_async_put_does_not_block_the_event_loop(monkeypatch):
+    saving = threading.Event()
+    may_save = threading.Event()
+
+    def slow_save_data(data, cache_path):
+        saving.set()
+        may_save.wait()
+
+    monkeypatch.setattr(writer_module, "save_data", slow_save_data)
+
+    async def put_while_the_writer_is_stuck(writer):
+        await writer.async_put([1])
+        await asyncio.get_running_loop().run_in_executor(None, saving.wait)
+        await writer.async_put([2])  # fills the queue
+        threading.Timer(0.5, may_save.set).start()  # a put that blocked the loop would only return after this
+        put = asyncio.ensure_future(writer.async_put([3]))
+        for _ in range(5):
+            await asyncio.sleep(0.01)
+        assert not put.done()
+        await put
+
+    with BackgroundWriter(TEST_CACHE_PATH, batch_size=1, max_queued=1) as writer:
+        asyncio.run(put_while_the_writer_is_stuck(writer))
+    assert writer.rows_saved == 3
+
+
+@refresh_testing_db
+def test_block_hashes_are_saved_and_forgotten_with_their_block():
+    data = Multicall([weth_bal, usdc_bal], engine="tryBlockAndAggregate").make_external_calls_to_raw_data(
+        W3, TEST_BLOCK
+    )
+    fetch_save_and_return([weth_bal], [TEST_BLOCK + 1], W3, cache=TEST_CACHE_PATH)
+    save_data(data, TEST_CACHE_PATH)
+    assert get_block_hash(1, TEST_BLOCK, TEST_CACHE_PATH) == bytes(W3.eth.get_block(TEST_BLOCK).hash)
+    assert get_block_hash(1, TEST_BLOCK + 1, TEST_CACHE_PATH) is None  # fetched with tryAggregate
+
+    assert forget_block(1, TEST_BLOCK, TEST_CACHE_PATH) == 2
+    assert get_block_hash(1, TEST_BLOCK, TEST_CACHE_PATH) is None
+    assert not isCached(weth_bal, TEST_BLOCK, TEST_CACHE_PATH)
+    assert isCached(weth_bal, TEST_BLOCK + 1, TEST_CACHE_PATH)
+
+
+@refresh_testing_db
+def test_pending_results_are_only_read_by_their_block_hash_until_promoted():
+    data = Multicall([weth_bal, usdc_bal], engine="tryBlockAndAggregate").make_external_calls_to_raw_data(
+        W3, TEST_BLOCK
+    )
+    block_hash = bytes(data[0].block_hash)
+    save_data(data, TEST_CACHE_PATH, pending=True)
+    assert has_pending_results(1, TEST_BLOCK, TEST_CACHE_PATH)
+    assert not isCached(weth_bal, TEST_BLOCK, TEST_CACHE_PATH)
+    assert len(get_data_from_disk([weth_bal, usdc_bal], [TEST_BLOCK], TEST_CACHE_PATH)[0]) == 0
+
+    pending = get_pending_data([usdc_bal, weth_bal], TEST_BLOCK, block_hash, TEST_CACHE_PATH)
+    assert [(d.call, d.response) for d in pending] == [(d.call, d.response) for d in data[::-1]]
+    assert get_pending_data([weth_bal], TEST_BLOCK, b"\x11" * 32, TEST_CACHE_PATH) is None
+    assert get_pending_data([weth_bal, target_has_no_code], TEST_BLOCK, block_hash, TEST_CACHE_PATH) is None
+
+    # finalized with another hash, the pending results were of an orphaned block
+    assert promote_pending_results(1, TEST_BLOCK, b"\x11" * 32, TEST_CACHE_PATH) == 0
+    assert not has_pending_results(1, TEST_BLOCK, TEST_CACHE_PATH)
+    assert not isCached(weth_bal, TEST_BLOCK, TEST_CACHE_PATH)
+
+    save_data(data, TEST_CACHE_PATH, pending=True)
+    assert promote_pending_results(1, TEST_BLOCK, block_hash, TEST_CACHE_PATH) == 2
+    assert isCached(weth_bal, TEST_BLOCK, TEST_CACHE_PATH) and isCached(usdc_bal, TEST_BLOCK, TEST_CACHE_PATH)
+    assert get_block_hash(1, TEST_BLOCK, TEST_CACHE_PATH) == block_hash
+    assert not has_pending_results(1, TEST_BLOCK, TEST_CACHE_PATH)
+
+    with pytest.raises(ValueError):
+        save_data(Multicall([weth_bal]).make_external_calls_to_raw_data(W3, TEST_BLOCK), TEST_CACHE_PATH, pending=True)
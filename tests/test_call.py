@@ -1,7 +1,15 @@
+import hashlib
+import pickle
+import warnings
+
+import eth_abi
+import numpy as np
 import pytest
 import web3
 from multicallcache.call import Call, NOT_A_CONTRACT_REVERT_MESSAGE
+from multicallcache.multicall import Multicall
 from multicallcache.constants import TEST_CACHE_PATH, W3
+from multicallcache.utils import chain_id
 from helpers import refresh_testing_db, TEST_BLOCK
 
 
@@ -109,3 +117,29 @@ def test_malformed_calls():
 
     with pytest.raises(Exception):
         Call(cbETH, "balanceOf(address)(uint256)", (int(100)), "balanceOf", identity_function, W3)
+
+
+def test_call_ids_are_the_sha256_of_the_call_and_block():
+    balance_of_call = Call(cbETH, "balanceOf(address)(uint256)", (cbETH_holder), "balanceOf", identity_function, W3)
+    prefix = f"{chain_id(W3)} {cbETH} balanceOf(address)(uint256) {str((cbETH_holder,))} "
+    blocks = [TEST_BLOCK, TEST_BLOCK + 1]
+
+    assert balance_of_call.to_key() == hashlib.sha256(prefix.encode("utf-8")).digest()
+    assert balance_of_call.to_id(TEST_BLOCK) == hashlib.sha256((prefix + str(TEST_BLOCK)).encode("utf-8")).digest()
+    assert balance_of_call.to_ids(np.array(blocks)) == [balance_of_call.to_id(block) for block in blocks]
+
+
+def test_calls_share_signatures_and_multicall_reuses_their_calldata():
+    balance_of_call = Call(cbETH, "balanceOf(address)(uint256)", (cbETH_holder), "balanceOf", identity_function, W3)
+    other_balance_of_call = Call(cbETH, "balanceOf(address)(uint256)", (cbETH), "balanceOf2", identity_function, W3)
+    assert balance_of_call.signature is other_balance_of_call.signature
+    assert pickle.loads(pickle.dumps(balance_of_call.signature)) is balance_of_call.signature
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        expected_calldata = eth_abi.encode_single(
+            "(bool,(address,bytes)[])",
+            (False, ((cbETH, balance_of_call.calldata), (cbETH, other_balance_of_call.calldata))),
+        )
+    multicall = Multicall([balance_of_call, other_balance_of_call])
+    assert multicall.calldata == "0x" + (multicall.multicall_sig.fourbyte + expected_calldata).hex()
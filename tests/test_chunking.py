@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+from aiolimiter import AsyncLimiter
+
+from multicallcache import rpc_call, utils
+from multicallcache.call import Call
+from multicallcache.chunking import (
+    ChunkSizer,
+    DEFAULT_CALLS_PER_RPC_CALL,
+    CostModel,
+    RESULT_OVERHEAD_BYTES,
+    async_fetch_splitting_on_failure,
+    chunk_lengths,
+    estimate_response_bytes,
+)
+from multicallcache.constants import W3
+from multicallcache.multicall import CallRawData, Multicall
+from multicallcache.rpc_call import (
+    OutOfGas,
+    PayloadTooLarge,
+    RpcCallFailed,
+    RpcTimeout,
+    _result_or_raise,
+    async_rpc_eth_call,
+)
+from multicallcache.utils import chunks
+from helpers import weth
+
+
+def test_failed_multicalls_are_split_and_the_sizer_settles_under_the_limit(monkeypatch):
+    monkeypatch.setitem(utils.chainids, W3, 1)
+    limit = 37  # the most calls the fake node answers in one multicall
+    holders = [f"0x{i:040x}" for i in range(1, 501)]
+    calls = [
+        Call(weth, "balanceOf(address)(uint256)", holder, f"bal_{i}", None, W3) for i, holder in enumerate(holders)
+    ]
+    sizer = ChunkSizer()
+    num_failures = []
+
+    async def fetch(multicall, block):
+        if len(multicall.calls) > limit:
+            raise PayloadTooLarge("413")
+        return [(call, block) for call in multicall.calls]
+
+    async def fetch_blocks():
+        for block in range(30):
+            failures_before = sizer.num_failures
+            fetched = []
+            for chunk in chunks(calls, sizer.chunk_size()):
+                fetched.extend(await async_fetch_splitting_on_failure(fetch, Multicall(chunk), block, sizer))
+            assert fetched == [(call, block) for call in calls]
+            num_failures.append(sizer.num_failures - failures_before)
+
+    asyncio.run(fetch_blocks())
+    assert limit * 3 // 4 <= sizer.size <= limit + limit // 16
+    # once settled only an occasional block probes over the limit
+    assert sum(n > 0 for n in num_failures[-10:]) <= 2
+
+
+def test_json_rpc_errors_are_raised_by_what_went_wrong():
+    assert _result_or_raise({"jsonrpc": "2.0", "id": 1, "result": "0x0102"}) == b"\x01\x02"
+    errors = {
+        "out of gas": OutOfGas,
+        "gas required exceeds allowance (30000000)": OutOfGas,
+        "execution aborted (timeout = 5s)": RpcTimeout,
+        "Response size is larger than 150MB limit": PayloadTooLarge,
+        "execution reverted": RpcCallFailed,
+    }
+    for message, error in errors.items():
+        with pytest.raises(error):
+            _result_or_raise({"jsonrpc": "2.0", "id": 1, "error": {"code": -32000, "message": message}})
+
+
+def test_calls_are_packed_by_their_response_bytes_and_latency(monkeypatch):
+    monkeypatch.setitem(utils.chainids, W3, 1)
+    assert estimate_response_bytes("(uint112,uint112,uint32)") == 3 * 32 + RESULT_OVERHEAD_BYTES
+    assert estimate_response_bytes("(uint256[2],address)") == 3 * 32 + RESULT_OVERHEAD_BYTES
+    assert estimate_response_bytes("(uint256[])") > estimate_response_bytes("(uint256[2],address)")
+
+    light = [Call(weth, "totalSupply()(uint256)", (), f"light_{i}", None, W3) for i in range(100)]
+    heavy = [Call(weth, "holders(uint256)(address[])", i, f"heavy_{i}", None, W3) for i in range(100)]
+    cost_model = CostModel(target_bytes=13_500, target_seconds=1.0)
+    assert chunk_lengths(light, 300, cost_model) == (100,)
+    assert chunk_lengths(light, 30, cost_model) == (30, 30, 30, 10)
+    assert chunk_lengths(light, 300) == (100,)
+
+    # 100 addresses per response, 20x the width of a light call
+    cost_model.record([CallRawData(call, 1, True, bytes(32 * 102)) for call in heavy[:10]], seconds=0.1)
+    assert chunk_lengths(heavy, 300, cost_model) == (4,) * 25
+    assert len(chunk_lengths(light[:50] + heavy[:2], 300, cost_model)) == 1
+
+    # the node takes 0.1 seconds longer for each light call than the quickest multicall
+    cost_model.record([CallRawData(call, 1, True, bytes(32)) for call in light[:10]], seconds=0.1)
+    cost_model.record([CallRawData(call, 1, True, bytes(32)) for call in light[:10]], seconds=1.1)
+    assert 0 < cost_model.seconds(light[0].signature) <= 0.1
+    assert max(chunk_lengths(light, 300, cost_model)) < 100
+
+
+class FakeResponse:
+    status = 200
+
+    async def json(self):
+        return {"jsonrpc": "2.0", "id": 1, "result": "0x0102"}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FlakySession:
+    """Times out on the first num_timeouts posts, like a network blip, then answers"""
+
+    def __init__(self, num_timeouts):
+        self.num_timeouts = num_timeouts
+        self.num_posts = 0
+
+    def post(self, *args, **kwargs):
+        self.num_posts += 1
+        if self.num_posts <= self.num_timeouts:
+            raise asyncio.TimeoutError()
+        return FakeResponse()
+
+
+def test_transport_timeouts_are_retried_and_never_split(monkeypatch):
+    monkeypatch.setattr(rpc_call, "RETRY_COUNT", 2)
+    w3 = type("FakeWeb3", (), {"provider": type("FakeProvider", (), {"endpoint_uri": "http://node.example"})})()
+
+    session = FlakySession(num_timeouts=1)
+    assert asyncio.run(async_rpc_eth_call(w3, [], session, AsyncLimiter(100))) == b"\x01\x02"
+    assert session.num_posts == 2
+
+    session = FlakySession(num_timeouts=2)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(async_rpc_eth_call(w3, [], session, AsyncLimiter(100)))
+
+    # a fetch that keeps getting no answer is not a multicall that is too large, the sizer does not shrink
+    monkeypatch.setitem(utils.chainids, W3, 1)
+    multicall = Multicall([Call(weth, "totalSupply()(uint256)", (), f"supply_{i}", None, W3) for i in range(2)])
+    sizer = ChunkSizer()
+
+    async def fetch(multicall, block):
+        return await async_rpc_eth_call(w3, [], FlakySession(num_timeouts=2), AsyncLimiter(100))
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(async_fetch_splitting_on_failure(fetch, multicall, 1, sizer))
+    assert sizer.num_failures == 0 and sizer.size == DEFAULT_CALLS_PER_RPC_CALL
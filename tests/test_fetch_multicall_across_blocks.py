@@ -1,6 +1,25 @@
+import asyncio
+import json
+import time
+
 import pandas as pd
+import pytest
+from aiolimiter import AsyncLimiter
 
-from multicallcache.fetch_multicall_across_blocks import fetch_save_and_return
+from multicallcache import fetch_multicall_across_blocks, multicall as multicall_module, utils
+from multicallcache.fetch_multicall_across_blocks import (
+    fetch_save_and_return,
+    _rpc_fetch_batches,
+    _plan_multicalls_for_missing_data,
+    _run_with_bounded_concurrency,
+    iter_fetch_save_and_return,
+    _raw_bytes_data_df_to_processed_block_wise_data_df,
+)
+from multicallcache.call import Call
+from multicallcache.multicall import Multicall
+from multicallcache.rpc_call import PayloadTooLarge, _batch_results, async_rpc_eth_call_batch
+from multicallcache.signature import get_signature
+from multicallcache.cache import get_data_from_disk
 from multicallcache.constants import W3, TEST_CACHE_PATH
 from helpers import weth_bal, usdc_bal, invalid_function, target_has_no_code, weth_bal2, refresh_testing_db
 
@@ -17,3 +36,185 @@ def test_fetch_save_and_return():
     assert first_df.equals(second_df)
     local_df = pd.read_parquet("tests/test_data/test_fetch_save_and_return_data.parquet")
     assert first_df.equals(local_df)
+
+
+@refresh_testing_db
+def test_only_missing_calls_are_fetched():
+    blocks = [18_000_000, 18_500_000]
+    fetch_save_and_return([weth_bal, usdc_bal], blocks, W3, 10, cache=TEST_CACHE_PATH)
+
+    calls = [weth_bal, usdc_bal, weth_bal2]
+    _, not_found_df = get_data_from_disk(calls, blocks + [19_000_000], TEST_CACHE_PATH)
+    planned_multicalls = _plan_multicalls_for_missing_data(calls, not_found_df, max_calls_per_rpc_call=300)
+
+    planned = {block: multicall.calls for multicall, block in planned_multicalls}
+    assert planned == {18_000_000: [weth_bal2], 18_500_000: [weth_bal2], 19_000_000: calls}
+
+
+def test_planned_multicalls_are_shared_by_blocks_missing_the_same_calls(monkeypatch):
+    monkeypatch.setitem(utils.chainids, W3, 1)
+    monkeypatch.setattr(fetch_multicall_across_blocks, "MAX_PLANNED_MISSING_CALL_SETS", 2)
+    calls = [weth_bal, usdc_bal, weth_bal2]
+    missing_call_indexes = [(0, 1), (0, 1), (2,), (0, 1), (1,), (2,), (0, 1)]
+    not_found_df = pd.DataFrame(
+        [(i, block) for block, indexes in enumerate(missing_call_indexes) for i in indexes],
+        columns=["callIndex", "block"],
+    )
+    planned = [multicall for multicall, _ in _plan_multicalls_for_missing_data(calls, not_found_df, 300)]
+
+    assert [[calls.index(c) for c in m.calls] for m in planned] == [list(i) for i in missing_call_indexes]
+    assert planned[1] is planned[0] and planned[3] is planned[0]
+    assert planned[5] is not planned[2]  # dropped for (1,), only the 2 most recently used sets are kept
+    assert planned[6] is not planned[3]
+
+    chunk_sizes = iter([2, 2, 1])
+    sizer = type("FakeSizer", (), {"chunk_size": lambda self, max_calls: next(chunk_sizes)})()
+    not_found_df = not_found_df[not_found_df["block"].isin([0, 1, 3])]
+    planned = list(_plan_multicalls_for_missing_data(calls, not_found_df, None, sizer))
+    assert [len(m.calls) for m, _ in planned] == [2, 2, 1, 1]
+    assert planned[1][0] is planned[0][0] and planned[2][0] is not planned[0][0]  # rebuilt for the new lengths
+
+
+def test_bounded_concurrency_never_exceeds_the_window():
+    in_flight, max_in_flight, fetched = [0], [0], []
+
+    async def fetch(multicall, block):
+        in_flight[0] += 1
+        max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        await asyncio.sleep(0)
+        in_flight[0] -= 1
+        fetched.append(block)
+
+    asyncio.run(_run_with_bounded_concurrency(fetch, ((None, block) for block in range(1_000)), 8))
+    assert max_in_flight[0] == 8
+    assert sorted(fetched) == list(range(1_000))
+
+
+@refresh_testing_db
+def test_iter_fetch_save_and_return_matches_fetch_save_and_return():
+    calls = [weth_bal, usdc_bal, target_has_no_code]
+    blocks = [18_000_000, 18_500_000, 19_000_000]
+    fetch_save_and_return(calls, blocks[:1], W3, 10, cache=TEST_CACHE_PATH)
+
+    rows = list(iter_fetch_save_and_return(calls, blocks, W3, 10, cache=TEST_CACHE_PATH, blocks_per_chunk=2))
+    assert [row["block"] for row in rows] == blocks
+    assert pd.DataFrame.from_records(rows).equals(fetch_save_and_return(calls, blocks, W3, 10, cache=TEST_CACHE_PATH))
+
+
+@refresh_testing_db
+def test_decoding_in_a_process_pool_matches_decoding_serially():
+    calls = [weth_bal, usdc_bal, target_has_no_code]
+    blocks = [18_000_000, 18_500_000, 19_000_000]
+    fetch_save_and_return(calls, blocks, W3, 10, cache=TEST_CACHE_PATH)
+    found_df, _ = get_data_from_disk(calls, blocks, TEST_CACHE_PATH)
+    # shuffled, the pool must not rely on found_df being ordered by block
+    found_df = found_df.sample(frac=1, random_state=0)
+
+    serial_df = _raw_bytes_data_df_to_processed_block_wise_data_df(found_df, calls, blocks)
+    assert _raw_bytes_data_df_to_processed_block_wise_data_df(found_df, calls, blocks, decode_workers=2).equals(
+        serial_df
+    )
+
+    unpicklable = [Call(c.target, c.signature.signature, c.arguments, c.data_labels, lambda x: x, W3) for c in calls]
+    with pytest.warns(UserWarning):
+        df = _raw_bytes_data_df_to_processed_block_wise_data_df(found_df, unpicklable, blocks, decode_workers=2)
+    assert df.shape == serial_df.shape
+
+
+@refresh_testing_db
+def test_long_and_arrow_output_formats_hold_the_wide_values():
+    calls = [weth_bal, usdc_bal, target_has_no_code]
+    blocks = [18_000_000, 18_500_000, 19_000_000]
+    wide_df = fetch_save_and_return(calls, blocks, W3, 10, cache=TEST_CACHE_PATH).set_index("block").loc[blocks]
+
+    long_df = fetch_save_and_return(calls, blocks, W3, 10, cache=TEST_CACHE_PATH, output_format="long")
+    assert list(long_df.columns) == ["block", "label", "value"]
+    assert len(long_df) == len(calls) * len(blocks)
+    assert long_df.pivot(index="block", columns="label", values="value").loc[blocks, wide_df.columns].equals(wide_df)
+
+    table = fetch_save_and_return(calls, blocks, W3, 10, cache=TEST_CACHE_PATH, output_format="arrow")
+    assert table.column("block").to_pylist() == blocks
+    assert table.column("weth_bal").to_pylist() == wide_df["weth_bal"].tolist()
+    assert table.column("notAContract").null_count == len(blocks)
+
+    with pytest.raises(ValueError):
+        fetch_save_and_return(calls, blocks, W3, 10, cache=TEST_CACHE_PATH, output_format="tall")
+
+
+def test_json_rpc_batches_are_matched_back_and_failed_multicalls_retried_alone(monkeypatch):
+    monkeypatch.setitem(utils.chainids, W3, 1)
+    results_sig = get_signature("results((bool,bytes)[])()")
+    multicall = Multicall([weth_bal, usdc_bal])
+    planned = [(multicall, block) for block in range(18_000_000, 18_000_006)]
+    batch_sizes, single_blocks = [], []
+
+    def tryAggregate_output(block):
+        return results_sig.encode_data(([(True, block.to_bytes(32, "big"))] * 2,))[4:]
+
+    async def fake_batch(w3, all_rpc_args, session, rate_limiter, timings=None):
+        batch_sizes.append(len(all_rpc_args))
+        if len(all_rpc_args) > 4:
+            raise PayloadTooLarge("batch too large")
+        answers = []
+        for request_id, (_, block) in enumerate(all_rpc_args):
+            block = int(block, 16)
+            if block == 18_000_001:
+                answers.append({"id": request_id, "error": {"code": -32000, "message": "out of gas"}})
+            elif block != 18_000_002:  # left out of the answer
+                answers.append({"id": request_id, "result": "0x" + tryAggregate_output(block).hex()})
+        return _batch_results(answers[::-1], len(all_rpc_args))
+
+    async def fake_single(w3, rpc_args, session, rate_limiter, timings=None):
+        single_blocks.append(int(rpc_args[1], 16))
+        return tryAggregate_output(int(rpc_args[1], 16))
+
+    monkeypatch.setattr(fetch_multicall_across_blocks, "async_rpc_eth_call_batch", fake_batch)
+    monkeypatch.setattr(multicall_module, "async_rpc_eth_call", fake_single)
+    fetch_batch = _rpc_fetch_batches(W3, None, None, None, None)
+    all_call_raw_data = asyncio.run(fetch_batch(planned))
+
+    assert batch_sizes == [6, 3, 3]  # refused as a whole, then halved
+    assert sorted(single_blocks) == [18_000_001, 18_000_002]
+    assert [[data.block for data in call_raw_data] for call_raw_data in all_call_raw_data] == [
+        [block, block] for _, block in planned
+    ]
+    for call_raw_data in all_call_raw_data:
+        assert all(data.response == data.block.to_bytes(32, "big") for data in call_raw_data)
+
+
+def test_each_eth_call_in_a_batch_counts_against_the_rate_limit():
+    sent_at = []  # when each eth_call reached the fake node
+
+    class FakeResponse:
+        status = 200
+
+        def __init__(self, data):
+            self.requests = json.loads(data)
+
+        async def json(self):
+            return [{"jsonrpc": "2.0", "id": r["id"], "result": "0x"} for r in self.requests]
+
+        async def __aenter__(self):
+            sent_at.extend([time.monotonic()] * len(self.requests))
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+    class FakeSession:
+        def post(self, url, headers, data, timeout):
+            return FakeResponse(data)
+
+    w3 = type("FakeWeb3", (), {"provider": type("FakeProvider", (), {"endpoint_uri": "http://node.example"})})()
+    rate_limiter = AsyncLimiter(100, time_period=0.1)  # 1000 eth_calls per second
+
+    async def send_batches():
+        started_at = time.monotonic()
+        for _ in range(3):
+            assert await async_rpc_eth_call_batch(w3, [[]] * 250, FakeSession(), rate_limiter) == [b""] * 250
+        return started_at
+
+    started_at = asyncio.run(send_batches())
+    assert len(sent_at) == 750
+    # the first 100 go out at once, the other 650 at no more than 1000 per second
+    assert sent_at[-1] - started_at >= 0.6
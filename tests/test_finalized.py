@@ -0,0 +1,71 @@
+from multicallcache import constants, utils
+from multicallcache.finalized import FinalizedBlockTracker, get_finalized_block_tracker
+from multicallcache.utils import chain_id
+
+
+class FakeBlock:
+    def __init__(self, number):
+        self.number = number
+
+
+class FakeEth:
+    def __init__(self, finalized_block, chain):
+        self.finalized_block = finalized_block
+        self.chain = chain
+        self.rpc_calls = 0
+
+    def get_block(self, block_identifier):
+        assert block_identifier == "finalized"
+        self.rpc_calls += 1
+        return FakeBlock(self.finalized_block)
+
+    @property
+    def chain_id(self):
+        self.rpc_calls += 1
+        return self.chain
+
+
+class FakeWeb3:
+    def __init__(self, endpoint, finalized_block=100, chain=10):
+        self.provider = endpoint
+        self.eth = FakeEth(finalized_block, chain)
+
+
+def test_finalized_block_is_fetched_at_most_once_per_ttl():
+    w3 = FakeWeb3("https://finalized.example")
+    tracker = FinalizedBlockTracker(w3, ttl=3600)
+
+    assert tracker.is_finalized(5)
+    assert tracker.is_finalized(99)
+    assert not tracker.is_finalized(100)
+    assert not tracker.is_finalized(150)
+    assert w3.eth.rpc_calls == 1
+
+    w3.eth.finalized_block = 200
+    tracker.ttl = 0
+    assert tracker.is_finalized(150)
+    assert tracker.is_finalized(10)  # below the known finalized block, no need to ask again
+    assert w3.eth.rpc_calls == 2
+
+
+def test_web3_instances_on_the_same_endpoint_share_a_tracker():
+    tracker = get_finalized_block_tracker(FakeWeb3("https://shared.example"))
+    assert get_finalized_block_tracker(FakeWeb3("https://shared.example")) is tracker
+    assert get_finalized_block_tracker(FakeWeb3("https://other.example")) is not tracker
+
+
+def test_chain_ids_of_remote_endpoints_are_saved_to_disk(tmp_path, monkeypatch):
+    monkeypatch.setattr(constants, "CHAIN_IDS_PATH", tmp_path / "chainIds.json")
+    monkeypatch.setattr(utils, "_saved_chainids", None)
+
+    first_run = FakeWeb3("https://rpc.example/v2/secret-api-key", chain=10)
+    local_node = FakeWeb3("http://127.0.0.1:8545", chain=31337)
+    assert chain_id(first_run) == 10
+    assert chain_id(local_node) == 31337
+    assert "secret-api-key" not in (tmp_path / "chainIds.json").read_text()
+
+    monkeypatch.setattr(utils, "_saved_chainids", None)  # as if it was a new process
+    next_run = FakeWeb3("https://rpc.example/v2/secret-api-key", chain=10)
+    assert chain_id(next_run) == 10
+    assert next_run.eth.rpc_calls == 0
+    assert len(utils._load_saved_chain_ids()) == 1  # the local node was not saved
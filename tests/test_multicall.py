@@ -1,7 +1,18 @@
-from multicallcache.multicall import Multicall
+import pytest
+from eth_utils import keccak
+
+from multicallcache import utils
+from multicallcache.multicall import Multicall, MULTICALL_ENGINES
+from multicallcache.rpc_call import RpcCallFailed
 from multicallcache.call import Call, CALL_FAILED_REVERT_MESSAGE, NOT_A_CONTRACT_REVERT_MESSAGE
 from helpers import TEST_BLOCK, refresh_testing_db, identity_function, TEST_CACHE_PATH
-from multicallcache.constants import W3
+from multicallcache.constants import (
+    MULTICALL3_BYTECODE,
+    MULTICALL3_DEPLOYMENT_BLOCKS,
+    MULTICALL3_OVERRIDE_MIN_BLOCKS,
+    Network,
+    W3,
+)
 
 # note: does not touch db
 
@@ -128,3 +139,49 @@ def test_multicall():
     assert (
         multicall_with_call_to_address_without_code(TEST_BLOCK, TEST_CACHE_PATH) == expected_values_combination
     ), "multicall_with_call_to_address_without_code failed"
+
+
+def test_multicall_engines_return_the_same_results():
+    balance_of_call = Call(cbETH, "balanceOf(address)(uint256)", (cbETH_holder), "balanceOf", identity_function, W3)
+    not_a_function = Call(cbETH, "functionDoesNotExist()(uint256)", (), "notAFunction", identity_function, W3)
+    calls = [balance_of_call, not_a_function]
+
+    results = {
+        engine: Multicall(calls, engine).make_external_calls_to_raw_data(W3, TEST_BLOCK) for engine in MULTICALL_ENGINES
+    }
+    for call_raw_data in results.values():
+        assert [(d.success, d.response) for d in call_raw_data] == [
+            (d.success, d.response) for d in results["tryAggregate"]
+        ]
+    assert [d.success for d in results["aggregate3"]] == [True, False]
+    assert {bytes(d.block_hash) for d in results["tryBlockAndAggregate"]} == {bytes(W3.eth.get_block(TEST_BLOCK).hash)}
+    assert results["tryAggregate"][0].block_hash is None
+
+    must_succeed = Call(cbETH, "functionDoesNotExist()(uint256)", (), "mustSucceed", identity_function, W3, False)
+    with pytest.raises(RpcCallFailed):
+        Multicall([balance_of_call, must_succeed], "aggregate3").make_external_calls_to_raw_data(W3, TEST_BLOCK)
+    with pytest.raises(ValueError):
+        Multicall(calls, "aggregate")
+
+
+def test_multicall_code_is_injected_before_multicall3_was_deployed(monkeypatch):
+    monkeypatch.setitem(utils.chainids, W3, 1)
+    # the code hash of Multicall3 as deployed on mainnet, the dispatcher shifts the selector with SHR (0x1c)
+    assert (
+        keccak(hexstr=MULTICALL3_BYTECODE).hex() == "d5c15df687b16f2ff992fc8d767b4216323184a2bbc6ee2f9c398c318e770891"
+    )
+    assert MULTICALL3_BYTECODE.startswith("0x6080604052600436106100f35760003560e01c")
+    balance_of_call = Call(cbETH, "balanceOf(address)(uint256)", (cbETH_holder), "balanceOf", identity_function, W3)
+    deployment_block = MULTICALL3_DEPLOYMENT_BLOCKS[Network.Mainnet]
+    lowest_block = MULTICALL3_OVERRIDE_MIN_BLOCKS[Network.Mainnet]
+    assert lowest_block == 7_280_000  # Constantinople
+
+    for engine in MULTICALL_ENGINES:
+        multicall = Multicall([balance_of_call], engine)
+        assert len(multicall.to_rpc_call_args(deployment_block)) == 2
+        rpc_args = multicall.to_rpc_call_args(deployment_block - 1)
+        assert rpc_args[2] == {multicall.multicall_address: {"code": MULTICALL3_BYTECODE}}
+        assert rpc_args[:2] == multicall.to_rpc_call_args(deployment_block)[:1] + [hex(deployment_block - 1)]
+        assert len(multicall.to_rpc_call_args(lowest_block, block_hash=bytes(32))) == 3
+        with pytest.raises(ValueError):
+            multicall.to_rpc_call_args(lowest_block - 1)
@@ -0,0 +1,45 @@
+from eth_abi.exceptions import DecodingError
+from hexbytes import HexBytes
+
+from multicallcache.signature import get_signature
+
+
+def _decode_data_or_none(signature, output):
+    try:
+        return signature.decode_data(output)
+    except DecodingError:
+        return None
+
+
+def test_decode_many_matches_decode_data():
+    signature = get_signature("f()(uint8,int16,address,bool,bytes4)")
+    words = [
+        (255).to_bytes(32, "big"),
+        (-300).to_bytes(32, "big", signed=True),
+        bytes(12) + bytes.fromhex("c02aaa39b223fe8d0a0e5c4f27ead9083c756cc2"),
+        (1).to_bytes(32, "big"),
+        b"\x12\x34\x56\x78" + bytes(28),
+    ]
+    valid = b"".join(words)
+    outputs = [
+        valid,
+        HexBytes(valid),
+        valid + b"trailing bytes are ignored",
+        b"\x01" + valid[1:],  # uint8 with non zero padding
+        valid[:32] + (1 << 20).to_bytes(32, "big") + valid[64:],  # out of range int16
+        valid[:96] + (2).to_bytes(32, "big") + valid[128:],  # bool that is not 0 or 1
+        valid[:-1] + b"\x01",  # bytes4 with non zero padding
+        valid[:40],  # too short
+        b"",
+    ]
+    decoded_outputs = signature.decode_many(outputs)
+
+    assert decoded_outputs[0] == (255, -300, "0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2", True, b"\x12\x34\x56\x78")
+    assert decoded_outputs == [_decode_data_or_none(signature, output) for output in outputs]
+    assert decoded_outputs[3:] == [None] * 6
+
+
+def test_decode_many_falls_back_to_eth_abi_for_dynamic_types():
+    signature = get_signature("f()(uint256[])")
+    output = (32).to_bytes(32, "big") + (2).to_bytes(32, "big") + (7).to_bytes(32, "big") + (8).to_bytes(32, "big")
+    assert signature.decode_many([output, b""]) == [((7, 8),), None]